@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Benchmark of the pipeline stages on synthetic data.
+
+The raw data is generated by synthetic_data.py in a workspace, then the preprocessing
+and feature stages (data_processing/pipeline.py, feature_engineering/run.py) run one
+by one in dependency order, with their inputs in memory as dag.Pipeline passes them.
+For each stage:
+    seconds: wall time of the stage function, the median of the repeats
+    write_seconds: wall time of saving its outputs by storage.write_frame; the stages storing
+                   their outputs themselves (rebuilt in each run) save them within seconds
+    peak_mb: peak memory allocated above the memory before the stage, traced by tracemalloc
+             (numpy buffers included) in one more run, as tracing slows the stages down
+    rows: the largest number of rows among the stage inputs and outputs
+    rows_per_sec: rows / seconds
+
+The results are saved as JSON, which can be kept as a baseline. Compared with a
+baseline of the same configuration, a stage slower or larger than the tolerance is
+flagged as a regression, and the exit code is 1.
+
+Usage:
+    python3 -u ./benchmark.py --stations 24 --grids 861 --years 1 --output baselines/s24_g861_y1.json
+    python3 -u ./benchmark.py --stations 24 --grids 861 --years 1 --compare baselines/s24_g861_y1.json
+
+@author: Stephen
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# feature_engineering first, whose run.py defines the feature stages
+for folder in ['feature_engineering', 'data_processing']:
+    path = os.path.normpath(os.path.join(BENCHMARK_DIR, os.pardir, folder))
+    if path not in sys.path:
+        sys.path.append(path)
+
+import numpy as np
+import pandas as pd
+from synthetic_data import generate
+
+def ordered_stages(stages):
+    """
+    Return the stages in dependency order, by name within a level.
+
+    params: stages: list of dag.Stage
+    return: list of dag.Stage
+    """
+    producer = {name: stage.name for stage in stages for name in stage.outputs}
+    names = {stage.name for stage in stages}
+    pending = {stage.name: stage for stage in stages}
+    done, ordered = set(), list()
+    while pending:
+        ready = [name for name, stage in sorted(pending.items())
+                 if {producer[i] for i in stage.inputs} | (set(stage.after) & names) <= done]
+        if not ready:
+            raise ValueError('Cyclic dependencies among stages: {}'.format(sorted(pending)))
+        for name in ready:
+            ordered.append(pending.pop(name))
+            done.add(name)
+    return ordered
+
+
+def benchmark_stages(root, submission_day1):
+    """
+    Create the stages of the pipeline, reading and writing in the workspace.
+
+    params: root: string, the workspace directory
+    params: submission_day1: datetime.date, the first prediction day
+    return: list of dag.Stage
+    """
+    from pipeline import preprocessing_stages
+    from run import feature_stages
+
+    rawPath = os.path.join(root, 'raw_data')
+    return (preprocessing_stages(rawPath, os.path.join(root, 'input', 'london'), retrieve=False)
+            + feature_stages(submission_day1, os.path.join(root, 'feature', 'london'), rawPath))
+
+
+def run_once(stages, traced=False):
+    """
+    Run the stages one by one and measure them.
+
+    params: stages: list of dag.Stage, in dependency order
+    params: traced: bool, measure the peak memory by tracemalloc, which slows the stages down
+    return: dict, stage name -> {seconds, write_seconds, peak_mb, rows}, peak_mb is None unless traced
+    """
+    from storage import apply_schema, memory_schema, read_frame, write_frame
+    from key_index import KeyIndex
+
+    frames, results = dict(), dict()
+    for stage in stages:
+        inputs = [frames[name] for name in stage.inputs]
+        if stage.stores:
+            # without their key indexes, the incremental outputs are built from all files again
+            for path in stage.outputs.values():
+                KeyIndex.remove(path)
+        gc.collect()
+        if traced:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        s = time.perf_counter()
+        result = stage.func(*inputs, **stage.params)
+        seconds = time.perf_counter() - s
+        peak = (tracemalloc.get_traced_memory()[1] - before) / 2**20 if traced else None
+        if len(stage.outputs) == 1:
+            result = (result,)
+
+        s = time.perf_counter()
+        for (name, path), df in zip(stage.outputs.items(), result):
+            if stage.stores:
+                # the stage returns the rows it stored, the consumers read the whole output
+                frames[name] = read_frame(path)
+                continue
+            frames[name] = memory_schema(apply_schema(df))
+            write_frame(frames[name], path)
+        writeSeconds = time.perf_counter() - s
+
+        rows = max([len(df) for df in inputs] + [len(df) for df in result])
+        results[stage.name] = {'seconds': seconds, 'write_seconds': writeSeconds, 'peak_mb': peak, 'rows': rows}
+        del result, inputs
+    return results
+
+
+def summarize(runs, memory):
+    """
+    Combine the timed runs (median time) and the traced run (peak memory).
+
+    params: runs: list of dict, see run_once()
+    params: memory: dict, see run_once(traced=True)
+    return: dict, stage name -> {seconds, write_seconds, peak_mb, rows, rows_per_sec}
+    """
+    summary = dict()
+    for name in runs[0]:
+        seconds = float(np.median([run[name]['seconds'] for run in runs]))
+        rows = runs[0][name]['rows']
+        summary[name] = {'seconds': round(seconds, 4),
+                         'write_seconds': round(float(np.median([run[name]['write_seconds'] for run in runs])), 4),
+                         'peak_mb': round(memory[name]['peak_mb'], 2),
+                         'rows': rows, 'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None}
+    return summary
+
+
+def environment():
+    """
+    Describe the machine and library versions of the results.
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'storage_format': os.environ.get('STORAGE_FORMAT', 'columnar'),
+            'compact_memory': os.environ.get('COMPACT_MEMORY', '1'),
+            'multi_target': os.environ.get('MULTI_TARGET', '0')}
+
+
+def compare(results, baseline, tolerance=0.2, memoryTolerance=0.2, minSeconds=0.05):
+    """
+    Flag the stages which are slower or use more memory than in the baseline.
+
+    Stages faster than minSeconds in both runs are not flagged for time, as their timing is mostly noise.
+
+    params: results: dict, the benchmark results
+    params: baseline: dict, earlier results of the same configuration
+    params: tolerance: float, the relative slowdown allowed
+    params: memoryTolerance: float, the relative growth of peak memory allowed
+    params: minSeconds: float
+    return: list of string, one message per regression
+    """
+    if results['config'] != baseline['config']:
+        raise ValueError('The baseline configuration {} differs from {}'.format(baseline['config'], results['config']))
+
+    regressions = list()
+    for name, current in sorted(results['stages'].items()):
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        if max(current['seconds'], before['seconds']) >= minSeconds and current['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.3f} secs, baseline {:.3f} secs (+{:.0%})'.format(
+                name, current['seconds'], before['seconds'], current['seconds'] / before['seconds'] - 1))
+        if current['peak_mb'] > max(before['peak_mb'], 1.0) * (1 + memoryTolerance):
+            regressions.append('{}: {:.1f} MB peak, baseline {:.1f} MB'.format(name, current['peak_mb'], before['peak_mb']))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    """
+    Print a table of the stages, with the change of time against the baseline.
+    """
+    print('{:<28} {:>9} {:>9} {:>9} {:>10} {:>12} {:>9}'.format(
+        'stage', 'secs', 'write', 'peak MB', 'rows', 'rows/sec', 'vs base'))
+    for name, stage in results['stages'].items():
+        change = ''
+        if baseline is not None and name in baseline['stages'] and baseline['stages'][name]['seconds'] > 0:
+            change = '{:+.0%}'.format(stage['seconds'] / baseline['stages'][name]['seconds'] - 1)
+        print('{:<28} {:>9.3f} {:>9.3f} {:>9.1f} {:>10} {:>12.0f} {:>9}'.format(
+            name, stage['seconds'], stage['write_seconds'], stage['peak_mb'], stage['rows'],
+            stage['rows_per_sec'] or 0, change))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--stations', type=int, default=24)
+    parser.add_argument('--grids', type=int, default=861)
+    parser.add_argument('--years', type=float, default=1.0)
+    parser.add_argument('--live-days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=os.path.join(BENCHMARK_DIR, 'workspace'),
+                        help='the directory of the synthetic raw data and the stage outputs')
+    parser.add_argument('--output', help='the JSON file of the results, default: results/{configuration}.json')
+    parser.add_argument('--compare', help='a baseline JSON file to flag regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='the relative slowdown allowed')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='the relative growth of peak memory allowed')
+    args = parser.parse_args()
+
+    config = {'stations': args.stations, 'grids': args.grids, 'years': args.years,
+              'live_days': args.live_days, 'seed': args.seed}
+    name = 's{}_g{}_y{}_d{}'.format(args.stations, args.grids, args.years, args.live_days)
+    root = os.path.abspath(os.path.join(args.workdir, name))
+
+    s = time.time()
+    written = generate(root, args.stations, args.grids, args.years, args.live_days, args.seed)
+    print('Synthetic raw data: {} historical rows, {} live rows ({:.2f} secs)'.format(
+        written['rows']['hist'], written['rows']['live'], time.time() - s))
+
+    # the station dictionary of the workspace, not of ../input
+    os.environ['STATION_DICTIONARY'] = os.path.join(root, 'input', 'station_dictionary.json')
+    submission_day1 = date(2018, 3, 31) + timedelta(days=args.live_days)
+    stages = ordered_stages(benchmark_stages(root, submission_day1))
+
+    runs = list()
+    for i in range(args.repeat):
+        runs.append(run_once(stages))
+        print('Run {} of {}: {:.2f} secs'.format(i + 1, args.repeat, sum(r['seconds'] for r in runs[-1].values())))
+    tracemalloc.start()
+    memory = run_once(stages, traced=True)
+    tracemalloc.stop()
+
+    results = {'config': config, 'environment': environment(), 'repeat': args.repeat,
+               'created': datetime.now().isoformat(timespec='seconds'), 'stages': summarize(runs, memory)}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(BENCHMARK_DIR, 'results', '{}.json'.format(name))
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results saved to {}'.format(output))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        for message in regressions:
+            print('REGRESSION {}'.format(message))
+        print('{} regressions against {}'.format(len(regressions), args.compare))
+        sys.exit(1 if regressions else 0)
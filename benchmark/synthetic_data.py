@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Deterministic synthetic raw data in the layouts of the official files.
+
+Written under {root}/raw_data, as the pipeline reads it:
+    London_AirQuality_Stations.csv
+    London_grid_weather_station.csv
+    London_historical_aqi_forecast_stations_20180331.csv
+    london/airquality/ld_airquality_{YYYYMMDD}.csv
+    london/grid/ld_grid_{YYYYMMDD}.csv
+
+The size scales with the number of air quality stations (the 24 London stations,
+then synthetic ones), grid points (the 861 London grid points on a 41 x 21 lattice,
+then more rows of the lattice), years of history before 2018-03-31 and days of live data after it.
+The same arguments and seed always write the same files.
+
+Usage:
+    python3 -u ./synthetic_data.py ../benchmark_data --stations 24 --grids 861 --years 1 --live-days 30
+
+@author: Stephen
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+LONDON_STATIONS = ['BL0', 'CD9', 'CD1', 'GN0', 'GR4', 'GN3', 'GR9', 'HV1', 'KF1', 'LW2', 'ST5', 'TH4', 'MY7',
+                   'BX9', 'BX1', 'CT2', 'CT3', 'CR8', 'GB0', 'HR1', 'LH0', 'KC1', 'RB7', 'TD5']
+PREDICTED_STATIONS = 13
+GRID_COLUMNS = 41
+HISTORY_END = pd.Timestamp('2018-03-31')
+MISSING_ROWS = 0.03
+MISSING_VALUES = 0.05
+
+
+def station_names(stations):
+    """
+    Return the names of the air quality stations, the London stations first.
+
+    params: stations: int
+    return: list of string
+    """
+    names = LONDON_STATIONS[:stations]
+    return names + ['SY{:03d}'.format(i) for i in range(stations - len(names))]
+
+
+def grid_names(grids):
+    """
+    Return the names of the grid points, e.g. london_grid_000.
+
+    params: grids: int
+    return: list of string
+    """
+    return ['london_grid_{:03d}'.format(i) for i in range(grids)]
+
+
+def hourly_values(rng, stations, times, level, scale):
+    """
+    Positive values with a daily cycle, a per-station level and gamma noise.
+
+    params: rng: numpy.random.Generator
+    params: stations: int
+    params: times: DatetimeIndex
+    params: level: float, the mean value
+    params: scale: float, the relative size of the daily cycle and of the noise
+    return: numpy array in shape of (stations, len(times))
+    """
+    hours = times.hour.values[None, :]
+    base = level * (0.5 + rng.random((stations, 1)))
+    cycle = 1 + scale * np.sin(2 * np.pi * (hours - 8) / 24)
+    return base * cycle * rng.gamma(1 / scale, scale, (stations, len(times)))
+
+
+def sparse_rows(rng, shape):
+    """
+    Return a bool mask of the (station, hour) rows present in a file, with some rows missing.
+    """
+    return rng.random(shape) >= MISSING_ROWS
+
+
+def with_missing(rng, values):
+    """
+    Return the values with some of them missing.
+    """
+    values = values.copy()
+    values[rng.random(values.shape) < MISSING_VALUES] = np.nan
+    return values
+
+
+def write_stations(rawPath, stations, grids, rng):
+    """
+    Write the coordinates of the air quality stations and of the grid points.
+    """
+    names = station_names(stations)
+    pd.DataFrame({'need_prediction': [True if i < PREDICTED_STATIONS else np.nan for i in range(stations)],
+                  'Latitude': 51.35 + 0.3 * rng.random(stations),
+                  'Longitude': -0.45 + 0.6 * rng.random(stations),
+                  'SiteType': 'Urban Background', 'SiteName': names},
+                 index=pd.Index(names)).to_csv('{}/London_AirQuality_Stations.csv'.format(rawPath))
+
+    # 0.1 degree lattice, from (50.5, -2.0) to the north and east
+    i = np.arange(grids)
+    pd.DataFrame({'longitude': np.round(-2.0 + 0.1 * (i % GRID_COLUMNS), 1),
+                  'latitude': np.round(50.5 + 0.1 * (i // GRID_COLUMNS), 1)},
+                 index=pd.Index(grid_names(grids), name='stationName')).to_csv(
+        '{}/London_grid_weather_station.csv'.format(rawPath))
+
+
+def write_history(rawPath, stations, years, rng):
+    """
+    Write the historical air quality file, hourly until HISTORY_END.
+    """
+    times = pd.date_range(HISTORY_END - pd.Timedelta(days=int(round(365 * years))), HISTORY_END, freq='h', inclusive='left')
+    names = np.asarray(station_names(stations), dtype=object)
+    keep = sparse_rows(rng, (stations, len(times)))
+    stationIndex, timeIndex = np.nonzero(keep)
+    values = {name: with_missing(rng, hourly_values(rng, stations, times, level, 0.4)[keep])
+              for name, level in [('PM2.5 (ug/m3)', 12.0), ('PM10 (ug/m3)', 20.0), ('NO2 (ug/m3)', 35.0)]}
+    df = pd.DataFrame(dict({'MeasurementDateGMT': times.strftime('%Y/%m/%d %H:%M').values[timeIndex],
+                            'station_id': names[stationIndex]}, **values))
+    df.to_csv('{}/London_historical_aqi_forecast_stations_20180331.csv'.format(rawPath), float_format='%.1f')
+    return len(df)
+
+
+def write_live_day(rawPath, day, names, grids, rng):
+    """
+    Write the live air quality file and the live grid weather file of a day.
+    """
+    times = pd.date_range(day, periods=24, freq='h')
+    text = times.strftime('%Y-%m-%d %H:%M:%S').values
+    rows = 0
+
+    keep = sparse_rows(rng, (len(names), len(times)))
+    stationIndex, timeIndex = np.nonzero(keep)
+    aq = pd.DataFrame({'id': np.arange(len(stationIndex)), 'station_id': names[stationIndex], 'time': text[timeIndex]})
+    for col, level in [('PM25_Concentration', 12.0), ('PM10_Concentration', 20.0), ('NO2_Concentration', 35.0),
+                       ('CO_Concentration', 0.5), ('O3_Concentration', 40.0), ('SO2_Concentration', 3.0)]:
+        aq[col] = with_missing(rng, hourly_values(rng, len(names), times, level, 0.4)[keep])
+    aq.to_csv('{}/london/airquality/ld_airquality_{:%Y%m%d}.csv'.format(rawPath, day), index=False, float_format='%.1f')
+    rows += len(aq)
+
+    gridIndex, timeIndex = np.nonzero(np.ones((grids, len(times)), dtype=bool))
+    n = len(gridIndex)
+    hours = times.hour.values[timeIndex]
+    grid = pd.DataFrame({'id': np.arange(n), 'station_id': np.asarray(grid_names(grids), dtype=object)[gridIndex],
+                         'time': text[timeIndex], 'weather': 'CLEAR_DAY',
+                         'temperature': 9 + 4 * np.sin(2 * np.pi * (hours - 9) / 24) + rng.normal(0, 1.5, n),
+                         'pressure': 1012 + rng.normal(0, 4, n),
+                         'humidity': np.clip(75 - 10 * np.sin(2 * np.pi * (hours - 9) / 24) + rng.normal(0, 5, n), 0, 100),
+                         'wind_direction': rng.uniform(0, 360, n),
+                         'wind_speed': rng.gamma(2, 2, n)})
+    grid.to_csv('{}/london/grid/ld_grid_{:%Y%m%d}.csv'.format(rawPath, day), index=False, float_format='%.2f')
+    return rows + n
+
+
+def generate(root, stations=24, grids=861, years=1.0, liveDays=30, seed=0):
+    """
+    Write the synthetic raw data under {root}/raw_data.
+
+    Files of the same configuration are not written again (see {root}/raw_data/synthetic.json).
+
+    params: root: string, the workspace directory
+    params: stations: int, the number of air quality stations, at least 1
+    params: grids: int, the number of grid points, at least 1
+    params: years: float, the years of historical data
+    params: liveDays: int, the days of live data from 2018-03-31
+    params: seed: int
+    return: dict, the configuration and the number of rows written per file type
+    """
+    rawPath = os.path.join(root, 'raw_data')
+    config = {'stations': stations, 'grids': grids, 'years': years, 'live_days': liveDays, 'seed': seed}
+    configPath = os.path.join(rawPath, 'synthetic.json')
+    if os.path.isfile(configPath):
+        with open(configPath) as f:
+            written = json.load(f)
+        if written['config'] == config:
+            return written
+
+    for directory in ['london/airquality', 'london/grid']:
+        path = os.path.join(rawPath, directory)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+        else:
+            os.makedirs(path)
+
+    # one generator per file type, so the history does not change with the live days
+    hist_rng, station_rng, live_rng = (np.random.default_rng([seed, i]) for i in range(3))
+    write_stations(rawPath, stations, grids, station_rng)
+    rows = {'hist': write_history(rawPath, stations, years, hist_rng), 'live': 0}
+    names = np.asarray(station_names(stations), dtype=object)
+    for day in pd.date_range(HISTORY_END, periods=liveDays, freq='D'):
+        rows['live'] += write_live_day(rawPath, day, names, grids, live_rng)
+
+    written = {'config': config, 'rows': rows}
+    with open(configPath, 'w') as f:
+        json.dump(written, f, indent=1)
+    return written
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write synthetic raw data.')
+    parser.add_argument('root', help='the workspace directory, raw data goes to {root}/raw_data')
+    parser.add_argument('--stations', type=int, default=24)
+    parser.add_argument('--grids', type=int, default=861)
+    parser.add_argument('--years', type=float, default=1.0)
+    parser.add_argument('--live-days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    s = time.time()
+    written = generate(args.root, args.stations, args.grids, args.years, args.live_days, args.seed)
+    print('Synthetic raw data: {} historical rows, {} live rows'.format(written['rows']['hist'], written['rows']['live']))
+    print('Generation time: {:.2f} secs'.format(time.time() - s))
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+City configurations of the pipeline.
+
+A city names its stations to be predicted, its pollutants (prediction targets),
+the measurements kept from its air quality data, and its raw files:
+    the station and grid coordinates, and the one-file historical air quality data.
+The live data is read from {rawPath}/{city}/airquality and {rawPath}/{city}/grid,
+where retrieve_data.py saves it for both cities.
+
+Preprocessed data goes to ../input/{city} and features to ../feature/{city}, e.g.
+    ../input/beijing/beijing_aq_hist_data_merged
+    ../feature/beijing/train/O3/all_features
+
+Coordinate files are CSV with the station name as the first column and latitude and
+longitude columns (any case). Beijing_grid_weather_station.csv has no header.
+Beijing station coordinates are read from Beijing_AirQuality_Stations.csv, the official
+Beijing_AirQuality_Stations_en.xlsx saved as CSV.
+
+Scripts take the city as an argument, default: london, e.g. python3 create_label.py beijing
+
+In multi-target mode (MULTI_TARGET=1, or the script argument multi), all the measurements of a city
+are labeled and featured together into wide frames, e.g. ../input/london/london_aq_hist_data_w_labels
+and ../feature/london/train/all_features, and the frames of each pollutant are views over them.
+
+@author: Stephen
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS = 6371.0
+
+
+class City(object):
+    """
+    The configuration of a city.
+
+    params: name: string, e.g. 'london'
+    params: abbr: string, the abbreviation of the API and the daily files, e.g. 'ld'
+    params: stations: list of string, the stations to be predicted
+    params: pollutants: dict, target -> abbreviation in file names, e.g. {'PM2.5': 'PM25'}
+    params: measurements: list of string, the air quality columns kept, all of them are targets in multi-target mode
+    params: aqStationsFile: string, the coordinates of the air quality stations, under rawPath
+    params: gridStationsFile: string, the coordinates of the grid points, under rawPath
+    params: gridStationsHeader: bool, False when the grid file has no header (name, longitude, latitude)
+    params: histFiles: list of string, the historical air quality files, under rawPath
+    params: histColumns: dict, raw column -> column, the other raw columns are dropped
+    params: histIndexCol: int, the index column of the historical files, None if there is none
+    params: dataTypes: list of string, the data types retrieved by retrieve_data.py
+    """
+    def __init__(self, name, abbr, stations, pollutants, measurements, aqStationsFile, gridStationsFile, histFiles,
+                 histColumns, histIndexCol=None, gridStationsHeader=True, dataTypes=('airquality', 'grid')):
+        self.name = name
+        self.abbr = abbr
+        self.stations = list(stations)
+        self.pollutants = dict(pollutants)
+        self.measurements = list(measurements)
+        self.aqStationsFile = aqStationsFile
+        self.gridStationsFile = gridStationsFile
+        self.gridStationsHeader = gridStationsHeader
+        self.histFiles = list(histFiles)
+        self.histColumns = dict(histColumns)
+        self.histIndexCol = histIndexCol
+        self.dataTypes = list(dataTypes)
+
+    @property
+    def inputPath(self):
+        return '../input/{}'.format(self.name)
+
+    @property
+    def featurePath(self):
+        return '../feature/{}'.format(self.name)
+
+    @property
+    def stationDictionary(self):
+        return '{}/station_dictionary.json'.format(self.inputPath)
+
+    def frame(self, name, inputPath=None):
+        """
+        Return the path of a preprocessed frame, e.g. frame('aq_hist_data_merged').
+        """
+        return '{}/{}_{}'.format(inputPath or self.inputPath, self.name, name)
+
+    def label_frame(self, target, kind, inputPath=None):
+        """
+        Return the path of the labeled data of a target, kind: 'hist' or 'live'.
+        """
+        return self.frame('{}_{}_data_w_label'.format(self.pollutants[target], kind), inputPath)
+
+    def labels_frame(self, kind, inputPath=None):
+        """
+        Return the path of the labeled data of all measurements (multi-target mode), kind: 'hist' or 'live'.
+        """
+        return self.frame('aq_{}_data_w_labels'.format(kind), inputPath)
+
+    def pairs(self):
+        """
+        Return the (dataType, city) pairs retrieved for the city.
+        """
+        return [(dataType, self.name) for dataType in self.dataTypes]
+
+
+LONDON = City('london', 'ld',
+              stations=['BL0', 'CD9', 'CD1', 'GN0', 'GR4', 'GN3', 'GR9', 'HV1', 'KF1', 'LW2', 'ST5', 'TH4', 'MY7'],
+              pollutants={'PM2.5': 'PM25', 'PM10': 'PM10'},
+              measurements=['PM2.5', 'PM10', 'NO2'],
+              aqStationsFile='London_AirQuality_Stations.csv',
+              gridStationsFile='London_grid_weather_station.csv',
+              histFiles=['London_historical_aqi_forecast_stations_20180331.csv'],
+              histColumns={'MeasurementDateGMT': 'utc_time', 'station_id': 'station_id', 'PM2.5 (ug/m3)': 'PM2.5',
+                           'PM10 (ug/m3)': 'PM10', 'NO2 (ug/m3)': 'NO2'},
+              histIndexCol=0)
+
+BEIJING = City('beijing', 'bj',
+               stations=['dongsi_aq', 'tiantan_aq', 'guanyuan_aq', 'wanshouxigong_aq', 'aotizhongxin_aq',
+                         'nongzhanguan_aq', 'wanliu_aq', 'beibuxinqu_aq', 'zhiwuyuan_aq', 'fengtaihuayuan_aq',
+                         'yungang_aq', 'gucheng_aq', 'fangshan_aq', 'daxing_aq', 'yizhuang_aq', 'tongzhou_aq',
+                         'shunyi_aq', 'pingchang_aq', 'mentougou_aq', 'pinggu_aq', 'huairou_aq', 'miyun_aq',
+                         'yanqin_aq', 'dingling_aq', 'badaling_aq', 'miyunshuiku_aq', 'donggaocun_aq',
+                         'yongledian_aq', 'yufa_aq', 'liulihe_aq', 'qianmen_aq', 'yongdingmennei_aq',
+                         'xizhimenbei_aq', 'nansanhuan_aq', 'dongsihuan_aq'],
+               pollutants={'PM2.5': 'PM25', 'PM10': 'PM10', 'O3': 'O3'},
+               measurements=['PM2.5', 'PM10', 'NO2', 'O3'],
+               aqStationsFile='Beijing_AirQuality_Stations.csv',
+               gridStationsFile='Beijing_grid_weather_station.csv',
+               gridStationsHeader=False,
+               histFiles=['beijing_17_18_aq.csv', 'beijing_201802_201803_aq.csv'],
+               histColumns={'stationId': 'station_id', 'utc_time': 'utc_time', 'PM2.5': 'PM2.5', 'PM10': 'PM10',
+                            'NO2': 'NO2', 'O3': 'O3'},
+               dataTypes=('meteorology', 'airquality', 'grid'))
+
+CITIES = {city.name: city for city in [LONDON, BEIJING]}
+
+
+def get_city(city):
+    """
+    Return the configuration of a city.
+
+    params: city: string or City
+    return: City
+    """
+    if isinstance(city, City):
+        return city
+    if city not in CITIES:
+        raise ValueError('Unknown city: {}, options: {}'.format(city, list(CITIES)))
+    return CITIES[city]
+
+
+def city_arguments(default=('london',)):
+    """
+    Return the cities named in the script arguments, e.g. python3 run.py beijing london
+
+    params: default: tuple of string, when no city is named
+    return: list of string
+    """
+    names = [arg for arg in sys.argv[1:] if arg in CITIES]
+    return names or list(default)
+
+
+def multi_target():
+    """
+    Return True in multi-target mode, set by MULTI_TARGET=1 or the script argument multi.
+    """
+    return os.environ.get('MULTI_TARGET', '0') == '1' or 'multi' in sys.argv[1:]
+
+
+def station_coordinates(path, header=True):
+    """
+    Read a coordinates file.
+
+    params: path: string
+    params: header: bool, False when the columns are name, longitude, latitude without header
+    return: DataFrame, indexed by station, with columns latitude and longitude
+    """
+    if header:
+        df = pd.read_csv(path, index_col=0)
+        df.columns = [col.lower() for col in df.columns]
+    else:
+        df = pd.read_csv(path, header=None, index_col=0, names=['station', 'longitude', 'latitude'])
+    return df[['latitude', 'longitude']]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distances in km, broadcast over the inputs.
+
+    params: lat1, lon1, lat2, lon2: numpy arrays of degrees
+    return: numpy array
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
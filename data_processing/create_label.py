@@ -6,18 +6,44 @@ In our case, the air quality data of next hour is set as label.
 For example:
 PM2.5 at 13:00 is the label of the input data at 12:00
 
+create_labels() builds the labels of every forecast horizon (1-48 hours) at once.
+Each station is laid onto its own hourly index, so a label is only set when the
+observation exactly `horizon` hours later exists.
+
+Benchmark against the original create_label():
+    python3 -u ./create_label.py benchmark
+
+Streaming mode labels the historical data in chunks within a memory limit (MB, default: 512):
+    python3 -u ./create_label.py stream 512
+
+The cities named in the arguments are labeled (default: london), for each of their pollutants:
+    python3 -u ./create_label.py beijing london
+
+Multi-target mode labels all the measurements of a city (NO2 included) with one sort and one
+panel, into one wide frame per data kind, {city}_aq_{kind}_data_w_labels:
+    python3 -u ./create_label.py multi
+
 @author: Stephen
 
 Note:
-The rows are dropped if their labels are NaN.
-Alternative way is to drop the rows with invalid labels when training the models
-Do model training methods neglect invalid row by default?
+The invalid labels are filled with 0, and the valid ones are recorded in a bitmap column
+per target ({target}_label_validity, bit h - 1 for the label of horizon h), so that the rows
+with invalid labels can be dropped when training the models.
 """
 
 import pandas as pd
 import numpy as np
-import os
+import sys
 import time
+from storage import read_frame, write_frame, frame_exists, compact_mode
+from storage import iter_frame, append_frame, chunk_rows, memory_limit
+from panel import Panel
+from parallel import station_bounds, map_stations
+from validity import with_missing
+from tracing import traced
+from cities import get_city, city_arguments, multi_target
+
+HORIZONS = range(1, 49)
 
 def create_label(df, target, offset=1):
     """
@@ -38,53 +64,296 @@ def create_label(df, target, offset=1):
     return df
 
 
+def label_name(target, horizon):
+    """
+    Name of the label column of a horizon, e.g. 'PM2.5_label' (1 hour) or 'PM2.5_label_24' (24 hours).
+    """
+    return '{}_label'.format(target) if horizon == 1 else '{}_label_{}'.format(target, horizon)
+
+
+def target_list(target):
+    """
+    Return a target or a list of targets as a list, e.g. 'PM2.5' -> ['PM2.5'].
+    """
+    return [target] if isinstance(target, str) else list(target)
+
+
+def _label_stations(inputs, outputs, start, stop, targets, horizons):
+    """
+    Create the labels of the stations in the rows [start, stop), on a panel of their own.
+
+    params: inputs: dict, 'stations': int64 station codes (-1 for no station), 'times': utc_time,
+                    'target{j}': the values of the j-th target
+    params: outputs: dict, 'labels': array in shape of (targets * horizons, rows), written in place
+    params: start: int, the first row, of a station
+    params: stop: int, the row after the last one, of a station
+    params: targets: list of string
+    params: horizons: numpy array of int
+    return: None
+    """
+    codes = inputs['stations'][start:stop]
+    df = pd.DataFrame({'station_id': pd.Categorical.from_codes(codes, categories=np.arange(codes.max(initial=-1) + 1)),
+                       'utc_time': inputs['times'][start:stop]})
+    for j, name in enumerate(targets):
+        df[name] = inputs['target{}'.format(j)][start:stop]
+
+    panel = Panel.from_frame(df, targets)
+    stationIndex, timeIndex = panel.locate(df)
+    labels = outputs['labels']
+    for k, h in enumerate(horizons):
+        for j, values in enumerate(panel.lookup_many(targets, stationIndex, timeIndex, h)):
+            labels[j * len(horizons) + k, start:stop] = values
+
+
+@traced()
+def create_labels(df, target, horizons=HORIZONS, workers=None):
+    """
+    Create the labels of several horizons for all stations in one pass per station.
+
+    The observations are placed on a dense station x hour panel, and the label
+    of horizon h is read at position (hour + h). Missing hours are masked in
+    the panel, so gaps produce NaN labels without any delta check.
+    Several targets share the sort and the panel. Only the observed values are
+    laid on the panel, by the validity bitmap (see validity.py), so a missing
+    reading filled with 0 or an imputed value gives no label.
+    With several workers, the stations are split among worker processes over
+    shared memory, each with its own panel, see parallel.map_stations().
+
+    params: df: DataFrame, including station_id, utc_time and target columns
+    params: target: string or list of string, e.g. 'PM2.5' or ['PM2.5', 'PM10', 'NO2']
+    params: horizons: iterable of int (>0), the hour intervals from input time to label time
+    params: workers: int, the number of worker processes, default: parallel.station_workers()
+    return: df: DataFrame, sorted by station_id and utc_time, with one label column per target and horizon
+    """
+    targets = target_list(target)
+    horizons = np.asarray(list(horizons), dtype=np.int64)
+    df = df.sort_values(['station_id', 'utc_time'], kind='mergesort').reset_index(drop=True)
+
+    codes = pd.factorize(df['station_id'])[0].astype(np.int64)
+    inputs = {'stations': codes, 'times': df['utc_time'].values}
+    # the labels are only read from observations, not from missing or imputed values
+    observed = with_missing(df, targets, observed=True)
+    for j, name in enumerate(targets):
+        values = np.asarray(observed[name].values)
+        inputs['target{}'.format(j)] = values if values.dtype.kind in 'iubf' else values.astype(np.float64)
+    # one label per row, so a column is contiguous
+    labels = np.full((len(targets) * len(horizons), len(df)), np.nan, dtype=np.float32 if compact_mode() else np.float64)
+    outputs, _ = map_stations(_label_stations, inputs, {'labels': labels}, station_bounds(codes), (targets, horizons), workers)
+
+    labelNames = [label_name(name, h) for name in targets for h in horizons]
+    return pd.concat([df, pd.DataFrame(outputs['labels'].T, columns=labelNames)], axis=1)
+
+
+def label_validity_name(target):
+    """
+    Name of the validity bitmap of the labels of a target, e.g. 'PM2.5_label_validity'.
+    """
+    return '{}_label_validity'.format(target)
+
+
+def label_validity_columns(df, target):
+    """
+    Return the label validity bitmaps of the targets which a frame has, to be selected with its labels.
+
+    params: df: DataFrame
+    params: target: string or list of string
+    return: list of string
+    """
+    return [label_validity_name(name) for name in target_list(target) if label_validity_name(name) in df.columns]
+
+
+def label_validity(df, target, horizons=HORIZONS):
+    """
+    Return the validity bitmap of the labels of a target: bit h - 1 is set when the label of horizon h exists.
+
+    params: df: DataFrame, with the label columns of create_labels(), before they are filled
+    params: target: string
+    params: horizons: iterable of int, from 1 to 64
+    return: numpy array of uint64
+    """
+    bits = np.zeros(len(df), dtype=np.uint64)
+    for h in horizons:
+        if not 1 <= h <= 64:
+            raise ValueError('The label validity bitmap holds horizons of 1 to 64 hours: {}'.format(h))
+        bits |= pd.notna(df[label_name(target, h)].values).astype(np.uint64) << np.uint64(h - 1)
+    return bits
+
+
+@traced()
+def label_data(df, target, horizons=HORIZONS):
+    """
+    Create the labels of all horizons, and fill the invalid labels with 0.
+
+    The labels which exist are recorded in a validity bitmap per target (label_validity_name()),
+    so that the rows of filled labels can be left out when training.
+
+    params: df: DataFrame, merged air quality data
+    params: target: string or list of string, see create_labels()
+    params: horizons: iterable of int (>0)
+    return: df: DataFrame
+    """
+    horizons = list(horizons)
+    df = create_labels(df, target, horizons)
+    df = df.assign(**{label_validity_name(name): label_validity(df, name, horizons) for name in target_list(target)})
+    return df.fillna({label_name(name, h): 0 for name in target_list(target) for h in horizons})
+
+
+def station_latest(df):
+    """
+    Return the latest utc_time of each station.
+
+    params: df: DataFrame, including station_id and utc_time columns
+    return: Series, indexed by station_id
+    """
+    return df.groupby(df['station_id'].astype(object))['utc_time'].max()
+
+
+def check_time_order(chunk, latest):
+    """
+    Raise ValueError if a chunk has rows of a station not after the latest rows of the previous chunks.
+
+    params: chunk: DataFrame, including station_id and utc_time columns
+    params: latest: Series, see station_latest()
+    return: None
+    """
+    first = chunk.groupby(chunk['station_id'].astype(object))['utc_time'].min()
+    common = first.index.intersection(latest.index)
+    if (first[common] <= latest[common]).any():
+        raise ValueError('Rows of a station are not in time order across chunks; sort by station_id and utc_time first')
+
+
+def stream_labels(chunks, target, horizons=HORIZONS):
+    """
+    Label chunks of air quality data, the same as label_data() on all of them at once.
+
+    The rows of a station must come in time order across chunks. A row is yielded once
+    the observations of all its horizons are known, and the rows within the largest horizon
+    of their station's latest observation are carried to the next chunk.
+
+    params: chunks: iterable of DataFrame, merged air quality data
+    params: target: string, options: ['PM2.5', 'PM10']
+    params: horizons: iterable of int (>0)
+    return: generator of DataFrame, labeled rows sorted by station_id and utc_time within a chunk
+    """
+    horizons = list(horizons)
+    horizon = pd.Timedelta(hours=max(horizons))
+    pending = None
+    latest = pd.Series(dtype='datetime64[ns]')
+    for chunk in chunks:
+        check_time_order(chunk, latest)
+        df = chunk if pending is None else pd.concat([pending, chunk], axis=0, ignore_index=True)
+        latest = station_latest(df).combine_first(latest)
+
+        labeled = label_data(df, target, horizons)
+        last = labeled['station_id'].astype(object).map(latest).values
+        final = (labeled['utc_time'] + horizon).values <= last
+        yield labeled[final]
+        pending = labeled.loc[~final, df.columns]
+    if pending is not None and len(pending):
+        yield label_data(pending, target, horizons)
+
+
+@traced()
+def stream_label_data(inputPath, outputPath, target, memoryLimit=None):
+    """
+    Label a stored frame chunk by chunk, and write the labeled rows as they are done.
+
+    params: inputPath: string, merged air quality data, without extension
+    params: outputPath: string, without extension, replaced if it exists
+    params: target: string, options: ['PM2.5', 'PM10']
+    params: memoryLimit: float, in MB, default: memory_limit()
+    return: int, the number of rows written
+    """
+    # input columns and all labels, in float64, with the copies of sorting and concatenation
+    bytesPerRow = 4 * 8 * (8 + len(HORIZONS))
+    rows = chunk_rows(memoryLimit or memory_limit(), bytesPerRow)
+    written = 0
+    for labeled in stream_labels(iter_frame(inputPath, rows), target):
+        if written == 0:
+            write_frame(labeled, outputPath)
+        else:
+            append_frame(labeled, outputPath)
+        written += len(labeled)
+    return written
+
+
+def benchmark(filepath='../input/london/london_aq_hist_data_merged', target='PM2.5'):
+    """
+    Compare create_labels() with the groupby create_label() on the historical data.
+
+    params: filepath: string, merged air quality data, without extension
+    params: target: string, options: ['PM2.5', 'PM10']
+    return: dict, timings in seconds and the number of 1-hour labels which differ
+    """
+    df = read_frame(filepath)
+
+    s = time.time()
+    old = pd.concat([create_label(group.copy(), target=target) for _, group in df.groupby('station_id', observed=True)])
+    old_time = time.time() - s
+
+    s = time.time()
+    new = create_labels(df, target)
+    new_time = time.time() - s
+
+    # create_label() reads timedelta.seconds, so gaps of n days + 1 hour are taken as 1 hour
+    old = old.sort_values(['station_id', 'utc_time'], kind='mergesort')
+    oldLabel = old[label_name(target, 1)].values
+    newLabel = new[label_name(target, 1)].values
+    mismatch = int((~np.isclose(oldLabel, newLabel, equal_nan=True)).sum())
+
+    print('create_label (1 horizon): {:.2f} secs'.format(old_time))
+    print('create_labels ({} horizons): {:.2f} secs'.format(len(HORIZONS), new_time))
+    print('1-hour labels differing: {} of {}'.format(mismatch, len(new)))
+    return {'create_label': old_time, 'create_labels': new_time, 'mismatch': mismatch}
+
+
 if __name__ == "__main__":
 
-    start = time.time()
-
-    ###################
-    # Historical Data #
-    ###################
-    # Note: This pipeline will be skipped if the historical data already exists.
-
-    london_aq_hist_data = pd.read_csv('../input/london/london_aq_hist_data_merged.csv.gz', compression='gzip')
-    london_aq_hist_data['utc_time'] = pd.to_datetime(london_aq_hist_data['utc_time'])
-
-    PM25_hist_filepath = '../input/london/london_PM25_hist_data_w_label.csv'
-    if not os.path.isfile(PM25_hist_filepath):
-        london_PM25_data = london_aq_hist_data.groupby('station_id').apply(create_label, target='PM2.5').fillna({'PM2.5_label':0}).drop(['utc_time_delta'], axis=1)
-        london_PM25_data.to_csv(PM25_hist_filepath, index=False)
-        print('London PM2.5 hist label data created and saved.')
-        del london_PM25_data
-    else:
-        print('London PM2.5 hist label data already exists')
-
-    PM10_hist_filepath = '../input/london/london_PM10_hist_data_w_label.csv'
-    if not os.path.isfile(PM10_hist_filepath):
-        london_PM10_data = london_aq_hist_data.groupby('station_id').apply(create_label, target='PM10').fillna({'PM10_label':0}).drop(['utc_time_delta'], axis=1)
-        london_PM10_data.to_csv(PM10_hist_filepath, index=False)
-        print('London PM10 hist label data created and saved.')
-        del london_PM10_data
-    else:
-        print('London PM10 hist label data already exists')
-
-    #############
-    # Live Data #
-    #############
-    london_aq_live_data = pd.read_csv('../input/london/london_aq_live_data_merged.csv.gz', compression='gzip')
-    london_aq_live_data['utc_time'] = pd.to_datetime(london_aq_live_data['utc_time'])
-
-    PM25_live_filepath = '../input/london/london_PM25_live_data_w_label.csv'
-    london_PM25_live_data = london_aq_live_data.groupby('station_id').apply(create_label, target='PM2.5').fillna({'PM2.5_label':0}).drop(['utc_time_delta'], axis=1)
-    london_PM25_live_data.to_csv(PM25_live_filepath, index=False)
-    print('London PM2.5 live label data created and saved.')
-    del london_PM25_live_data
-
-    PM10_live_filepath = '../input/london/london_PM10_live_data_w_label.csv'
-    london_PM10_live_data = london_aq_live_data.groupby('station_id').apply(create_label, target='PM10').fillna({'PM10_label':0}).drop(['utc_time_delta'], axis=1)
-    london_PM10_live_data.to_csv(PM10_live_filepath, index=False)
-    print('London PM10 live label data created and saved.')
-    del london_PM10_live_data
-
-    end = time.time()
-    print("Labeling Process time: {:.2f} secs".format(end-start))
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+        sys.exit()
+
+    for city in map(get_city, city_arguments()):
+        if multi_target():
+            start = time.time()
+            for kind in ['hist', 'live']:
+                write_frame(label_data(read_frame(city.frame('aq_{}_data_merged'.format(kind))), city.measurements),
+                            city.labels_frame(kind))
+                print('{} {} label data of {} created and saved.'.format(city.name.title(), kind, city.measurements))
+            print("Labeling Process time: {:.2f} secs".format(time.time()-start))
+            continue
+
+        start = time.time()
+
+        ###################
+        # Historical Data #
+        ###################
+        if len(sys.argv) > 1 and sys.argv[1] == 'stream':
+            # within the memory limit: the historical data is only read in chunks, never as a whole
+            memoryLimit = float(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2][:1].isdigit() else None
+            for target in city.pollutants:
+                rows = stream_label_data(city.frame('aq_hist_data_merged'), city.label_frame(target, 'hist'),
+                                         target, memoryLimit)
+                print('{} {} hist label data streamed: {} rows'.format(city.name.title(), target, rows))
+        else:
+            # Note: This pipeline will be skipped if the historical data already exists.
+            aq_hist_data = read_frame(city.frame('aq_hist_data_merged'))
+            for target in city.pollutants:
+                hist_filepath = city.label_frame(target, 'hist')
+                if not frame_exists(hist_filepath):
+                    write_frame(label_data(aq_hist_data, target=target), hist_filepath)
+                    print('{} {} hist label data created and saved.'.format(city.name.title(), target))
+                else:
+                    print('{} {} hist label data already exists'.format(city.name.title(), target))
+            del aq_hist_data
+
+        #############
+        # Live Data #
+        #############
+        aq_live_data = read_frame(city.frame('aq_live_data_merged'))
+        for target in city.pollutants:
+            write_frame(label_data(aq_live_data, target=target), city.label_frame(target, 'live'))
+            print('{} {} live label data created and saved.'.format(city.name.title(), target))
+
+        end = time.time()
+        print("Labeling Process time: {:.2f} secs".format(end-start))
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+In-process DAG runner of the pipeline stages.
+
+A stage is a function of DataFrames. It receives the outputs of upstream stages
+in memory and returns its own outputs, which are also saved by storage.write_frame,
+unless the stage stores them itself (e.g. the live data integrated incrementally):
+such a stage only returns the rows it stored, and its outputs are read from storage
+by the downstream stages which run.
+
+Each stage has a fingerprint, the hash of:
+    1. the source code of the stage function's module (code version)
+    2. its parameters
+    3. the fingerprints of its input frames, and the content of its raw files
+A stage is skipped when its fingerprint equals the one recorded in the cache
+and all its outputs are still stored. The outputs of skipped stages are only
+read back from storage when a downstream stage has to run.
+
+Stages whose dependencies are done run concurrently in a thread pool.
+
+The memory of the input and output frames of each stage run is printed at
+the end and saved as memory_report.json next to the cache.
+
+Each stage run is a tracing span under the span of the pipeline (see tracing.py).
+
+Several cities run their own pipelines in worker processes (run_cities), one
+process per city, so a slow city does not hold the others' stages.
+
+@author: Stephen
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from storage import apply_schema, memory_schema, memory_usage, read_frame, write_frame, frame_exists
+from tracing import span, current, from_environment
+from cities import get_city
+
+
+class Stage(object):
+    """
+    A pipeline stage.
+
+    params: name: string, unique in a pipeline
+    params: func: callable, func(*input frames, **params) returns a DataFrame, or a tuple for several outputs
+    params: inputs: list of string, names of the frames produced by other stages
+    params: outputs: dict, output frame name -> storage path (without extension), in the order func returns them
+    params: params: dict, keyword arguments of func, part of the fingerprint
+    params: files: list of string, raw files or directories read by func, hashed by content
+    params: after: list of string, names of stages to wait for without taking their outputs
+    params: cache: bool, False to always run the stage (e.g. data retrieval)
+    params: code: list of string, other modules whose source is part of the code version
+    params: stores: bool, True when func stores its outputs at their paths itself and returns only the rows it stored,
+                    they are not written again, and downstream stages read them from storage
+    """
+    def __init__(self, name, func, inputs=(), outputs=None, params=None, files=(), after=(), cache=True, code=(),
+                 stores=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = dict(outputs or {})
+        self.params = dict(params or {})
+        self.files = list(files)
+        self.after = list(after)
+        self.cache = cache
+        self.code = list(code)
+        self.stores = stores
+
+    def code_version(self):
+        """
+        Hash of the source code of the module defining func, and of the modules in code.
+        """
+        h = hashlib.sha1()
+        for module in [self.func.__module__] + self.code:
+            h.update(inspect.getsource(sys.modules[module]).encode('utf-8'))
+        return h.hexdigest()
+
+
+def file_hash(path, memo):
+    """
+    Content hash of a file or of all files under a directory.
+
+    The hash of a file is reused from memo while its size and modification time are unchanged.
+
+    params: path: string
+    params: memo: dict, path -> [size, mtime_ns, hash]
+    return: string
+    """
+    if os.path.isdir(path):
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                h.update(os.path.relpath(filepath, path).encode('utf-8'))
+                h.update(file_hash(filepath, memo).encode('utf-8'))
+        return h.hexdigest()
+    if not os.path.isfile(path):
+        return 'missing'
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if key in memo and memo[key][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return memo[key][2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    memo[key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return memo[key][2]
+
+
+class Pipeline(object):
+    """
+    Run stages in dependency order within one process.
+
+    params: stages: list of Stage
+    params: cachePath: string, the json file recording stage fingerprints and file hashes
+    params: workers: int, the maximum number of stages running concurrently
+    """
+    def __init__(self, stages, cachePath='../input/dag_cache.json', workers=4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cachePath = cachePath
+        self.workers = workers
+        self.producer = {name: stage.name for stage in stages for name in stage.outputs}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.producer:
+                    raise ValueError('Stage {}: no stage produces {}'.format(stage.name, name))
+
+    def _dependencies(self, stage):
+        deps = {self.producer[name] for name in stage.inputs if name in self.producer}
+        return deps | {name for name in stage.after if name in self.stages}
+
+    def _load_cache(self):
+        if os.path.isfile(self.cachePath):
+            with open(self.cachePath) as f:
+                return json.load(f)
+        return {'stages': dict(), 'files': dict()}
+
+    def _save_cache(self, cache):
+        directory = os.path.dirname(self.cachePath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.cachePath + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(self.cachePath + '.tmp', self.cachePath)
+
+    def fingerprint(self, stage, fingerprints, memo):
+        """
+        Fingerprint of a stage, given the fingerprints of its upstream stages.
+        """
+        h = hashlib.sha1()
+        h.update(stage.name.encode('utf-8'))
+        h.update(stage.code_version().encode('utf-8'))
+        h.update(json.dumps(stage.params, sort_keys=True, default=str).encode('utf-8'))
+        for name in stage.inputs:
+            h.update('{}:{}'.format(name, fingerprints[self.producer[name]]).encode('utf-8'))
+        for path in stage.files:
+            h.update('{}:{}'.format(path, file_hash(path, memo)).encode('utf-8'))
+        return h.hexdigest()
+
+    def run(self):
+        """
+        Run the pipeline.
+
+        return: dict, stage name -> 'run', 'cached' or 'failed'
+        """
+        cache = self._load_cache()
+        memo = cache['files']
+        fingerprints = dict()
+        frames = dict()
+        consumers = {name: sum(name in stage.inputs for stage in self.stages.values()) for name in self.producer}
+        status = dict()
+        memory = dict()
+
+        def get_frame(name):
+            if name not in frames:
+                frames[name] = read_frame(self.stages[self.producer[name]].outputs[name])
+            return frames[name]
+
+        def execute(stage, parent):
+            s = time.time()
+            with span(stage.name, parent=parent, stage=True) as sp:
+                inputs = [get_frame(name) for name in stage.inputs]
+                result = stage.func(*inputs, **stage.params)
+                if len(stage.outputs) == 1:
+                    result = (result,)
+                report = {'inputs': {name: memory_usage(df) for name, df in zip(stage.inputs, inputs)}, 'outputs': dict()}
+                for (name, path), df in zip(stage.outputs.items(), result or ()):
+                    if stage.stores:
+                        # the rows stored by the stage, the whole output is read by get_frame()
+                        report['outputs'][name] = {'rows': len(df), 'bytes': 0, 'returned_bytes': memory_usage(df)}
+                        continue
+                    # downstream stages get the same types in memory as from storage
+                    frames[name] = memory_schema(apply_schema(df))
+                    write_frame(frames[name], path)
+                    report['outputs'][name] = {'rows': len(df), 'bytes': memory_usage(frames[name]),
+                                               'returned_bytes': memory_usage(df)}
+                sp.set(rows_in=sum(len(df) for df in inputs),
+                       rows_out=sum(output['rows'] for output in report['outputs'].values()))
+            memory[stage.name] = report
+            print('[{}] done in {:.2f} secs'.format(stage.name, time.time() - s))
+
+        pending = set(self.stages)
+        running = dict()
+        with span('pipeline', profile=False, stages=len(self.stages)), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                ready = [name for name in sorted(pending) if self._dependencies(self.stages[name]) <= set(status)]
+                if not ready and not running:
+                    raise ValueError('Cyclic dependencies among stages: {}'.format(sorted(pending)))
+                for name in ready:
+                    stage = self.stages[name]
+                    pending.discard(name)
+                    if any(status[dep] == 'failed' for dep in self._dependencies(stage)):
+                        status[name] = 'failed'
+                        print('[{}] skipped, upstream failed'.format(name))
+                        continue
+
+                    fingerprints[name] = self.fingerprint(stage, fingerprints, memo)
+                    record = cache['stages'].get(name, dict())
+                    if (stage.cache and record.get('fingerprint') == fingerprints[name]
+                            and all(frame_exists(path) for path in stage.outputs.values())):
+                        status[name] = 'cached'
+                        print('[{}] up to date'.format(name))
+                        continue
+                    running[executor.submit(execute, stage, current())] = name
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        status[name] = 'failed'
+                        print('[{}] failed:\n{}'.format(name, format_error(future.exception())))
+                        continue
+                    status[name] = 'run'
+                    cache['stages'][name] = {'fingerprint': fingerprints[name], 'outputs': self.stages[name].outputs}
+                    self._save_cache(cache)
+
+                    # release the frames which no pending stage reads
+                    for input_name in self.stages[name].inputs:
+                        consumers[input_name] = consumers.get(input_name, 1) - 1
+                        if consumers[input_name] <= 0:
+                            frames.pop(input_name, None)
+
+        self._save_cache(cache)
+        if memory:
+            self._save_memory_report(memory)
+        return status
+
+    def _save_memory_report(self, memory):
+        """
+        Print the memory of the frames of each stage run, and save it next to the cache.
+
+        params: memory: dict, stage name -> {'inputs': {name: bytes}, 'outputs': {name: {rows, bytes, returned_bytes}}}
+        """
+        print('Memory per stage (MB): inputs / outputs as returned -> as kept')
+        for name in sorted(memory):
+            report = memory[name]
+            outputs = report['outputs'].values()
+            print('  {:<28} {:>9.1f} / {:>9.1f} -> {:>9.1f}'.format(
+                name, sum(report['inputs'].values()) / 2**20,
+                sum(output['returned_bytes'] for output in outputs) / 2**20,
+                sum(output['bytes'] for output in outputs) / 2**20))
+        path = os.path.join(os.path.dirname(self.cachePath), 'memory_report.json')
+        with open(path, 'w') as f:
+            json.dump(memory, f, indent=1, sort_keys=True)
+
+
+def format_error(error):
+    """
+    Return the traceback of an exception, with the traceback of the worker process it was raised in, if any.
+    """
+    return ''.join(traceback.format_exception(error)).rstrip()
+
+
+def failed(status):
+    """
+    Return the stages or cities which failed in the status of Pipeline.run() or run_cities().
+
+    params: status: dict, name -> 'run', 'cached' or 'failed', or the nested status of a city
+    return: list of string, e.g. ['london/label_live_PM2.5', 'beijing']
+    """
+    names = []
+    for name, value in status.items():
+        if value == 'failed':
+            names.append(name)
+        elif isinstance(value, dict) and 'failed' in value:
+            # a city whose whole pipeline raised, see run_cities()
+            names.append(name)
+        elif isinstance(value, dict):
+            names.extend('{}/{}'.format(name, inner) for inner in failed(value))
+    return names
+
+
+def _run_city(function, city, args):
+    """
+    Run the pipeline of a city in a worker process, with the city's own station dictionary and trace file.
+    """
+    os.environ['STATION_DICTIONARY'] = get_city(city).stationDictionary
+    from_environment(suffix=city)
+    return function(city, *args)
+
+
+def run_cities(function, cities, args=(), workers=None):
+    """
+    Run a pipeline per city, in worker processes when there are several cities.
+
+    params: function: callable, function(city, *args) builds and runs the pipeline of a city and returns
+                      its status, defined at module level so that worker processes can import it
+    params: cities: list of string
+    params: args: tuple, the other arguments of function
+    params: workers: int, the maximum number of processes, default: one per city up to the number of CPUs
+    return: dict, city -> the status returned, or {'failed': error} if the city failed
+    """
+    workers = workers or min(len(cities), os.cpu_count() or 1)
+    results = dict()
+    if len(cities) == 1 or workers == 1:
+        for city in cities:
+            os.environ['STATION_DICTIONARY'] = get_city(city).stationDictionary
+            results[city] = function(city, *args)
+        return results
+
+    # spawned workers start clean, without the threads and locks of this process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {city: executor.submit(_run_city, function, city, args) for city in cities}
+        for city, future in futures.items():
+            try:
+                results[city] = future.result()
+            except Exception as e:
+                print('[{}] failed:\n{}'.format(city, format_error(e)))
+                results[city] = {'failed': repr(e)}
+    return results
@@ -9,10 +9,36 @@ Live air quality and grid weather data integration:
 1. Concatenate the live day-by-day data into one file.
 2. Merge air data with station latitude and longitude information.
 
-Output:
-historical air quality data as ../input/london/london_aq_hist_data_merged.csv.gz
-live air quality data as ../input/london/london_aq_live_data_merged.csv.gz
-live grid weather data as ../input/london/london_grid_live_data_merged.csv.gz
+The raw files and stations of each city are configured in cities.py.
+
+Output (saved by storage.write_frame, see storage.py for formats):
+historical air quality data as ../input/{city}/{city}_aq_hist_data_merged
+live air quality data as ../input/{city}/{city}_aq_live_data_merged
+live grid weather data as ../input/{city}/{city}_grid_live_data_merged
+
+Missing values are filled with 0, and the values read are recorded in a validity bitmap column
+(see validity.py), so that a missing reading is told apart from a real zero.
+
+The live data is integrated incrementally: a (station_id, utc_time) key index saved next
+to each live output (see key_index.py) records its rows and the daily files already read.
+Only new or changed daily files are read, and their rows are deduplicated against the index
+and appended, so the cost of a run depends on the new rows: only the stored rows of the keys
+read again are compared, and a run returns the rows it added or changed, not the whole output.
+A row whose key is already stored is a conflict when its values differ, e.g. a day downloaded again with revised values,
+resolved by DUPLICATE_POLICY:
+    last (default): the newer values replace the stored ones
+    first:          the stored values are kept
+    error:          raise ValueError
+Rows are only added, never removed. The index is rebuilt from all files when it does not match
+the output or the configuration (stations, columns, policy) changes.
+
+The live daily files can be folded into a raw store partitioned by data type and month
+({rawPath}/{city}/store, see raw_store.py), from which the in-memory integration and other
+readers (read_live) read a time range and stations, touching only the partitions which overlap them:
+    python3 -u ./data_integration.py compact
+
+Usage:
+    python3 -u ./data_integration.py [london|beijing] [compact]
 
 @author: Stephen
 """
@@ -20,97 +46,412 @@ live grid weather data as ../input/london/london_grid_live_data_merged.csv.gz
 import pandas as pd
 import numpy as np
 import os
+import sys
 import time
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from storage import read_rows, frame_rows, write_frame, frame_exists, append_frame, update_column, compact_mode, encode_stations
+from key_index import KeyIndex
+from raw_store import RawStore, file_fingerprint
+from tracing import traced, span, current, enabled
+from cities import LONDON, get_city, city_arguments, station_coordinates
+from validity import VALIDITY, add_validity
 
-def read_multiple_csv(path, col = None, parse_dates = None):
+# Schemas of the live daily files: (raw column, column, dtype), in output order.
+# Raw columns not listed (id, weather, the measurements a city does not keep) are skipped by the parser.
+LIVE_AQ_COLUMNS = {'PM2.5': 'PM25_Concentration', 'PM10': 'PM10_Concentration', 'NO2': 'NO2_Concentration',
+                   'CO': 'CO_Concentration', 'O3': 'O3_Concentration', 'SO2': 'SO2_Concentration'}
 
-    # glob(path+'/*'): return a list, which consist of each files in path
-    # tqdm is a package which shows the progressive bar on Pythton CLI
-    if parse_dates == None:
-        if col is None:
-            df = pd.concat([pd.read_csv(f) for f in sorted(glob(path+'/*'))])
-        else:
-            df = pd.concat([pd.read_csv(f)[col] for f in sorted(glob(path+'/*'))])
-    else:
-        if col is None:
-            df = pd.concat([pd.read_csv(f, parse_dates = ['date'] ) for f in sorted(glob(path+'/*'))])
+
+def live_aq_schema(measurements):
+    """
+    Return the schema of the live air quality files for some measurements.
+
+    params: measurements: list of string, e.g. ['PM2.5', 'PM10', 'NO2']
+    return: list of (raw column, column, dtype)
+    """
+    return ([('station_id', 'station_id', object), ('time', 'utc_time', 'datetime64[ns]')]
+            + [(LIVE_AQ_COLUMNS[name], name, np.float64) for name in measurements])
+
+
+LIVE_AQ_SCHEMA = live_aq_schema(LONDON.measurements)
+LIVE_GRID_SCHEMA = [('station_id', 'station_id', object), ('time', 'utc_time', 'datetime64[ns]'),
+                    ('temperature', 'temperature', np.float64), ('pressure', 'pressure', np.float64),
+                    ('humidity', 'humidity', np.float64), ('wind_direction', 'wind_direction', np.float64),
+                    ('wind_speed', 'wind_speed', np.float64)]
+
+
+def compact_schema(schema):
+    """
+    Return the schema with float32 values in compact mode.
+
+    params: schema: list of (raw column, column, dtype)
+    return: list of (raw column, column, dtype)
+    """
+    if not compact_mode():
+        return schema
+    return [(raw, name, np.float32 if dtype == np.float64 else dtype) for raw, name, dtype in schema]
+
+
+def read_csv_columns(filepath, schema):
+    """
+    Parse the schema columns of a CSV file.
+
+    params: filepath: string
+    params: schema: list of (raw column, column, dtype)
+    return: list of numpy array, in the order of schema
+    """
+    schema = compact_schema(schema)
+    dtypes = {raw: dtype for raw, name, dtype in schema if dtype != 'datetime64[ns]'}
+    df = pd.read_csv(filepath, usecols=[raw for raw, name, dtype in schema], dtype=dtypes)
+    columns = list()
+    for raw, name, dtype in schema:
+        values = pd.to_datetime(df[raw]) if dtype == 'datetime64[ns]' else df[raw]
+        columns.append(np.asarray(values.values, dtype=dtype))
+    return columns
+
+
+@traced()
+def read_multiple_csv(path, schema=None, workers=None):
+    """
+    Read and concatenate all CSV files in a directory, in the order of file names.
+
+    The files are parsed concurrently (pandas parses without holding the GIL).
+    With a schema, only its columns are parsed, with fixed dtypes, into buffers
+    allocated once for all files. Without a schema, dtypes are inferred per file.
+
+    params: path: string, the directory, or a list of files
+    params: schema: list of (raw column, column, dtype), e.g. LIVE_AQ_SCHEMA
+    params: workers: int, the number of files parsed at once, default: ThreadPoolExecutor's
+    return: DataFrame
+    """
+    files = list(path) if isinstance(path, list) else sorted(glob(path+'/*.csv'))
+    if enabled():
+        current().add(bytes_read=sum(os.path.getsize(f) for f in files)).set(files=len(files))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if schema is None:
+            frames = list(executor.map(pd.read_csv, files))
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        parts = list(executor.map(lambda f: read_csv_columns(f, schema), files))
+
+    schema = compact_schema(schema)
+    rows = sum(len(part[0]) for part in parts)
+    buffers = [np.empty(rows, dtype=dtype) for raw, name, dtype in schema]
+    offset = 0
+    for part in parts:
+        for buffer, values in zip(buffers, part):
+            buffer[offset:offset+len(values)] = values
+        offset += len(part[0])
+    df = pd.DataFrame({name: buffer for (raw, name, dtype), buffer in zip(schema, buffers)}, copy=False)
+    if compact_mode() and 'station_id' in df.columns:
+        df['station_id'] = encode_stations(df['station_id'])
+    return df
+
+
+STATIONS = LONDON.stations
+
+
+@traced()
+def integrate_hist_aq(rawPath='../raw_data', city='london'):
+    """
+    Merge the official historical air quality data with station latitude and longitude.
+
+    params: rawPath: string, the root directory of raw data
+    params: city: string, see cities.py
+    return: DataFrame
+    """
+    city = get_city(city)
+
+    # Read official historical data from files
+    frames = list()
+    for filename in city.histFiles:
+        histPath = '{}/{}'.format(rawPath, filename)
+        df = pd.read_csv(histPath, index_col=city.histIndexCol)
+        frames.append(df[list(city.histColumns)].rename(columns=city.histColumns))
+        if enabled():
+            current().add(bytes_read=os.path.getsize(histPath))
+    hist_data = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    # the values read are recorded in the validity bitmap before the missing ones are filled
+    hist_data = add_validity(hist_data).fillna(0).drop_duplicates()
+
+    # Merge latitude and longitude data
+    aq_stations = station_coordinates('{}/{}'.format(rawPath, city.aqStationsFile))
+    hist_data = hist_data.join(aq_stations, on='station_id')
+    hist_data = hist_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude'] + city.measurements + [VALIDITY])
+
+    # sorted, so the rows of each station can be streamed in time order
+    hist_data = hist_data.sort_values(['station_id', 'utc_time'], kind='mergesort')
+    return hist_data
+
+
+KEYS = ['station_id', 'utc_time']
+DUPLICATE_POLICIES = ['last', 'first', 'error']
+
+
+def duplicate_policy(policy=None):
+    """
+    Return the policy of live rows with a key already seen, default: environment variable DUPLICATE_POLICY or 'last'.
+    """
+    policy = policy or os.environ.get('DUPLICATE_POLICY', 'last')
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError('Unknown duplicate policy: {}, options: {}'.format(policy, DUPLICATE_POLICIES))
+    return policy
+
+
+def drop_duplicate_keys(df, policy):
+    """
+    Drop the repeated rows, and resolve the rows with the same key but other values by the policy, in file order.
+
+    params: df: DataFrame, including station_id and utc_time columns
+    params: policy: string, see DUPLICATE_POLICIES
+    return: DataFrame
+    """
+    df = df.drop_duplicates()
+    if policy == 'error':
+        conflicts = df[df.duplicated(KEYS, keep=False)]
+        if len(conflicts):
+            raise ValueError('{} live rows share their station_id and utc_time with other values, e.g.\n{}'.format(
+                len(conflicts), conflicts.head()))
+        return df
+    return df.drop_duplicates(KEYS, keep=policy)
+
+
+def file_fingerprints(files):
+    """
+    Return the size and modification time of files, by file name.
+    """
+    return {os.path.basename(f): file_fingerprint(f) for f in files}
+
+
+def live_schemas(city):
+    """
+    Return the schemas of the live daily files of a city, by data type.
+    """
+    return {'airquality': live_aq_schema(city.measurements), 'grid': LIVE_GRID_SCHEMA}
+
+
+@traced()
+def compact_live(rawPath='../raw_data', city='london', dataTypes=None):
+    """
+    Fold the new or changed live daily files of a city into its raw store ({rawPath}/{city}/store), see raw_store.py.
+
+    params: rawPath: string, the root directory of raw data
+    params: city: string, see cities.py
+    params: dataTypes: list of string, default: ['airquality', 'grid']
+    return: dict, data type -> the number of files folded
+    """
+    city = get_city(city)
+    store = RawStore('{}/{}/store'.format(rawPath, city.name))
+    folded = dict()
+    for dataType, schema in live_schemas(city).items():
+        if dataTypes is None or dataType in dataTypes:
+            files = sorted(glob('{}/{}/{}/*.csv'.format(rawPath, city.name, dataType)))
+            folded[dataType] = store.compact(dataType, files, lambda files, schema=schema: read_multiple_csv(files, schema),
+                                             [name for raw, name, dtype in schema])
+    return folded
+
+
+def read_live(rawPath='../raw_data', city='london', dataType='airquality', start=None, end=None, stations=None, columns=None):
+    """
+    Read live data of a time range and stations from the raw store, reading only the partitions which overlap them.
+
+    The new or changed daily files are folded into the store first.
+
+    params: rawPath: string, the root directory of raw data
+    params: city: string, see cities.py
+    params: dataType: string, options: ['airquality', 'grid']
+    params: start: datetime-like, the first utc_time, None for no lower bound
+    params: end: datetime-like, the last utc_time, None for no upper bound
+    params: stations: list of string, None for all stations
+    params: columns: list of string, default: the columns of the schema
+    return: DataFrame, the rows in the order of the daily files
+    """
+    compact_live(rawPath, city, [dataType])
+    return RawStore('{}/{}/store'.format(rawPath, get_city(city).name)).read(dataType, start, end, stations, columns)
+
+
+def resolve_conflicts(df, positions, outputPath, policy):
+    """
+    Compare rows with the stored rows of their keys, and apply the policy to those with other values.
+
+    Only the stored rows at the positions are read, not the whole output.
+
+    params: df: DataFrame, rows whose keys are stored
+    params: positions: numpy array of int, the positions of their keys in the stored frame
+    params: outputPath: string, the stored frame without extension
+    params: policy: string, see DUPLICATE_POLICIES
+    return: numpy array of bool, the conflicting rows of df
+    """
+    columns = [col for col in df.columns if col not in KEYS]
+    stored = read_rows(outputPath, positions, columns=columns)
+    differ = np.zeros(len(df), dtype=bool)
+    for col in columns:
+        # compared in the stored dtypes, e.g. float32 in compact mode
+        old = stored[col].values
+        new = df[col].values.astype(old.dtype) if old.dtype.kind in 'fiu' else df[col].values
+        differ |= ~((old == new) | (pd.isna(old) & pd.isna(new)))
+    if differ.any() and policy == 'error':
+        raise ValueError('{} live rows differ from the stored rows of their keys, e.g.\n{}'.format(
+            differ.sum(), df[differ].head()))
+    if differ.any() and policy == 'last':
+        for col in columns:
+            update_column(outputPath, col, positions[differ], df[col].values[differ])
+    return differ
+
+
+def integrate_live(rawPath, city, dataType, prepare, outputPath=None, config=None, start=None, end=None, stations=None):
+    """
+    Integrate the daily files of a data type, incrementally into a stored frame with its key index.
+
+    Without outputPath, the rows of a time range and stations are read from the raw store (see read_live())
+    and integrated in memory. With outputPath, the new or changed daily files are read, and only the rows
+    they add or change are returned; the whole output is read from storage by its consumers (see dag.Stage).
+
+    params: rawPath: string, the root directory of raw data
+    params: city: City
+    params: dataType: string, options: ['airquality', 'grid']
+    params: prepare: callable, prepare(df) returns the rows of some files to be stored, without duplicate keys
+    params: outputPath: string, the stored frame without extension, None to integrate in memory
+    params: config: dict, the settings of prepare, the output is rebuilt when they change
+    params: start: datetime-like, the first utc_time read in memory, None for no lower bound
+    params: end: datetime-like, the last utc_time read in memory, None for no upper bound
+    params: stations: list of string, the stations read in memory, None for all stations
+    return: DataFrame, the integrated rows in memory, or the rows added or changed in outputPath
+    """
+    if outputPath is None:
+        return prepare(read_live(rawPath, city, dataType, start, end, stations))
+    if start is not None or end is not None:
+        raise ValueError('A time range is only read in memory, without outputPath')
+
+    files = sorted(glob('{}/{}/{}/*.csv'.format(rawPath, city.name, dataType)))
+    schema = live_schemas(city)[dataType]
+    index = KeyIndex.load(outputPath) if frame_exists(outputPath) else None
+    if index is not None and (index.config != config or index.rows != frame_rows(outputPath)):
+        index = None
+    fingerprints = file_fingerprints(files)
+    files = [f for f in files if index is None or index.files.get(os.path.basename(f)) != fingerprints[os.path.basename(f)]]
+    if index is not None and not files:
+        return read_rows(outputPath, np.empty(0, dtype=np.int64))
+
+    with span('integrate_live', path=outputPath, files=len(files), rebuild=index is None) as sp:
+        df = prepare(read_multiple_csv(files, schema))
+        if index is None:
+            KeyIndex.remove(outputPath)
+            index = KeyIndex(config=config)
+            write_frame(df, outputPath)
+            index.add(df)
         else:
-            df = pd.concat([pd.read_csv(f, parse_dates = ['date'] )[col] for f in sorted(glob(path+'/*'))])
+            positions = index.lookup(df)
+            stored = positions >= 0
+            differ = resolve_conflicts(df[stored], positions[stored], outputPath, config['policy'])
+            sp.set(conflicts=int(differ.sum()))
+            if not stored.all():
+                append_frame(df[~stored], outputPath)
+                index.add(df[~stored])
+            sp.set(rows_in=len(df), rows_out=int((~stored).sum()))
+            # the stored values of the conflicts are only changed by the policy 'last'
+            changed = df[stored][differ] if config['policy'] == 'last' else df.iloc[:0]
+            df = pd.concat([changed, df[~stored]], axis=0)
+        index.files.update({os.path.basename(f): fingerprints[os.path.basename(f)] for f in files})
+        index.save(outputPath)
     return df
 
 
+@traced()
+def integrate_live_aq(rawPath='../raw_data', stations=None, city='london', outputPath=None, policy=None, start=None, end=None):
+    """
+    Concatenate the live air quality data and merge it with station latitude and longitude.
+
+    params: rawPath: string, the root directory of raw data
+    params: stations: list of string, the stations to be predicted, default: the stations of the city
+    params: city: string, see cities.py
+    params: outputPath: string, integrate the new files into this stored frame, see integrate_live()
+    params: policy: string, the duplicate policy, default: duplicate_policy()
+    params: start: datetime-like, the first utc_time, without outputPath only
+    params: end: datetime-like, the last utc_time, without outputPath only
+    return: DataFrame, sorted by station_id and utc_time within the files of a run,
+            only the rows added or changed with outputPath
+    """
+    city = get_city(city)
+    stations = list(city.stations if stations is None else stations)
+    policy = duplicate_policy(policy)
+    aq_stations = station_coordinates('{}/{}'.format(rawPath, city.aqStationsFile))
+
+    def prepare(live_aq_data):
+        live_aq_data = live_aq_data.reindex(columns=['utc_time', 'station_id'] + city.measurements)
+        live_aq_data = drop_duplicate_keys(add_validity(live_aq_data).fillna(0), policy)
+
+        # Merge latitude and longitude data
+        live_aq_data = live_aq_data.join(aq_stations, on='station_id')
+        live_aq_data = live_aq_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude'] + city.measurements + [VALIDITY])
+
+        # Filter out the data which stations aren't required for predictions
+        live_aq_data = live_aq_data.loc[live_aq_data['station_id'].isin(stations)]
+        return live_aq_data.sort_values(['station_id', 'utc_time'])
+
+    return integrate_live(rawPath, city, 'airquality', prepare, outputPath,
+                          {'stations': stations, 'measurements': city.measurements, 'policy': policy,
+                           'compact': compact_mode(), 'validity': VALIDITY}, start, end, stations)
+
+
+@traced()
+def integrate_live_grid(rawPath='../raw_data', city='london', outputPath=None, policy=None, start=None, end=None):
+    """
+    Concatenate the live grid weather data and merge it with grid latitude and longitude.
+
+    params: rawPath: string, the root directory of raw data
+    params: city: string, see cities.py
+    params: outputPath: string, integrate the new files into this stored frame, see integrate_live()
+    params: policy: string, the duplicate policy, default: duplicate_policy()
+    params: start: datetime-like, the first utc_time, without outputPath only
+    params: end: datetime-like, the last utc_time, without outputPath only
+    return: DataFrame, only the rows added or changed with outputPath
+    """
+    city = get_city(city)
+    policy = duplicate_policy(policy)
+    grid_stations_data = station_coordinates('{}/{}'.format(rawPath, city.gridStationsFile), city.gridStationsHeader)
+
+    def prepare(live_grid_data):
+        live_grid_data = drop_duplicate_keys(add_validity(live_grid_data).fillna(0), policy)
+
+        # Add longitude data and latitude data to live meo data
+        live_grid_data = live_grid_data.join(grid_stations_data, on='station_id')
+        return live_grid_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude', 'temperature', 'pressure', 'humidity', 'wind_direction', 'wind_speed', VALIDITY])
+
+    return integrate_live(rawPath, city, 'grid', prepare, outputPath, {'policy': policy, 'compact': compact_mode(), 'validity': VALIDITY},
+                          start, end)
+
+
 if __name__ == '__main__':
 
-    stations = ['BL0', 'CD9', 'CD1', 'GN0', 'GR4', 'GN3', 'GR9', 'HV1', 'KF1', 'LW2', 'ST5', 'TH4', 'MY7']
+    for city in map(get_city, city_arguments()):
+        # Initialize a directory
+        if not os.path.isdir(city.inputPath):
+            os.makedirs(city.inputPath)
 
-    # Initialize a directory
-    path = '../input/london'
-    if not os.path.isdir(path):
-        os.makedirs(path)
+        start = time.time()
+        if 'compact' in sys.argv:
+            folded = compact_live(city=city.name)
+            print('{} daily files folded into the raw store: {}'.format(city.name.title(), folded))
+            continue
 
-        
-    start = time.time()
-    ###############################
-    # Historical Air Quality Data #
-    ###############################
-    if not os.path.isfile('../input/ld/london_aq_hist_data_merged.csv.gz'):
+        ###############################
+        # Historical Air Quality Data #
+        ###############################
+        if not frame_exists(city.frame('aq_hist_data_merged')):
+            write_frame(integrate_hist_aq(city=city.name), city.frame('aq_hist_data_merged'))
 
-        # Read official historical data from file
-        hist_data = pd.read_csv('../raw_data/London_historical_aqi_forecast_stations_20180331.csv', index_col=0)
-        hist_data.columns = ['utc_time', 'station_id', 'PM2.5', 'PM10', 'NO2']
-        hist_data = hist_data.fillna(0).drop_duplicates()
+        #########################
+        # Live Air Quality Data #
+        #########################
+        integrate_live_aq(city=city.name, outputPath=city.frame('aq_live_data_merged'))
+        print('{} Air Quality Data: Done.'.format(city.name.title()))
 
-        # Merge latitude and longitude data
-        aq_stations = pd.read_csv('../raw_data/London_AirQuality_Stations.csv', index_col=0)
-        hist_data = hist_data.join(aq_stations[['Latitude', 'Longitude']], on='station_id')
-        hist_data = hist_data.rename(columns={'Latitude': 'latitude', 'Longitude': 'longitude'})
-        hist_data = hist_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude', 'PM2.5', 'PM10', 'NO2'])
-
-        # Save the file
-        hist_data.to_csv('../input/london/london_aq_hist_data_merged.csv.gz', index=False, compression='gzip')
-
-    #########################
-    # Live Air Quality Data #
-    #########################
-    # Read live data
-    live_aq_data = read_multiple_csv('../raw_data/london/airquality')
-    live_aq_data = live_aq_data.drop(['id', 'CO_Concentration', 'O3_Concentration', 'SO2_Concentration'], axis=1)
-    live_aq_data.columns = ['station_id', 'utc_time', 'PM2.5', 'PM10', 'NO2']
-    live_aq_data = live_aq_data.reindex(columns=['utc_time', 'station_id', 'PM2.5', 'PM10', 'NO2'])
-    live_aq_data = live_aq_data.fillna(0).drop_duplicates()
+        ##########################
+        # Live Grid Weather Data #
+        ##########################
+        integrate_live_grid(city=city.name, outputPath=city.frame('grid_live_data_merged'))
+        print('{} Grid Weather Data: Done.'.format(city.name.title()))
 
-    # Merge latitude and longitude data
-    aq_stations = pd.read_csv('../raw_data/London_AirQuality_Stations.csv', index_col=0)
-    live_aq_data = live_aq_data.join(aq_stations[['Latitude', 'Longitude']], on='station_id')
-    live_aq_data = live_aq_data.rename(columns={'Latitude': 'latitude', 'Longitude': 'longitude'})
-    live_aq_data = live_aq_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude' , 'PM2.5', 'PM10', 'NO2'])
-
-    # Filter out the data which stations aren't required for predictions
-    live_aq_data = live_aq_data.loc[live_aq_data['station_id'].isin(stations)]
-    live_aq_data.sort_values(['station_id', 'utc_time'], inplace=True)
-
-    live_aq_data.to_csv('../input/london/london_aq_live_data_merged.csv.gz', index=False, compression='gzip')
-    del live_aq_data
-    print('London Air Quality Data: Done.')
-
-    ##########################
-    # Live Grid Weather Data #
-    ##########################
-    # Read grid weather data
-    live_grid_data = read_multiple_csv('../raw_data/london/grid')
-    live_grid_data = live_grid_data.drop(['id', 'weather'], axis=1)
-    live_grid_data.columns = ['station_id', 'utc_time', 'temperature', 'pressure', 'humidity', 'wind_direction', 'wind_speed']
-    live_grid_data = live_grid_data.fillna(0).drop_duplicates()
-
-    # Add longitude data and latitude data to live meo data
-    grid_stations_data = pd.read_csv('../raw_data/London_grid_weather_station.csv', index_col=0)
-    live_grid_data = live_grid_data.join(grid_stations_data, on='station_id')
-    live_grid_data = live_grid_data.reindex(columns=['station_id', 'utc_time', 'longitude', 'latitude', 'temperature', 'pressure', 'humidity', 'wind_direction', 'wind_speed'])
-
-    live_grid_data.to_csv('../input/london/london_grid_live_data_merged.csv.gz', index=False, compression='gzip')
-    del live_grid_data
-    print('London Grid Weather Data: Done.')
-    
-    end = time.time()
-    print('Data Integration Time: {:.2f} secs'.format(end-start))
+        end = time.time()
+        print('Data Integration Time: {:.2f} secs'.format(end-start))
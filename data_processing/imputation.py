@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Spatio-temporal imputation of the missing air quality values, for all stations and hours at once.
+
+The observed values (by the validity bitmap, see validity.py) are laid on a station x hour panel,
+and each missing value of a row is filled:
+    1. by linear interpolation in time between the observations of its station around it,
+       when they are at most MAX_GAP_HOURS apart from each other
+    2. else, by the inverse distance weighted mean of the observations of the nearest stations
+       at the same hour (NEIGHBOURS stations, weights 1 / distance ** POWER), renormalized over
+       the neighbours observed at that hour
+    3. else it stays missing
+Both steps are array operations over the whole panel: the previous and next observation of every
+(station, hour) come from running maxima and minima of their positions, and the neighbour means of all hours
+from one matrix product.
+
+The filled values are valid in the validity bitmap, and marked in the imputed bitmap,
+so labels are still created from the observations only.
+
+Imputation is a pipeline stage between integration and labeling, enabled by IMPUTE=1 (see pipeline.py),
+or run on the merged data of the cities named in the arguments:
+    python3 -u ./imputation.py [london|beijing]
+
+@author: Stephen
+"""
+
+import os
+import time
+import numpy as np
+import pandas as pd
+from storage import read_frame, write_frame
+from panel import Panel
+from tracing import traced
+from cities import get_city, city_arguments, haversine
+from validity import VALIDITY, IMPUTED, MASKED, BITMAP_DTYPE, validity_bits, valid_mask, with_missing
+
+MAX_GAP_HOURS = 6
+NEIGHBOURS = 4
+POWER = 2
+
+
+def imputation():
+    """
+    Return True when the imputation stages run, set by IMPUTE=1.
+    """
+    return os.environ.get('IMPUTE', '0') == '1'
+
+
+def neighbour_weights(df, stations, neighbours=NEIGHBOURS, power=POWER):
+    """
+    Return the inverse distance weights of the nearest other stations.
+
+    params: df: DataFrame, including station_id, longitude and latitude columns
+    params: stations: list of string, the station axis
+    params: neighbours: int
+    params: power: float
+    return: numpy array in shape of (stations, stations), zero on the diagonal, for the stations without
+            coordinates, and beyond the nearest neighbours
+    """
+    coordinates = df.groupby(df['station_id'].astype(object))[['latitude', 'longitude']].first()
+    coordinates = coordinates.reindex(stations).values.astype(np.float64)
+    distance = haversine(coordinates[:, None, 0], coordinates[:, None, 1], coordinates[None, :, 0], coordinates[None, :, 1])
+    distance[np.arange(len(stations)), np.arange(len(stations))] = np.inf
+    distance[np.isnan(distance)] = np.inf
+
+    weights = np.zeros_like(distance)
+    nearest = np.argsort(distance, axis=1, kind='mergesort')[:, :neighbours]
+    nearestDistance = np.take_along_axis(distance, nearest, axis=1)
+    # stations at the same place (within 1 m) take almost all the weight
+    np.put_along_axis(weights, nearest, np.where(np.isfinite(nearestDistance),
+                                                 1.0 / np.maximum(nearestDistance, 1e-3) ** power, 0.0), axis=1)
+    return weights
+
+
+def impute_panel(values, mask, weights, maxGap=MAX_GAP_HOURS):
+    """
+    Fill the missing values of one variable of a panel.
+
+    params: values: numpy array in shape of (stations, times)
+    params: mask: bool numpy array in shape of (stations, times), True where observed
+    params: weights: numpy array in shape of (stations, stations), see neighbour_weights()
+    params: maxGap: int, the longest gap in hours filled in time
+    return: numpy array of float64 in shape of (stations, times), NaN where not filled
+    """
+    values = np.where(mask, values, 0.0).astype(np.float64)
+    hours = values.shape[1]
+    position = np.arange(hours)
+    # the previous and next observation of each (station, hour)
+    before = np.maximum.accumulate(np.where(mask, position, -1), axis=1)
+    after = np.minimum.accumulate(np.where(mask, position, hours)[:, ::-1], axis=1)[:, ::-1]
+    inner = ~mask & (before >= 0) & (after < hours) & (after - before <= maxGap + 1)
+    lo, hi = np.clip(before, 0, hours - 1), np.clip(after, 0, hours - 1)
+    low, high = np.take_along_axis(values, lo, axis=1), np.take_along_axis(values, hi, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        temporal = low + (high - low) * (position - before) / (after - before)
+        spatial = (weights @ values) / (weights @ mask.astype(np.float64))
+    return np.where(mask, values, np.where(inner, temporal, spatial))
+
+
+@traced()
+def impute(df, columns=None, maxGap=MAX_GAP_HOURS, neighbours=NEIGHBOURS, power=POWER):
+    """
+    Fill the missing values of the rows, in time and else from the neighbouring stations.
+
+    params: df: DataFrame, merged air quality data, including station_id, utc_time, longitude and latitude columns
+    params: columns: list of string, default: the masked columns of df
+    params: maxGap: int, the longest gap in hours filled in time
+    params: neighbours: int, the number of nearest stations averaged
+    params: power: float, weights are 1 / distance ** power
+    return: DataFrame, the rows of df with the values filled, and the imputed bitmap
+    """
+    columns = [col for col in MASKED if col in df.columns] if columns is None else list(columns)
+    if VALIDITY not in df.columns:
+        df = df.assign(**{VALIDITY: validity_bits(df, columns)})
+    panel = Panel.from_frame(with_missing(df, columns, observed=True), columns)
+    stationIndex, timeIndex = panel.locate(df)
+    inside = (stationIndex >= 0) & (timeIndex >= 0)
+    weights = neighbour_weights(df, panel.stations, neighbours, power)
+
+    # the rows without a bitmap take the bits of their non-null values
+    bits = df[VALIDITY].values
+    validity = np.where(pd.notna(bits), bits, validity_bits(df, columns)).astype(BITMAP_DTYPE)
+    imputed = df[IMPUTED].values.astype(BITMAP_DTYPE) if IMPUTED in df.columns else np.zeros(len(df), dtype=BITMAP_DTYPE)
+    filled = dict()
+    for col in columns:
+        values = impute_panel(panel.values[col], panel.mask[col], weights, maxGap)
+        result = np.full(len(df), np.nan)
+        result[inside] = values[stationIndex[inside], timeIndex[inside]]
+        new = ~valid_mask(df, col, observed=True) & ~np.isnan(result)
+        filled[col] = np.where(new, result, df[col].values).astype(df[col].dtype)
+        bit = BITMAP_DTYPE(1 << MASKED.index(col))
+        validity = np.where(new, validity | bit, validity)
+        imputed = np.where(new, imputed | bit, imputed)
+    filled.update({VALIDITY: validity.astype(BITMAP_DTYPE), IMPUTED: imputed.astype(BITMAP_DTYPE)})
+    return df.assign(**filled)
+
+
+if __name__ == '__main__':
+
+    for city in map(get_city, city_arguments()):
+        for kind in ['hist', 'live']:
+            s = time.time()
+            df = impute(read_frame(city.frame('aq_{}_data_merged'.format(kind))), city.measurements)
+            write_frame(df, city.frame('aq_{}_data_imputed'.format(kind)))
+            counts = {col: int(((df[IMPUTED].values >> MASKED.index(col)) & 1).sum()) for col in city.measurements}
+            print('{} {} data imputed: {} ({:.2f} secs)'.format(city.name.title(), kind, counts, time.time() - s))
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Persistent (station_id, utc_time) key index of a stored frame.
+
+A key is one int64: the station number << 32 | the seconds since 1970-01-01.
+Station numbers are given in order of first appearance and never change, so the
+keys stay valid when new stations come.
+
+The index is a list of segments, each a sorted array of keys with the positions
+of their rows in the stored frame. Adding keys writes one more segment, so the cost
+depends on the new keys only; the segments are merged into one once there are
+more than MAX_SEGMENTS. A lookup searches each segment by bisection.
+
+The index also records the raw files already integrated (size and modification time)
+and the configuration it was built with.
+
+Saved as a directory '{path}.keys' next to the stored frame:
+    index.json: stations, segments, rows, files, config
+    {i}.keys.npy, {i}.positions.npy: the segments
+
+@author: Stephen
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+MAX_SEGMENTS = 16
+SECONDS = 2 ** 32
+
+
+class KeyIndex(object):
+    """
+    Row positions of the (station_id, utc_time) keys of a stored frame.
+
+    params: stations: list of string, numbered by their position
+    params: segments: list of (keys, positions): sorted numpy arrays of int64
+    params: rows: int, the number of rows of the stored frame
+    params: files: dict, file name -> [size, mtime_ns], the raw files integrated
+    params: config: dict, the configuration the rows were integrated with
+    """
+    def __init__(self, stations=(), segments=(), rows=0, files=None, config=None):
+        self.stations = list(stations)
+        self.segments = list(segments)
+        self.rows = rows
+        self.files = dict(files or {})
+        self.config = config
+        self.saved = len(self.segments)
+
+    def __len__(self):
+        return sum(len(keys) for keys, positions in self.segments)
+
+    def keys(self, df, add=False):
+        """
+        Return the int64 keys of the rows of a frame.
+
+        params: df: DataFrame, including station_id and utc_time columns
+        params: add: bool, give numbers to the stations not known yet, else their keys are -1
+        return: numpy array of int64
+        """
+        values = df['station_id']
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories, codes = values.cat.categories, values.cat.codes.values
+        else:
+            codes, categories = pd.factorize(values)
+        number = {station: i for i, station in enumerate(self.stations)}
+        if add:
+            for station in categories:
+                if station not in number:
+                    number[station] = len(self.stations)
+                    self.stations.append(station)
+        stationNumber = np.array([number.get(station, -1) for station in categories] + [-1], dtype=np.int64)[codes]
+
+        seconds = df['utc_time'].values.astype('datetime64[s]').astype(np.int64)
+        if len(seconds) and (seconds.min() < 0 or seconds.max() >= SECONDS):
+            raise ValueError('utc_time out of the range of the key index')
+        return np.where(stationNumber >= 0, stationNumber * SECONDS + seconds, -1)
+
+    def lookup(self, df):
+        """
+        Return the positions of the rows of a frame in the stored frame.
+
+        params: df: DataFrame, including station_id and utc_time columns
+        return: numpy array of int64, -1 for the keys not in the index
+        """
+        keys = self.keys(df)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        for segmentKeys, positions in self.segments:
+            if len(segmentKeys) == 0:
+                continue
+            i = np.minimum(np.searchsorted(segmentKeys, keys), len(segmentKeys) - 1)
+            found = (segmentKeys[i] == keys) & (keys >= 0)
+            result[found] = positions[i[found]]
+        return result
+
+    def add(self, df):
+        """
+        Add the keys of rows appended to the stored frame, at positions from self.rows.
+
+        params: df: DataFrame, including station_id and utc_time columns, keys not in the index
+        return: None
+        """
+        if len(df) == 0:
+            return
+        keys = self.keys(df, add=True)
+        order = np.argsort(keys, kind='mergesort')
+        self.segments.append((keys[order], self.rows + order.astype(np.int64)))
+        self.rows += len(df)
+        if len(self.segments) > MAX_SEGMENTS:
+            keys = np.concatenate([k for k, p in self.segments])
+            positions = np.concatenate([p for k, p in self.segments])
+            order = np.argsort(keys, kind='mergesort')
+            self.segments = [(keys[order], positions[order])]
+            self.saved = 0
+
+    def save(self, path):
+        """
+        Save the index as '{path}.keys'. Only the segments added since loading are written,
+        unless they were merged.
+
+        params: path: string, the stored frame without extension
+        return: None
+        """
+        directory = final = path + '.keys'
+        if self.saved == 0:
+            # all segments are written again, into a new directory
+            directory = final + '.tmp'
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for i in range(self.saved, len(self.segments)):
+            keys, positions = self.segments[i]
+            np.save(os.path.join(directory, '{}.keys.npy'.format(i)), keys)
+            np.save(os.path.join(directory, '{}.positions.npy'.format(i)), positions)
+        # the metadata last, so an interrupted save leaves the previous index
+        meta = {'stations': self.stations, 'segments': len(self.segments), 'rows': self.rows,
+                'files': self.files, 'config': self.config}
+        with open(os.path.join(directory, 'index.json.tmp'), 'w') as f:
+            json.dump(meta, f, indent=1, default=str)
+        os.replace(os.path.join(directory, 'index.json.tmp'), os.path.join(directory, 'index.json'))
+        if directory != final:
+            if os.path.isdir(final):
+                shutil.rmtree(final)
+            os.replace(directory, final)
+        self.saved = len(self.segments)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the index of a stored frame.
+
+        params: path: string, the stored frame without extension
+        return: KeyIndex, or None if there is none
+        """
+        directory = path + '.keys'
+        if not os.path.isfile(os.path.join(directory, 'index.json')):
+            return None
+        with open(os.path.join(directory, 'index.json')) as f:
+            meta = json.load(f)
+        segments = [(np.load(os.path.join(directory, '{}.keys.npy'.format(i)), mmap_mode='r'),
+                     np.load(os.path.join(directory, '{}.positions.npy'.format(i)), mmap_mode='r'))
+                    for i in range(meta['segments'])]
+        return cls(meta['stations'], segments, meta['rows'], meta['files'], meta['config'])
+
+    @staticmethod
+    def remove(path):
+        """
+        Delete the index of a stored frame, e.g. when the frame is rebuilt.
+        """
+        if os.path.isdir(path + '.keys'):
+            shutil.rmtree(path + '.keys')
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Dense station x hour x variable panel.
+
+A panel holds the values of several variables for every station and every hour
+of a complete hourly time axis. Each variable is one numpy array in shape of
+(stations, hours) in its own dtype, with a boolean mask of the same shape marking
+the observed values, and a boolean array marking the rows of the long format.
+
+Rows of different frames line up by position: a (station, hour) pair is found by
+the station code and the hour offset from the first hour, so no key is hashed.
+Long-format frames (station_id, utc_time, variables...) are converted at the edges.
+
+A panel is saved as a directory '{path}.panel' with one .npy file per variable and mask,
+rows.npy and axes.json, and can be memory-mapped when loaded.
+
+@author: Stephen
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from storage import compact_mode, station_dtype
+from tracing import traced
+
+KEYS = ['station_id', 'utc_time']
+
+
+def station_axis(*frames):
+    """
+    Return the sorted stations of several frames.
+
+    params: frames: DataFrame, including station_id column
+    return: list of string
+    """
+    stations = set()
+    for df in frames:
+        values = df['station_id']
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.values
+            stations |= set(values.cat.categories[np.unique(codes[codes >= 0])])
+        else:
+            stations |= set(values.dropna().unique())
+    return sorted(stations)
+
+
+def time_axis(*frames):
+    """
+    Return the complete hourly axis from the first to the last hour of several frames.
+
+    params: frames: DataFrame, including utc_time column
+    return: DatetimeIndex
+    """
+    times = [df['utc_time'].values.astype('datetime64[h]') for df in frames if len(df)]
+    if not times:
+        return pd.DatetimeIndex([], dtype='datetime64[ns]')
+    first = min(t.min() for t in times).astype('datetime64[ns]')
+    last = max(t.max() for t in times).astype('datetime64[ns]')
+    return pd.date_range(first, last, freq='h')
+
+
+class Panel(object):
+    """
+    Values of variables by station and hour.
+
+    params: stations: list of string, the station axis
+    params: times: DatetimeIndex, the complete hourly axis
+    params: values: dict, variable -> numpy array in shape of (stations, times), in the order of the variable axis
+    params: mask: dict, variable -> bool numpy array in shape of (stations, times), True where a value is observed
+    params: rows: bool numpy array in shape of (stations, times), the rows of the long format
+    """
+    def __init__(self, stations, times, values, mask, rows):
+        self.stations = list(stations)
+        self.times = pd.DatetimeIndex(times)
+        self.values = values
+        self.mask = mask
+        self.rows = rows
+
+    @property
+    def variables(self):
+        return list(self.values)
+
+    @property
+    def shape(self):
+        return len(self.stations), len(self.times), len(self.values)
+
+    def locate(self, df):
+        """
+        Return the positions of the rows of a frame on the station and time axes.
+
+        params: df: DataFrame, including station_id and utc_time columns
+        return: (stationIndex, timeIndex): numpy arrays of int, -1 where the row is outside the axes
+        """
+        stations = pd.Index(self.stations)
+        values = df['station_id']
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # look up the categories only, and take the rows by their codes
+            stationIndex = np.r_[stations.get_indexer(values.cat.categories), -1][values.cat.codes.values]
+        else:
+            stationIndex = stations.get_indexer(values)
+        stationIndex = stationIndex.astype(np.int64)
+
+        if len(self.times) == 0:
+            return stationIndex, np.full(len(df), -1, dtype=np.int64)
+        start = self.times[0].to_datetime64().astype('datetime64[h]')
+        timeIndex = (df['utc_time'].values.astype('datetime64[h]') - start).astype(np.int64)
+        timeIndex[(timeIndex < 0) | (timeIndex >= len(self.times))] = -1
+        return stationIndex, timeIndex
+
+    @classmethod
+    @traced('Panel.from_frame')
+    def from_frame(cls, df, variables=None, stations=None, times=None):
+        """
+        Convert a long-format frame to a panel.
+
+        params: df: DataFrame, including station_id, utc_time and the numeric variables
+        params: variables: list of string, default: all columns but station_id and utc_time
+        params: stations: list of string, default: station_axis(df)
+        params: times: DatetimeIndex, default: time_axis(df)
+        return: Panel, rows outside the axes are left out, and the last of duplicated rows is kept
+        """
+        variables = list(variables) if variables is not None else [col for col in df.columns if col not in KEYS]
+        stations = stations if stations is not None else station_axis(df)
+        times = times if times is not None else time_axis(df)
+        shape = (len(stations), len(times))
+
+        panel = cls(stations, times, dict(), dict(), np.zeros(shape, dtype=bool))
+        stationIndex, timeIndex = panel.locate(df)
+        inside = (stationIndex >= 0) & (timeIndex >= 0)
+        flat = stationIndex[inside] * len(times) + timeIndex[inside]
+        panel.rows.ravel()[flat] = True
+        for col in variables:
+            values = np.asarray(df[col].values)[inside]
+            if values.dtype.kind not in 'iubf':
+                values = values.astype(np.float64)
+            panel.values[col] = np.full(shape, np.nan if values.dtype.kind == 'f' else 0, dtype=values.dtype)
+            panel.values[col].ravel()[flat] = values
+            panel.mask[col] = np.zeros(shape, dtype=bool)
+            panel.mask[col].ravel()[flat] = pd.notna(values)
+        return panel
+
+    def __getitem__(self, variable):
+        """
+        Return the values of a variable, NaN where not observed, in shape of (stations, times).
+        """
+        return np.where(self.mask[variable], self.values[variable], np.nan)
+
+    def lookup(self, variable, stationIndex, timeIndex, offset=0):
+        """
+        Return the values of a variable at positions shifted by some hours.
+
+        params: variable: string
+        params: stationIndex: numpy array of int, see locate()
+        params: timeIndex: numpy array of int, see locate()
+        params: offset: int, hours added to timeIndex
+        return: numpy array, NaN where not observed or outside the axes
+        """
+        return self.lookup_many([variable], stationIndex, timeIndex, offset)[0]
+
+    def lookup_many(self, variables, stationIndex, timeIndex, offset=0):
+        """
+        Return the values of several variables at the same shifted positions, which are computed once.
+
+        params: variables: list of string
+        params: stationIndex: numpy array of int, see locate()
+        params: timeIndex: numpy array of int, see locate()
+        params: offset: int, hours added to timeIndex
+        return: list of numpy arrays, see lookup()
+        """
+        position = timeIndex + offset
+        inside = (stationIndex >= 0) & (timeIndex >= 0) & (position >= 0) & (position < len(self.times))
+        flat = stationIndex[inside] * len(self.times) + position[inside]
+        results = list()
+        for variable in variables:
+            values, mask = self.values[variable], self.mask[variable]
+            result = np.full(len(position), np.nan, dtype=values.dtype if values.dtype.kind == 'f' else np.float64)
+            result[inside] = np.where(mask.ravel()[flat], values.ravel()[flat], np.nan)
+            results.append(result)
+        return results
+
+    def reindex(self, stations, times):
+        """
+        Place the panel on other station and time axes, by position.
+
+        params: stations: list of string
+        params: times: DatetimeIndex, hourly
+        return: Panel
+        """
+        stations, times = list(stations), pd.DatetimeIndex(times)
+        if stations == self.stations and times.equals(self.times):
+            return self
+        shape = (len(stations), len(times))
+        target = source = (slice(0, 0), slice(0, 0))
+        if len(self.times) and len(times):
+            sourceStation = pd.Index(stations).get_indexer(self.stations)
+            t = np.arange(len(self.times)) + int((self.times[0] - times[0]) / pd.Timedelta(hours=1))
+            keepStation, keepTime = sourceStation >= 0, (t >= 0) & (t < len(times))
+            target = np.ix_(sourceStation[keepStation], t[keepTime])
+            source = np.ix_(np.flatnonzero(keepStation), np.flatnonzero(keepTime))
+
+        def place(array, empty):
+            placed = np.full(shape, empty, dtype=array.dtype)
+            placed[target] = array[source]
+            return placed
+
+        return Panel(stations, times,
+                     {variable: place(values, np.nan if values.dtype.kind == 'f' else 0)
+                      for variable, values in self.values.items()},
+                     {variable: place(mask, False) for variable, mask in self.mask.items()},
+                     place(self.rows, False))
+
+    def join(self, other, how='inner'):
+        """
+        Add the variables of another panel, placed on the axes of this one.
+        Variables already in this panel are kept from this panel. No values are copied on the same axes.
+
+        params: other: Panel
+        params: how: string, options: ['inner', 'left'], the rows kept, as in pd.merge
+        return: Panel
+        """
+        other = other.reindex(self.stations, self.times)
+        values, mask = dict(self.values), dict(self.mask)
+        for variable in other.values:
+            if variable not in values:
+                values[variable], mask[variable] = other.values[variable], other.mask[variable]
+        rows = self.rows & other.rows if how == 'inner' else self.rows
+        return Panel(self.stations, self.times, values, mask, rows)
+
+    @traced('Panel.to_frame')
+    def to_frame(self, rows=None):
+        """
+        Convert the panel to a long-format frame, sorted by station_id and utc_time.
+
+        params: rows: bool numpy array in shape of (stations, times), the pairs to convert, default: self.rows
+        return: DataFrame, with station_id, utc_time and the variables, NaN where not observed
+        """
+        rows = self.rows if rows is None else rows
+        flat = np.flatnonzero(rows.ravel())
+        stationIndex, timeIndex = np.divmod(flat, max(len(self.times), 1))
+        if compact_mode():
+            dtype = station_dtype(self.stations)
+            codes = dtype.categories.get_indexer(self.stations)
+            stations = pd.Categorical.from_codes(codes[stationIndex], dtype=dtype)
+        else:
+            stations = np.asarray(self.stations, dtype=object)[stationIndex]
+        data = {'station_id': stations, 'utc_time': self.times.values.astype('datetime64[ns]')[timeIndex]}
+        for variable, values in self.values.items():
+            values = values.ravel()[flat]
+            mask = self.mask[variable].ravel()[flat]
+            data[variable] = values if mask.all() else np.where(mask, values, np.nan)
+        return pd.DataFrame(data, copy=False)
+
+    def save(self, path):
+        """
+        Save the panel as '{path}.panel'.
+
+        params: path: string, the path without extension
+        return: string, the directory written
+        """
+        directory = path + '.panel'
+        tmp = directory + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'rows.npy'), self.rows)
+        for i, variable in enumerate(self.values):
+            np.save(os.path.join(tmp, '{}.npy'.format(i)), self.values[variable])
+            np.save(os.path.join(tmp, '{}.mask.npy'.format(i)), self.mask[variable])
+        with open(os.path.join(tmp, 'axes.json'), 'w') as f:
+            json.dump({'stations': self.stations, 'start': str(self.times[0]) if len(self.times) else None,
+                       'hours': len(self.times), 'variables': list(self.values)}, f, indent=1)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp, directory)
+        return directory
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a panel saved by save().
+
+        params: path: string, the path without extension
+        params: mmap: bool, memory-map the arrays instead of reading them
+        return: Panel
+        """
+        directory = path + '.panel'
+        with open(os.path.join(directory, 'axes.json')) as f:
+            axes = json.load(f)
+        mode = 'r' if mmap else None
+        times = pd.date_range(axes['start'], periods=axes['hours'], freq='h') if axes['hours'] else []
+        values, mask = dict(), dict()
+        for i, variable in enumerate(axes['variables']):
+            values[variable] = np.load(os.path.join(directory, '{}.npy'.format(i)), mmap_mode=mode)
+            mask[variable] = np.load(os.path.join(directory, '{}.mask.npy'.format(i)), mmap_mode=mode)
+        return cls(axes['stations'], times, values, mask, np.load(os.path.join(directory, 'rows.npy'), mmap_mode=mode))
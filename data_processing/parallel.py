@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Process-pool backend of the per-station kernels, over shared memory.
+
+The rows are sorted by station_id and utc_time, so each station is a contiguous range of rows,
+and the stations are split into one contiguous partition per worker, balanced by rows.
+The input columns and the output arrays are packed into two blocks of shared memory
+(multiprocessing.shared_memory) once, and a worker is only sent their names and the rows of its
+partition: it reads the inputs and writes its rows of the outputs in place, so no copies of
+the arrays are pickled. The small values returned by the kernel (e.g. timings) are gathered
+in the order of the partitions, whichever worker finishes first.
+
+A kernel computes each station on its own, from the rows of whole stations, so the outputs are
+exactly those of the serial path, which runs the same kernel on all rows in this process.
+
+Number of workers (environment variable STATION_WORKERS, default: '1'):
+    1:  the serial path, no worker processes
+    n:  n worker processes, started once per process and kept for the later calls
+    0:  one worker per CPU
+A partition has at least MIN_PARTITION_ROWS rows, so small frames stay in this process.
+
+Usage:
+    STATION_WORKERS=8 python3 -u ./run.py
+
+@author: Stephen
+"""
+
+import os
+import atexit
+import threading
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from tracing import from_environment
+
+MIN_PARTITION_ROWS = 10000
+# the arrays in a block start at multiples of 64 bytes, a cache line
+ALIGNMENT = 64
+
+_pool = None
+_poolWorkers = 0
+_poolLock = threading.Lock()
+
+
+def station_workers(workers=None):
+    """
+    Return the number of worker processes, default: environment variable STATION_WORKERS or 1.
+    """
+    workers = int(os.environ.get('STATION_WORKERS', '1')) if workers is None else int(workers)
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def station_bounds(codes):
+    """
+    Return the row bounds of the stations of rows sorted by station.
+
+    params: codes: 1-d numpy array, the station of each row, the rows of a station contiguous
+    return: numpy array of int64, the first row of each station followed by the number of rows
+    """
+    if len(codes) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1, len(codes)].astype(np.int64)
+
+
+def partition(bounds, parts):
+    """
+    Split the stations into contiguous partitions of about the same number of rows.
+
+    params: bounds: numpy array of int64, see station_bounds()
+    params: parts: int, the largest number of partitions
+    return: list of (start, stop): the rows of each partition, whole stations, in row order
+    """
+    rows = int(bounds[-1])
+    if rows == 0:
+        return []
+    # the first station boundary at or after each even split of the rows
+    cuts = np.searchsorted(bounds, np.arange(1, parts) * rows / parts)
+    cuts = np.unique(np.r_[0, cuts, len(bounds) - 1])
+    return [(int(bounds[a]), int(bounds[b])) for a, b in zip(cuts[:-1], cuts[1:]) if bounds[b] > bounds[a]]
+
+
+def _views(buffer, layout):
+    """
+    Return the arrays of a block of shared memory, name -> numpy array on the buffer.
+    """
+    return {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer, offset=offset)
+            for name, (offset, shape, dtype) in layout.items()}
+
+
+class SharedArrays(object):
+    """
+    Numpy arrays packed into one block of shared memory.
+
+    params: arrays: dict, name -> numpy array of numbers, booleans or datetimes, copied into the block
+    """
+    def __init__(self, arrays):
+        self.layout, size = dict(), 0
+        for name, values in arrays.items():
+            if values.dtype.hasobject:
+                raise TypeError('Arrays of objects cannot be shared: {}'.format(name))
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+            self.layout[name] = (size, values.shape, values.dtype.str)
+            size += values.nbytes
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.arrays = _views(self.memory.buf, self.layout)
+        for name, values in arrays.items():
+            self.arrays[name][...] = values
+
+    @property
+    def spec(self):
+        """
+        The name and layout of the block, sent to the workers instead of the arrays.
+        """
+        return self.memory.name, self.layout
+
+    def close(self):
+        """
+        Release and delete the block; the arrays must not be used any more.
+        """
+        self.arrays = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _initialize():
+    # the spans of each worker go to their own trace file, as those of run_cities()
+    from_environment(suffix='stations.{}'.format(os.getpid()))
+
+
+def _run_partition(kernel, inputSpec, outputSpec, start, stop, args):
+    """
+    Run a kernel in a worker process, on the arrays of the shared blocks.
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name, layout in (inputSpec, outputSpec)]
+    inputs, outputs = _views(blocks[0].buf, inputSpec[1]), _views(blocks[1].buf, outputSpec[1])
+    try:
+        return kernel(inputs, outputs, start, stop, *args)
+    finally:
+        # the views must be gone before the blocks are closed
+        inputs = outputs = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # still viewed from the traceback of a failed kernel, unmapped with it
+                pass
+
+
+def _executor(workers):
+    """
+    Return the pool of worker processes, started again if the number of workers changed.
+    """
+    global _pool, _poolWorkers
+    with _poolLock:
+        if _pool is None or _poolWorkers != workers:
+            if _pool is not None:
+                _pool.shutdown()
+            # spawned workers start clean, without the threads and locks of this process
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_initialize)
+            _poolWorkers = workers
+        return _pool
+
+
+@atexit.register
+def shutdown():
+    """
+    Stop the worker processes.
+    """
+    global _pool, _poolWorkers
+    with _poolLock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool, _poolWorkers = None, 0
+
+
+def map_stations(kernel, inputs, outputs, bounds, args=(), workers=None):
+    """
+    Run a per-station kernel on the partitions of the stations, in worker processes.
+
+    params: kernel: callable, kernel(inputs, outputs, start, stop, *args) computes the rows [start, stop)
+                    (whole stations) of the outputs in place from the inputs, and returns a small value;
+                    defined at module level so that worker processes can import it
+    params: inputs: dict, name -> numpy array, read only
+    params: outputs: dict, name -> numpy array, with the initial values of the rows not computed
+    params: bounds: numpy array of int64, see station_bounds()
+    params: args: tuple, the other arguments of kernel, pickled for every partition
+    params: workers: int, see station_workers()
+    return: (outputs, results): dict of the computed arrays, and the list of the values the kernel
+            returned, in the order of the partitions
+    """
+    rows = int(bounds[-1])
+    parts = partition(bounds, min(station_workers(workers), rows // MIN_PARTITION_ROWS))
+    if len(parts) < 2:
+        return outputs, [kernel(inputs, outputs, 0, rows, *args)]
+
+    sharedInputs, sharedOutputs = SharedArrays(inputs), SharedArrays(outputs)
+    try:
+        executor = _executor(station_workers(workers))
+        futures = [executor.submit(_run_partition, kernel, sharedInputs.spec, sharedOutputs.spec, start, stop, args)
+                   for start, stop in parts]
+        results = [future.result() for future in futures]
+        outputs = {name: values.copy() for name, values in sharedOutputs.arrays.items()}
+    finally:
+        sharedInputs.close()
+        sharedOutputs.close()
+    return outputs, results
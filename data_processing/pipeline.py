@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Stages of data preprocessing, run by dag.Pipeline.
+
+retrieve -> integrate (hist / live air quality / live grid) [-> impute] -> label (each pollutant, hist / live)
+
+With IMPUTE=1, the missing air quality values are imputed before labeling (see imputation.py).
+
+The stages are created per city (see cities.py). Each city has its own pipeline,
+cache and station dictionary under ../input/{city}, so cities run in separate
+processes (see dag.run_cities), after one retrieval for all of them.
+
+@author: Stephen
+"""
+
+import os
+from dag import Stage, Pipeline
+from retrieve_data import retrieve_all
+from data_integration import integrate_hist_aq, integrate_live_aq, integrate_live_grid, duplicate_policy
+from create_label import label_data
+from imputation import impute, imputation
+from cities import get_city, multi_target
+
+# the modules run by the labels besides create_label.py, part of the fingerprints of the label stages
+LABEL_CODE = ['panel', 'parallel', 'validity', 'storage']
+
+
+def retrieval_stage(cities, rawPath='../raw_data'):
+    """
+    Create the stage retrieving the live data of several cities at once.
+
+    params: cities: list of string
+    params: rawPath: string, the root directory of raw data
+    return: Stage
+    """
+    pairs = [pair for city in cities for pair in get_city(city).pairs()]
+    return Stage('retrieve', retrieve_all, params={'pairs': pairs, 'rawPath': rawPath}, cache=False)
+
+
+def preprocessing_stages(rawPath='../raw_data', inputPath=None, retrieve=True, city='london', multiTarget=None):
+    """
+    Create the stages of data preprocessing of a city.
+
+    Frame names: aq_hist, aq_live, grid_live, {target}_hist_label, {target}_live_label,
+    or hist_label and live_label, the labels of all measurements, in multi-target mode,
+    and aq_hist_imputed and aq_live_imputed, labeled instead of aq_hist and aq_live, when imputing
+
+    params: rawPath: string, the root directory of raw data
+    params: inputPath: string, the directory of preprocessed data, default: ../input/{city}
+    params: retrieve: bool, False to skip the live data retrieval
+    params: city: string, see cities.py
+    params: multiTarget: bool, label all measurements at once, default: cities.multi_target()
+    return: list of Stage
+    """
+    city = get_city(city)
+    inputPath = inputPath or city.inputPath
+    multiTarget = multi_target() if multiTarget is None else multiTarget
+    stages = list()
+    if retrieve:
+        stages.append(retrieval_stage([city.name], rawPath))
+
+    aqStations = '{}/{}'.format(rawPath, city.aqStationsFile)
+    stages.append(Stage('integrate_hist_aq', integrate_hist_aq, params={'rawPath': rawPath, 'city': city.name},
+                        outputs={'aq_hist': city.frame('aq_hist_data_merged', inputPath)},
+                        files=['{}/{}'.format(rawPath, filename) for filename in city.histFiles] + [aqStations],
+                        code=['cities', 'validity']))
+    # the live data is integrated incrementally into its stored frames, see data_integration.integrate_live()
+    policy = duplicate_policy()
+    aqLive, gridLive = city.frame('aq_live_data_merged', inputPath), city.frame('grid_live_data_merged', inputPath)
+    stages.append(Stage('integrate_live_aq', integrate_live_aq,
+                        params={'rawPath': rawPath, 'city': city.name, 'outputPath': aqLive, 'policy': policy},
+                        after=['retrieve'], outputs={'aq_live': aqLive}, stores=True,
+                        files=['{}/{}/airquality'.format(rawPath, city.name), aqStations], code=['cities', 'key_index', 'validity']))
+    stages.append(Stage('integrate_live_grid', integrate_live_grid,
+                        params={'rawPath': rawPath, 'city': city.name, 'outputPath': gridLive, 'policy': policy},
+                        after=['retrieve'], outputs={'grid_live': gridLive}, stores=True,
+                        files=['{}/{}/grid'.format(rawPath, city.name), '{}/{}'.format(rawPath, city.gridStationsFile)],
+                        code=['cities', 'key_index', 'validity']))
+
+    # the frames labeled, by kind
+    labeled = {kind: 'aq_{}'.format(kind) for kind in ['hist', 'live']}
+    if imputation():
+        for kind in ['hist', 'live']:
+            stages.append(Stage('impute_{}_aq'.format(kind), impute, inputs=[labeled[kind]],
+                                params={'columns': city.measurements},
+                                outputs={'aq_{}_imputed'.format(kind): city.frame('aq_{}_data_imputed'.format(kind), inputPath)},
+                                code=['cities', 'panel', 'validity', 'storage']))
+            labeled[kind] = 'aq_{}_imputed'.format(kind)
+
+    if multiTarget:
+        for kind in ['hist', 'live']:
+            stages.append(Stage('label_{}'.format(kind), label_data,
+                                inputs=[labeled[kind]], params={'target': city.measurements},
+                                outputs={'{}_label'.format(kind): city.labels_frame(kind, inputPath)}, code=LABEL_CODE))
+        return stages
+
+    for target in city.pollutants:
+        for kind in ['hist', 'live']:
+            stages.append(Stage('label_{}_{}'.format(kind, target), label_data,
+                                inputs=[labeled[kind]], params={'target': target},
+                                outputs={'{}_{}_label'.format(target, kind): city.label_frame(target, kind, inputPath)},
+                                code=LABEL_CODE))
+    return stages
+
+
+def run_preprocessing(city):
+    """
+    Run the preprocessing pipeline of a city, without retrieval, e.g. in a worker process of dag.run_cities.
+
+    params: city: string
+    return: dict, stage name -> status
+    """
+    city = get_city(city)
+    if not os.path.isdir(city.inputPath):
+        os.makedirs(city.inputPath)
+    return Pipeline(preprocessing_stages(retrieve=False, city=city.name),
+                    cachePath='{}/dag_cache.json'.format(city.inputPath)).run()
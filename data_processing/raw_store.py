@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Partitioned store of the live daily files, by data type and month.
+
+The daily files of retrieve_data.py are folded into one stored frame per (data type, month)
+of their rows (see storage.py), e.g. {rawPath}/london/store/airquality/2018-04, and a small
+index (index.json) records for each partition:
+    start, end: the first and last utc_time
+    stations:   the station ids
+    rows:       the number of rows
+    files:      the daily files folded into it, with their size, modification time and row range
+
+Compaction is incremental: only the new or changed daily files are parsed, and only the partitions
+of their months are written again, with the rows of each file replacing its earlier rows (a daily file
+grows while its day is retrieved). The rows of a partition are kept in the order of the file names,
+so reading all partitions gives the rows of all daily files in the order read_multiple_csv() reads them.
+The daily files are kept, they are still the files retrieve_data.py appends to.
+
+A read names a time range and stations, and only the partitions which overlap both are read.
+
+@author: Stephen
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from storage import read_frame, write_frame, find_frame, compact_mode, encode_stations
+from tracing import span
+
+INDEX = 'index.json'
+
+
+def file_fingerprint(path):
+    """
+    Return the size and modification time of a file.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def remove_frame(path):
+    """
+    Delete a stored frame in any format.
+    """
+    found = find_frame(path)
+    if found is None:
+        return
+    if os.path.isdir(found):
+        shutil.rmtree(found)
+    else:
+        os.remove(found)
+
+
+class RawStore(object):
+    """
+    The partitions of the live data of a city.
+
+    params: path: string, the directory of the store, e.g. ../raw_data/london/store
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = {'data_types': dict()}
+        if os.path.isfile(os.path.join(path, INDEX)):
+            with open(os.path.join(path, INDEX)) as f:
+                self.index = json.load(f)
+
+    def partition_path(self, dataType, month):
+        return os.path.join(self.path, dataType, month)
+
+    def partitions(self, dataType):
+        """
+        Return the partitions of a data type, month -> metadata, in month order.
+        """
+        return self.index['data_types'].get(dataType, {}).get('partitions', {})
+
+    def save(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = os.path.join(self.path, INDEX + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, INDEX))
+
+    def compact(self, dataType, files, read, columns):
+        """
+        Fold the new or changed daily files of a data type into their month partitions.
+
+        params: dataType: string, e.g. 'airquality'
+        params: files: list of string, all the daily files of the data type
+        params: read: callable, read(list of files) returns their rows, with station_id and utc_time columns
+        params: columns: list of string, the columns of the rows, the partitions are rebuilt when they change
+        return: int, the number of files folded
+        """
+        meta = self.index['data_types'].get(dataType)
+        if meta is None or meta['columns'] != list(columns):
+            # a new data type, or other columns: all files are folded again
+            if os.path.isdir(os.path.join(self.path, dataType)):
+                shutil.rmtree(os.path.join(self.path, dataType))
+            meta = self.index['data_types'][dataType] = {'columns': list(columns), 'partitions': dict()}
+        partitions = meta['partitions']
+        known = {name: (month, info) for month, partition in partitions.items() for name, info in partition['files'].items()}
+        changed = [f for f in files if os.path.basename(f) not in known
+                   or known[os.path.basename(f)][1][:2] != file_fingerprint(f)]
+        if not changed:
+            return 0
+
+        with span('compact_raw', dataType=dataType, files=len(changed)) as sp:
+            # the rows of each changed file, by month
+            blocks = dict()
+            for f in changed:
+                df = read([f])
+                months = df['utc_time'].dt.strftime('%Y-%m')
+                for month, rows in df.groupby(months.values, sort=True):
+                    blocks.setdefault(month, dict())[os.path.basename(f)] = (rows.reset_index(drop=True), file_fingerprint(f))
+                # a changed file also leaves the partitions where it has no rows any more
+                for month, partition in partitions.items():
+                    if os.path.basename(f) in partition['files']:
+                        blocks.setdefault(month, dict())
+
+            changedNames = {os.path.basename(f) for f in changed}
+            for month in sorted(blocks):
+                partition = partitions.get(month, {'files': dict()})
+                stored = read_frame(self.partition_path(dataType, month)) if partition['files'] else None
+                parts = dict()
+                for name, info in partition['files'].items():
+                    if name not in changedNames:
+                        parts[name] = (stored.iloc[info[2]:info[3]], info[:2])
+                parts.update(blocks[month])
+                frames, fileInfo, rows = list(), dict(), 0
+                for name in sorted(parts):
+                    df, fingerprint = parts[name]
+                    frames.append(df)
+                    fileInfo[name] = fingerprint + [rows, rows + len(df)]
+                    rows += len(df)
+                if not frames:
+                    partitions.pop(month, None)
+                    remove_frame(self.partition_path(dataType, month))
+                    continue
+                df = pd.concat(frames, ignore_index=True)
+                if compact_mode():
+                    df['station_id'] = encode_stations(df['station_id'])
+                write_frame(df, self.partition_path(dataType, month))
+                partitions[month] = {'start': str(df['utc_time'].min()), 'end': str(df['utc_time'].max()),
+                                     'stations': sorted(df['station_id'].astype(object).unique()),
+                                     'rows': len(df), 'files': fileInfo}
+            meta['partitions'] = dict(sorted(partitions.items()))
+            self.save()
+            sp.set(partitions=len(blocks))
+        return len(changed)
+
+    def select(self, dataType, start=None, end=None, stations=None):
+        """
+        Return the months of the partitions overlapping a time range and stations.
+
+        params: dataType: string
+        params: start: datetime-like, included, None for no lower bound
+        params: end: datetime-like, included, None for no upper bound
+        params: stations: list of string, None for all stations
+        return: list of string
+        """
+        months = list()
+        for month, partition in self.partitions(dataType).items():
+            if start is not None and pd.Timestamp(partition['end']) < pd.Timestamp(start):
+                continue
+            if end is not None and pd.Timestamp(partition['start']) > pd.Timestamp(end):
+                continue
+            if stations is not None and not set(stations) & set(partition['stations']):
+                continue
+            months.append(month)
+        return months
+
+    def read(self, dataType, start=None, end=None, stations=None, columns=None):
+        """
+        Read the rows of a time range and stations, from the partitions overlapping them only.
+
+        params: dataType: string
+        params: start: datetime-like, included, None for no lower bound
+        params: end: datetime-like, included, None for no upper bound
+        params: stations: list of string, None for all stations
+        params: columns: list of string, default: all columns
+        return: DataFrame
+        """
+        meta = self.index['data_types'].get(dataType)
+        if meta is None:
+            raise FileNotFoundError('No {} partitions in {}'.format(dataType, self.path))
+        months = self.select(dataType, start, end, stations)
+        columns = list(columns or meta['columns'])
+        # the keys are read for the filters, and dropped unless asked for
+        keys = [col for col in ['station_id', 'utc_time'] if col not in columns]
+        with span('read_raw', dataType=dataType, partitions=len(months)) as sp:
+            frames = list()
+            for month in months:
+                df = read_frame(self.partition_path(dataType, month), columns=columns + keys)
+                keep = np.ones(len(df), dtype=bool)
+                if start is not None:
+                    keep &= (df['utc_time'] >= pd.Timestamp(start)).values
+                if end is not None:
+                    keep &= (df['utc_time'] <= pd.Timestamp(end)).values
+                if stations is not None:
+                    keep &= df['station_id'].isin(stations).values
+                frames.append((df if keep.all() else df[keep])[columns])
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+            if compact_mode() and 'station_id' in df.columns:
+                df['station_id'] = encode_stations(df['station_id'])
+            sp.set(rows_out=len(df))
+        return df
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Local stand-in for the official API, which replays recorded CSV payloads.
+
+The recordings are laid out as retrieve_data.py saves them:
+    {root}/{city}/{dataType}/{cityAbbr}_{dataType}_{YYYYMMDD}.csv
+
+A request returns the recorded rows within its hour range under one header,
+and 'None' is returned when no day is recorded, the same as the API.
+
+Usage:
+    python3 -u ./replay_server.py ../raw_data 8000
+    retrieve_all(pairs, baseUrl='http://127.0.0.1:8000')
+
+@author: Stephen
+"""
+
+import os
+import sys
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CITIES = {'bj': 'beijing', 'ld': 'london'}
+
+
+def _hour_of(line, col):
+    """
+    Parse the hour of a recorded row, e.g. '2018-04-01 13:00:00' -> datetime(2018, 4, 1, 13)
+    """
+    return datetime.datetime.strptime(line.split(',')[col][:13], '%Y-%m-%d %H')
+
+
+def recorded_payload(root, path):
+    """
+    Return the recorded payload of an API path.
+
+    params: root: string, the root directory of recordings
+    params: path: string, e.g. '/airquality/ld/2018-04-01-0/2018-04-01-23/2k0d1d8'
+    return: string
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) != 5:
+        return 'None'
+    if parts[0] == 'meteorology' and parts[1].endswith('_grid'):
+        cityAbbr, dataType = parts[1].split('_')
+    else:
+        dataType, cityAbbr = parts[0], parts[1]
+    if cityAbbr not in CITIES:
+        return 'None'
+
+    startTime = datetime.datetime.strptime(parts[2], '%Y-%m-%d-%H')
+    endTime = datetime.datetime.strptime(parts[3], '%Y-%m-%d-%H')
+
+    lines = list()
+    currentDate = startTime.date()
+    while currentDate <= endTime.date():
+        filename = '{0}_{1}_{2:%Y}{2:%m}{2:%d}.csv'.format(cityAbbr, dataType, currentDate)
+        filepath = os.path.join(root, CITIES[cityAbbr], dataType, filename)
+        if os.path.isfile(filepath):
+            with open(filepath) as f:
+                content = f.read().splitlines()
+            col = content[0].split(',').index('time') if 'time' in content[0].split(',') else 2
+            rows = [line for line in content[1:] if startTime <= _hour_of(line, col) <= endTime]
+            lines.extend(rows if lines else content[:1] + rows)
+        currentDate += datetime.timedelta(days=1)
+    return '\n'.join(lines) + '\n' if len(lines) > 1 else 'None'
+
+
+def serve(root, port=0):
+    """
+    Start a replay server in a daemon thread.
+
+    params: root: string, the root directory of recordings
+    params: port: int, 0 picks a free port
+    return: (server, baseUrl): call server.shutdown() to stop it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = recorded_payload(root, self.path).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+if __name__ == '__main__':
+
+    root = sys.argv[1] if len(sys.argv) > 1 else '../raw_data'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server, baseUrl = serve(root, port)
+    print('Replaying {} at {}'.format(root, baseUrl))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -3,6 +3,21 @@
 """
 Retrive live air quality and meteorology data, from 2018/03/31 to current time, by official API.
 
+retrieve_all() fetches every (city, dataType, day) in parallel with a bounded
+number of workers. Each worker reuses a pooled HTTP session, which retries
+failed requests with exponential backoff.
+
+The API can be replaced by a local stand-in with `baseUrl`, see replay_server.py.
+
+Retrieval is incremental: a manifest (../raw_data/retrieval_manifest.json) records
+the hours already on disk for each (city, dataType, day). Each run requests only
+the missing hours, one request per run of consecutive missing hours (so the gaps
+inside a day are requested again too), and appends them to the daily files.
+A past day is complete once it has every hour, or once its missing hours were answered
+without data by MISSING_RETRIES runs while it has rows; a day without any row is requested
+again at every run, since an empty answer may as well be an outage of the API.
+The one-file history is built locally from the daily files instead of being downloaded again.
+
 @author: Ray & Stephen
 
 Reference: https://biendata.com/forum/view_post/9
@@ -10,8 +25,143 @@ Reference: https://biendata.com/forum/view_post/9
 
 import requests
 import os
+import csv
+import json
 import time
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tracing import traced, span, current
+
+BASE_URL = 'https://biendata.com/competition'
+START_DATE = datetime.date(year=2018, month=3, day=31)
+MANIFEST = 'retrieval_manifest.json'
+MISSING_RETRIES = 3
+
+
+def build_url(dataType, city, startDate, endDate=None, endHour=23, baseUrl=BASE_URL, startHour=0):
+    """
+    Build the API url of a time range.
+
+    params: dataType: string, options: ['meteorology', 'airquality', 'grid']
+    params: city: string, options: ['beijing', 'london']
+    params: startDate: datetime.date, the range starts at startHour of this day
+    params: endDate: datetime.date, the range ends at endHour of this day, default: startDate
+    params: endHour: int, [0-23]
+    params: baseUrl: string
+    params: startHour: int, [0-23]
+    return: string
+    """
+    cityAbbr = 'bj' if city == 'beijing' else 'ld'
+    endDate = startDate if endDate is None else endDate
+    if dataType == 'grid':
+        return '{0}/meteorology/{1}_{2}/{3}-{6}/{4}-{5}/2k0d1d8'.format(baseUrl, cityAbbr, dataType, startDate, endDate, endHour, startHour)
+    return '{0}/{1}/{2}/{3}-{6}/{4}-{5}/2k0d1d8'.format(baseUrl, dataType, cityAbbr, startDate, endDate, endHour, startHour)
+
+
+def daily_filename(dataType, city, day):
+    """
+    File name of a day of data, e.g. ld_airquality_20180401.csv
+    """
+    cityAbbr = 'bj' if city == 'beijing' else 'ld'
+    return '{0}_{1}_{2:%Y}{2:%m}{2:%d}.csv'.format(cityAbbr, dataType, day)
+
+
+def scan_hours(lines):
+    """
+    Find the hours covered by CSV lines of the API.
+
+    params: lines: list of string, the header and the data rows
+    return: (hours, rows): hours is the sorted list of the hours with rows
+    """
+    rows = list(csv.reader(lines))
+    if len(rows) < 2:
+        return [], 0
+    col = rows[0].index('time') if 'time' in rows[0] else 2
+    hours = {int(row[col][11:13]) for row in rows[1:] if len(row) > col and len(row[col]) >= 13}
+    return sorted(hours), len(rows) - 1
+
+
+def missing_ranges(hours, endHour=23):
+    """
+    Group the hours of a day which are not on disk into ranges of consecutive hours.
+
+    params: hours: list of int, the hours on disk
+    params: endHour: int, the last hour expected
+    return: list of (startHour, endHour), both included
+    """
+    ranges = list()
+    for hour in sorted(set(range(endHour + 1)) - set(hours)):
+        if ranges and ranges[-1][1] == hour - 1:
+            ranges[-1] = (ranges[-1][0], hour)
+        else:
+            ranges.append((hour, hour))
+    return ranges
+
+
+def load_manifest(rawPath='../raw_data'):
+    """
+    Load the retrieval manifest.
+
+    Every entry is keyed by '{city}/{dataType}/{YYYY-MM-DD}', with
+    hours (the sorted hours on disk), rows, retries (the runs after the day ended whose
+    requests were answered, while hours were missing), complete (True once the day ended and it
+    has every hour, or it has rows and MISSING_RETRIES retries) and retrieved_at.
+
+    params: rawPath: string, the root directory of raw data
+    return: dict
+    """
+    path = os.path.join(rawPath, MANIFEST)
+    if not os.path.isfile(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, rawPath='../raw_data'):
+    """
+    Save the retrieval manifest atomically.
+    """
+    path = os.path.join(rawPath, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def build_history(dataType, city, endDate, rawPath='../raw_data'):
+    """
+    Build the one-file history from 2018/03/31 by joining the daily files under one header.
+
+    params: dataType: string, options: ['meteorology', 'airquality', 'grid']
+    params: city: string, options: ['beijing', 'london']
+    params: endDate: datetime.date, the last day included
+    params: rawPath: string, the root directory of raw data
+    return: string, the path of the history file
+    """
+    cityAbbr = 'bj' if city == 'beijing' else 'ld'
+    filename = '{0}_{1}_20180331_{2:%Y}{2:%m}{2:%d}.csv'.format(cityAbbr, dataType, endDate)
+    path = '{0}/{1}/{2}'.format(rawPath, city, filename)
+
+    header = None
+    with open(path + '.tmp', 'w') as out:
+        currentDate = START_DATE
+        while currentDate <= endDate:
+            filepath = '{0}/{1}/{2}/{3}'.format(rawPath, city, dataType, daily_filename(dataType, city, currentDate))
+            if os.path.isfile(filepath):
+                with open(filepath) as f:
+                    first = f.readline()
+                    if header is None:
+                        header = first
+                        out.write(header)
+                    for line in f:
+                        out.write(line if line.endswith('\n') else line + '\n')
+            currentDate += datetime.timedelta(days=1)
+    os.replace(path + '.tmp', path)
+    print("{}: Built".format(path))
+    return path
+
 
 def retrieve_data(dataType, city):
     """
@@ -21,87 +171,156 @@ def retrieve_data(dataType, city):
     params: city: string, options: ['beijing', 'london']
     return: None
     """
-    cityAbbr = 'bj' if city == 'beijing' else 'ld'
-    
-    # Create directories for each city
-    path = '../raw_data/{}'.format(city)
-    if not os.path.isdir(path):
-        os.makedirs(path)
+    retrieve_all([(dataType, city)], workers=1)
+
+
+_local = threading.local()
+
+
+def get_session(workers, retries, backoff):
+    """
+    Return the pooled session of the current thread, created on first use.
 
-    # Create directories for each kind of data
-    path = '../raw_data/{0}/{1}'.format(city, dataType)
-    if not os.path.isdir(path):
-        os.makedirs(path)
+    params: workers: int, the size of the connection pool
+    params: retries: int, the number of retries for connection errors and 429/5xx responses
+    params: backoff: float, the backoff factor in seconds, doubled at each retry
+    return: requests.Session
+    """
+    if getattr(_local, 'session', None) is None:
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return _local.session
+
+
+@traced()
+def retrieve_all(pairs, workers=8, retries=3, backoff=0.5, baseUrl=BASE_URL, rawPath='../raw_data'):
+    """
+    Retrieve the missing hours of several (dataType, city) pairs concurrently.
+
+    Every (city, dataType, day) with missing hours is an independent job, with one request per
+    range of consecutive missing hours.
+    New hours are appended to the daily file and recorded in the manifest,
+    then the one-file history of each pair is rebuilt from the daily files.
 
-    # Initialize date variables
+    params: pairs: list of tuple, (dataType, city)
+    params: workers: int, the maximum number of concurrent requests
+    params: retries: int, the number of retries per request
+    params: backoff: float, the backoff factor in seconds
+    params: baseUrl: string, the API address, e.g. a local replay server
+    params: rawPath: string, the root directory of raw data
+    return: dict, the number of requests retrieved, empty and failed
+    """
     utcTime = datetime.datetime.utcnow()
-    utcToday = datetime.date(year=utcTime.year, month=utcTime.month, day=utcTime.day)
-
-    # Retrieve data day by day, from 2018/03/31 until now
-    currentDate = datetime.date(year=2018, month=3, day=31)
-    while currentDate <= utcToday:
-        filename = '{0}_{1}_{2:%Y}{2:%m}{2:%d}.csv'.format(cityAbbr, dataType, currentDate)
-        path = '../raw_data/{0}/{1}/{2}'.format(city, dataType, filename)
-        if not os.path.isfile(path) or currentDate == utcToday:
-            if dataType == 'grid':
-                input = '{}_{}'.format(cityAbbr, dataType)
-                url = 'https://biendata.com/competition/meteorology/{0}/{1}-0/{1}-23/2k0d1d8'.format(input, currentDate)
-            else:
-                url = 'https://biendata.com/competition/{0}/{1}/{2}-0/{2}-23/2k0d1d8'.format(dataType, cityAbbr, currentDate)
+    utcToday = utcTime.date()
+    manifest = load_manifest(rawPath)
+
+    jobs = list()
+    for dataType, city in pairs:
+        path = '{0}/{1}/{2}'.format(rawPath, city, dataType)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        currentDate = START_DATE
+        while currentDate <= utcToday:
+            key = '{0}/{1}/{2}'.format(city, dataType, currentDate)
+            filepath = '{0}/{1}'.format(path, daily_filename(dataType, city, currentDate))
+            entry = manifest.get(key)
+            if (entry is None or 'hours' not in entry) and os.path.isfile(filepath):
+                # files retrieved before the manifest (or before it recorded every hour)
+                with open(filepath) as f:
+                    hours, rows = scan_hours(f.read().splitlines())
+                entry = manifest[key] = {'hours': hours, 'rows': rows, 'retries': 0,
+                                         'complete': currentDate < utcToday and len(hours) == 24, 'retrieved_at': None}
+            if entry is not None and ('hours' not in entry or entry['rows'] and not os.path.isfile(filepath)):
+                # the file was removed since, retrieve the day again
+                del manifest[key]
+                entry = None
 
-            response = requests.get(url)
+            if entry is None or not entry['complete']:
+                endHour = 23 if currentDate < utcToday else utcTime.hour
+                ranges = missing_ranges([] if entry is None else entry['hours'], endHour)
+                if ranges:
+                    # the ranges of a day are requested in turn, as they append to the same file
+                    urls = [build_url(dataType, city, currentDate, endHour=stopHour, baseUrl=baseUrl, startHour=startHour)
+                            for startHour, stopHour in ranges]
+                    jobs.append((key, urls, filepath, endHour == 23 and currentDate < utcToday))
+                elif currentDate < utcToday:
+                    entry['complete'] = True
+            currentDate += datetime.timedelta(days=1)
+
+    parent = current()
+
+    def fetch(key, url, filepath):
+        with span('fetch', parent=parent, key=key) as sp:
+            try:
+                response = get_session(workers, retries, backoff).get(url, timeout=60)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print("Failed {}: {}".format(filepath, e))
+                return 'failed', None
             if response.text == 'None':
-                print("No data in {}".format(filename))
-                pass
+                print("No data in {}".format(os.path.basename(filepath)))
+                return 'empty', ([], 0)
+            lines = response.text.splitlines()
+            if os.path.isfile(filepath):
+                with open(filepath, 'a') as f:
+                    f.writelines(line + '\n' for line in lines[1:])
             else:
-                with open(path, 'w') as f:
-                    f.write(response.text)
-                print("{}: Retrieved".format(path))
-
-        # Set currentDate to the next day
-        currentDate += datetime.timedelta(days=1)
-        
-    #=============================================
-    # Alternative method: Retrive data in one file
-    #=============================================
-    
-    filename = '{0}_{1}_20180331_{2:%Y}{2:%m}{2:%d}.csv'.format(cityAbbr, dataType, currentDate)
-    path = '../raw_data/{0}/{1}'.format(city, filename)
-    url = 'https://biendata.com/competition/{0}/{1}/2018-03-31-0/{2}-{3}/2k0d1d8'.format(dataType, cityAbbr, utcToday, utcTime.hour)
+                with open(filepath, 'w') as f:
+                    f.writelines(line + '\n' for line in lines)
+            sp.add(bytes_written=len(response.content)).set(rows_out=len(lines) - 1)
+            print("{}: Retrieved".format(filepath))
+            return 'retrieved', scan_hours(lines)
+
+    def fetch_day(job):
+        key, urls, filepath, final = job
+        return [fetch(key, url, filepath) for url in urls]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch_day, jobs))
 
-    response = requests.get(url)
-    if response.text == 'None':
-        print("No data in {}".format(filename))
-        pass
-    else:
-        with open(path, 'w') as f:
-            f.write(response.text)
-        print("{}: Retrieved".format(path))
+    retrievedAt = utcTime.isoformat(timespec='seconds')
+    for (key, urls, filepath, final), dayResults in zip(jobs, results):
+        for status, scanned in dayResults:
+            if status == 'failed':
+                continue
+            entry = manifest.setdefault(key, {'hours': [], 'rows': 0, 'retries': 0, 'complete': False})
+            hours, rows = scanned
+            entry['hours'] = sorted(set(entry['hours']) | set(hours))
+            entry['rows'] += rows
+            entry['retrieved_at'] = retrievedAt
+        if key in manifest:
+            # after the day ended, the hours still missing are requested again by the next runs, and
+            # given up after MISSING_RETRIES answers, unless the day has no rows at all (e.g. an outage)
+            entry = manifest[key]
+            if final and all(status != 'failed' for status, _ in dayResults) and len(entry['hours']) < 24:
+                entry['retries'] = entry.get('retries', 0) + 1
+            entry['complete'] = final and (len(entry['hours']) == 24
+                                           or entry['rows'] > 0 and entry['retries'] >= MISSING_RETRIES)
+    save_manifest(manifest, rawPath)
+
+    for dataType, city in pairs:
+        build_history(dataType, city, utcToday, rawPath)
+
+    statuses = [status for dayResults in results for status, _ in dayResults]
+    return {status: statuses.count(status) for status in ('retrieved', 'empty', 'failed')}
 
 
 if __name__ == '__main__':
 
     start = time.time()
-    ############################
-    # Retrieve Data in Beijing #
-    ############################
-    retrieve_data('meteorology', 'beijing')
-    print('Meteorology in Beijing: Done')
-
-    retrieve_data('airquality', 'beijing')
-    print('Air Quality in Beijing: Done')
-
-    retrieve_data('grid', 'beijing')
-    print('Grid Meteorology in Beijing: Done')
-
-    ###########################
-    # Retrieve Data in London #
-    ###########################
-    retrieve_data('airquality', 'london')
-    print('Air Quality in London: Done')
-
-    retrieve_data('grid', 'london')
-    print('Grid Meteorology in London: Done')
-    
+    ###################################
+    # Retrieve Data in Beijing/London #
+    ###################################
+    pairs = [('meteorology', 'beijing'), ('airquality', 'beijing'), ('grid', 'beijing'),
+             ('airquality', 'london'), ('grid', 'london')]
+    summary = retrieve_all(pairs)
+    print('Retrieved: {retrieved}, No data: {empty}, Failed: {failed}'.format(**summary))
+
     end = time.time()
-    print('Data Retrieval Time: {:.2f} secs'.format(end-start))
\ No newline at end of file
+    print('Data Retrieval Time: {:.2f} secs'.format(end-start))
@@ -3,37 +3,47 @@
 """
 Data preprocessing pipeline.
 
+The stages run in this process (see pipeline.py and dag.py), and the stages whose
+raw files, parameters and code are unchanged since the last run are skipped.
+
+The live data of all cities is retrieved once, then each city is preprocessed in
+its own worker process, e.g. python3 run.py london beijing (default: london).
+The worker processes import this script, hence the __main__ guard.
+The exit status is 1 when any stage or city failed, after the other stages ran.
+
 @author: Stephen
 """
 
-import os
+import sys
 import time
-
- ####################
-# data preprocessing #
- ####################
-s = time.time()
-
-print('Start Data preprocessing...')
-print('.')
-print('.')
-print('.')
-print('Step 1: Live Data Retrieval...')
-os.system('python3 -u ./retrieve_data.py')
-
-print('Step 2: Data Integration...')
-os.system('python3 -u ./data_integration.py')
-
-# The data retrieved from external API may varies due to the timezone issue.
-# Temporarily exclude running this script for now.
-# os.system('python3 -u ./merge_aq_external.py')
-
-print('Step 3: Data Labeling...')
-os.system('python3 -u ./create_label.py')
-
-e = time.time()
-print('.')
-print('.')
-print('.')
-print('Data Preprocessing Finished.')
-print('It takes {:.2f} mins'.format((e-s)/60.0))
+from dag import Pipeline, run_cities, failed
+from pipeline import retrieval_stage, run_preprocessing
+from cities import city_arguments
+
+if __name__ == '__main__':
+
+     ####################
+    # data preprocessing #
+     ####################
+    s = time.time()
+
+    print('Start Data preprocessing...')
+    print('.')
+    print('.')
+    print('.')
+    cities = city_arguments()
+
+    # The data retrieved from external API may varies due to the timezone issue.
+    # Temporarily exclude running merge_aq_external.py for now.
+    status = Pipeline([retrieval_stage(cities)], cachePath='../input/retrieval_cache.json').run()
+    status.update(run_cities(run_preprocessing, cities))
+
+    e = time.time()
+    print('.')
+    print('.')
+    print('.')
+    print('Data Preprocessing Finished: {}'.format(status))
+    print('It takes {:.2f} mins'.format((e-s)/60.0))
+    if failed(status):
+        print('Failed: {}'.format(failed(status)))
+        sys.exit(1)
@@ -0,0 +1,547 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Storage of the stage outputs, e.g. merged data, labels and features.
+
+Stage outputs are addressed without extension, e.g. '../input/london/london_aq_hist_data_merged',
+and saved in the format of STORAGE_FORMAT (environment variable, default: 'columnar').
+
+Formats:
+    columnar: a directory '{path}.cols' with one .npy file per column and schema.json.
+              utc_time is datetime64[ns], station_id is categorical and floats are float32.
+              Columns are memory-mapped when read, so nothing is parsed.
+    csv:      a plain '{path}.csv', the original text interchange.
+
+Compact memory (environment variable COMPACT_MEMORY, default: '1'):
+    station_id uses one categorical dictionary shared by all stages (STATION_DICTIONARY),
+    so frames of different stages concatenate and merge without falling back to strings.
+    Measurements are float32 and calendar columns are small ints also in memory.
+    COMPACT_MEMORY=0 restores strings, float64 and int64 in memory, e.g. to compare memory reports.
+
+Export a columnar output to CSV for other tools:
+    python3 -u ./storage.py ../feature/london/train/PM2.5/all_features all_features.csv
+
+@author: Stephen
+"""
+
+import os
+import sys
+import json
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+from tracing import span, enabled
+
+TIME_COLUMNS = ['utc_time']
+CATEGORY_COLUMNS = ['station_id']
+STATION_DICTIONARY = '../input/station_dictionary.json'
+
+_stationDtypes = dict()
+_stationLock = threading.Lock()
+
+
+def compact_mode():
+    """
+    Return True if frames are kept compact in memory, see COMPACT_MEMORY.
+    """
+    return os.environ.get('COMPACT_MEMORY', '1') != '0'
+
+
+def station_dtype(stations=()):
+    """
+    Return the categorical dtype of station_id shared by all stages.
+
+    The dictionary is saved at STATION_DICTIONARY (environment variable, default: '../input/station_dictionary.json')
+    and extended with stations it does not know yet. Its categories are kept sorted, so sorting by the
+    codes gives the same order as sorting by the names.
+
+    params: stations: iterable of string, the stations to be encoded
+    return: pandas.CategoricalDtype
+    """
+    path = os.environ.get('STATION_DICTIONARY', STATION_DICTIONARY)
+    with _stationLock:
+        if path not in _stationDtypes:
+            known = list()
+            if os.path.isfile(path):
+                with open(path) as f:
+                    known = json.load(f)
+            _stationDtypes[path] = pd.CategoricalDtype(known)
+        dtype = _stationDtypes[path]
+        new = {station for station in stations if not pd.isna(station)} - set(dtype.categories)
+        if new:
+            dtype = pd.CategoricalDtype(sorted(set(dtype.categories) | new))
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(dtype.categories.tolist(), f, indent=1)
+            os.replace(path + '.tmp', path)
+            _stationDtypes[path] = dtype
+    return dtype
+
+
+def encode_stations(values):
+    """
+    Encode station ids with the shared dictionary.
+
+    params: values: Series of string or categorical
+    return: Series, categorical with station_dtype()
+    """
+    stations = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.unique(values)
+    return values.astype(station_dtype(stations))
+
+
+def apply_schema(df):
+    """
+    Convert a dataframe to the storage schema.
+
+    utc_time -> datetime64[ns], station_id -> station_dtype(), other strings -> category, float64 -> float32.
+
+    params: df: DataFrame
+    return: df: DataFrame
+    """
+    columns = dict()
+    for col in df.columns:
+        values = df[col]
+        if col in TIME_COLUMNS:
+            values = pd.to_datetime(values).astype('datetime64[ns]')
+        elif col in CATEGORY_COLUMNS:
+            values = encode_stations(values)
+        elif values.dtype == object or pd.api.types.is_string_dtype(values):
+            values = values.astype('category')
+        elif values.dtype == np.float64:
+            values = values.astype(np.float32)
+        columns[col] = values.values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_schema(df):
+    """
+    Convert a dataframe in the storage schema to the in-memory representation of compact_mode().
+
+    Compact frames get station_id in the shared dictionary and float32 values, converted in place.
+    Otherwise categories become strings, floats float64 and ints int64.
+
+    params: df: DataFrame
+    return: df: DataFrame
+    """
+    if compact_mode():
+        for col in df.columns:
+            if col in CATEGORY_COLUMNS and df[col].dtype != station_dtype():
+                df[col] = encode_stations(df[col])
+            elif df[col].dtype == np.float64:
+                df[col] = df[col].astype(np.float32)
+        return df
+    columns = dict()
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        elif pd.api.types.is_float_dtype(values):
+            values = values.astype(np.float64)
+        elif pd.api.types.is_integer_dtype(values):
+            values = values.astype(np.int64)
+        columns[col] = values.values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_usage(df):
+    """
+    Return the memory of a dataframe in bytes, including strings.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _write_columnar(df, path):
+    df = apply_schema(df)
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    schema = {'rows': len(df), 'columns': list()}
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        entry = {'name': col, 'file': '{}.npy'.format(i)}
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            entry['dtype'] = 'category'
+            entry['categories'] = values.cat.categories.tolist()
+            np.save(os.path.join(tmp, entry['file']), values.cat.codes.values)
+        else:
+            entry['dtype'] = str(values.dtype)
+            np.save(os.path.join(tmp, entry['file']), values.values)
+        schema['columns'].append(entry)
+    with open(os.path.join(tmp, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent=1)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def _read_columnar(path, columns=None):
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+
+    data = dict()
+    for entry in schema['columns']:
+        if columns is not None and entry['name'] not in columns:
+            continue
+        values = np.load(os.path.join(path, entry['file']), mmap_mode='r')
+        if entry['dtype'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=entry['categories'])
+        data[entry['name']] = values
+    if columns is not None:
+        data = {col: data[col] for col in columns if col in data}
+    return pd.DataFrame(data, copy=False)
+
+
+def _iter_columnar(path, rows, columns=None):
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    entries = [entry for entry in schema['columns'] if columns is None or entry['name'] in columns]
+    arrays = [np.load(os.path.join(path, entry['file']), mmap_mode='r') for entry in entries]
+    for start in range(0, schema['rows'], rows):
+        data = dict()
+        for entry, values in zip(entries, arrays):
+            # copy the slice, so only one chunk is resident
+            values = np.array(values[start:start + rows])
+            if entry['dtype'] == 'category':
+                values = pd.Categorical.from_codes(values, categories=entry['categories'])
+            data[entry['name']] = values
+        yield pd.DataFrame(data, copy=False)
+
+
+def _take_columnar(path, positions, columns=None):
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    data = dict()
+    for entry in schema['columns']:
+        if columns is not None and entry['name'] not in columns:
+            continue
+        # only the pages of the positions are read from the memory map
+        values = np.load(os.path.join(path, entry['file']), mmap_mode='r')[positions]
+        if entry['dtype'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=entry['categories'])
+        data[entry['name']] = values
+    if columns is not None:
+        data = {col: data[col] for col in columns if col in data}
+    return pd.DataFrame(data, copy=False)
+
+
+def _rows_columnar(path):
+    with open(os.path.join(path, 'schema.json')) as f:
+        return json.load(f)['rows']
+
+
+NPY_HEADERS = {
+    (1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+    (2, 0): (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0),
+}
+
+
+def _append_columnar(df, path):
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    if [entry['name'] for entry in schema['columns']] != list(df.columns):
+        raise ValueError('Columns to append differ from {}'.format(path))
+    df = apply_schema(df)
+
+    for entry in schema['columns']:
+        values = df[entry['name']]
+        if entry['dtype'] == 'category':
+            # new categories are added at the end, so the stored codes stay valid
+            entry['categories'] += [c for c in values.cat.categories if c not in entry['categories']]
+            values = pd.Categorical(values, categories=entry['categories']).codes
+        else:
+            values = values.values
+        with open(os.path.join(path, entry['file']), 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            read_header, write_header = NPY_HEADERS[version]
+            shape, fortran, dtype = read_header(f)
+            end = f.tell()
+            values = np.ascontiguousarray(values, dtype=dtype)
+            f.seek(0)
+            # np.save leaves room in the header for the row count to grow in place
+            write_header(f, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                             'shape': (shape[0] + len(values),)})
+            if f.tell() != end:
+                raise ValueError('No room to grow the header of {}'.format(f.name))
+            f.seek(0, os.SEEK_END)
+            f.write(values.tobytes())
+    schema['rows'] += len(df)
+    with open(os.path.join(path, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent=1)
+
+
+def _update_columnar(path, column, positions, values):
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    entry = [entry for entry in schema['columns'] if entry['name'] == column][0]
+    stored = np.load(os.path.join(path, entry['file']), mmap_mode='r+')
+    stored[positions] = values
+    stored.flush()
+
+
+def _write_csv(df, path):
+    df.to_csv(path, index=False)
+
+
+def _read_csv(path, columns=None):
+    df = pd.read_csv(path, usecols=columns)
+    for col in TIME_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def _iter_csv(path, rows, columns=None):
+    for df in pd.read_csv(path, usecols=columns, chunksize=rows):
+        for col in TIME_COLUMNS:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+        yield df
+
+
+def _append_csv(df, path):
+    df.to_csv(path, index=False, header=False, mode='a')
+
+
+def _take_csv(path, positions, columns=None):
+    return _read_csv(path, columns).iloc[positions].reset_index(drop=True)
+
+
+def _rows_csv(path):
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def _update_csv(path, column, positions, values):
+    df = pd.read_csv(path)
+    df.loc[df.index[positions], column] = values
+    df.to_csv(path, index=False)
+
+
+FORMATS = {
+    'columnar': ('.cols', _write_columnar, _read_columnar, _append_columnar, _update_columnar, _iter_columnar,
+                 _take_columnar, _rows_columnar),
+    'csv': ('.csv', _write_csv, _read_csv, _append_csv, _update_csv, _iter_csv, _take_csv, _rows_csv),
+}
+
+
+def storage_format(fmt=None):
+    """
+    Return the format name, default: environment variable STORAGE_FORMAT or 'columnar'.
+    """
+    fmt = fmt or os.environ.get('STORAGE_FORMAT', 'columnar')
+    if fmt not in FORMATS:
+        raise ValueError('Unknown storage format: {}, options: {}'.format(fmt, list(FORMATS)))
+    return fmt
+
+
+def write_frame(df, path, fmt=None):
+    """
+    Save a stage output.
+
+    params: df: DataFrame
+    params: path: string, the output path without extension
+    params: fmt: string, options: ['columnar', 'csv'], default: storage_format()
+    return: string, the path written
+    """
+    suffix, write = FORMATS[storage_format(fmt)][:2]
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with span('write_frame', path=path, rows_in=len(df)) as sp:
+        write(df, path + suffix)
+        if enabled():
+            sp.add(bytes_written=stored_bytes(path + suffix))
+    return path + suffix
+
+
+def find_frame(path):
+    """
+    Return the stored path of a stage output in any format, or None if not found.
+
+    The configured format is looked up first.
+    """
+    first = storage_format()
+    for fmt in [first] + [f for f in FORMATS if f != first]:
+        if os.path.exists(path + FORMATS[fmt][0]):
+            return path + FORMATS[fmt][0]
+    return None
+
+
+def frame_exists(path):
+    return find_frame(path) is not None
+
+
+def stored_bytes(found, columns=None):
+    """
+    Return the size of a stored frame on disk, or of some of its columns in the columnar format.
+
+    params: found: string, the stored path, see find_frame()
+    params: columns: list of string, default: all
+    return: int
+    """
+    if not os.path.isdir(found):
+        return os.path.getsize(found)
+    names = os.listdir(found)
+    if columns is not None and 'schema.json' in names:
+        with open(os.path.join(found, 'schema.json')) as f:
+            names = [entry['file'] for entry in json.load(f)['columns'] if entry['name'] in columns]
+    return sum(os.path.getsize(os.path.join(found, name)) for name in names)
+
+
+def read_frame(path, columns=None):
+    """
+    Load a stage output, whichever format it was saved in.
+
+    params: path: string, the output path without extension
+    params: columns: list of string, only load these columns, default: all
+    return: DataFrame, utc_time is parsed as datetime, see memory_schema() for the other types
+    """
+    found = find_frame(path)
+    if found is None:
+        raise FileNotFoundError('No stored frame at {}'.format(path))
+    with span('read_frame', path=path) as sp:
+        df = memory_schema(_format_of(path, found)[2](found, columns))
+        if enabled():
+            sp.add(bytes_read=stored_bytes(found, columns)).set(rows_out=len(df))
+    return df
+
+
+def read_rows(path, positions, columns=None):
+    """
+    Load the rows of a stage output at some positions, e.g. the stored rows of some keys (see key_index.py).
+
+    The columnar format only reads the rows at the positions; the csv format is parsed whole.
+
+    params: path: string, the output path without extension
+    params: positions: 1-d numpy array of int
+    params: columns: list of string, only load these columns, default: all
+    return: DataFrame, in the order of positions, see memory_schema() for the types
+    """
+    found = find_frame(path)
+    if found is None:
+        raise FileNotFoundError('No stored frame at {}'.format(path))
+    with span('read_rows', path=path, rows_in=len(positions)):
+        return memory_schema(_format_of(path, found)[6](found, positions, columns))
+
+
+def frame_rows(path):
+    """
+    Return the number of rows of a stage output, without loading it (the columnar format reads its schema).
+
+    params: path: string, the output path without extension
+    return: int
+    """
+    found = find_frame(path)
+    if found is None:
+        raise FileNotFoundError('No stored frame at {}'.format(path))
+    return _format_of(path, found)[7](found)
+
+
+def _format_of(path, found):
+    for suffix, *functions in FORMATS.values():
+        if found == path + suffix:
+            return [suffix] + functions
+
+
+def iter_frame(path, rows, columns=None):
+    """
+    Load a stage output in chunks of rows, in the stored order.
+
+    params: path: string, the output path without extension
+    params: rows: int, the number of rows per chunk
+    params: columns: list of string, only load these columns, default: all
+    return: generator of DataFrame, see memory_schema() for the types
+    """
+    found = find_frame(path)
+    if found is None:
+        raise FileNotFoundError('No stored frame at {}'.format(path))
+    chunks = _format_of(path, found)[5](found, rows, columns)
+    while True:
+        with span('read_chunk', path=path) as sp:
+            df = next(chunks, None)
+            if df is None:
+                break
+            df = memory_schema(df)
+            sp.set(rows_out=len(df))
+        yield df
+
+
+def chunk_rows(memoryLimit, bytesPerRow, minimum=1000):
+    """
+    Return the number of rows per chunk, so that the rows being processed fit in a memory limit.
+
+    params: memoryLimit: float, in MB, default of the callers: environment variable MEMORY_LIMIT_MB or 512
+    params: bytesPerRow: int, the estimated memory of a row, including intermediate copies
+    params: minimum: int
+    return: int
+    """
+    return max(minimum, int(memoryLimit * 2**20 // bytesPerRow))
+
+
+def memory_limit():
+    """
+    Return the memory limit of the streaming mode in MB, environment variable MEMORY_LIMIT_MB or 512.
+    """
+    return float(os.environ.get('MEMORY_LIMIT_MB', 512))
+
+
+def append_frame(df, path):
+    """
+    Append rows to a stage output in place, or save it if it does not exist.
+
+    params: df: DataFrame, with the same columns as the stored output
+    params: path: string, the output path without extension
+    return: None
+    """
+    found = find_frame(path)
+    if found is None:
+        write_frame(df, path)
+        return
+    with span('append_frame', path=path, rows_in=len(df)) as sp:
+        before = stored_bytes(found) if enabled() else 0
+        _format_of(path, found)[3](df, found)
+        if enabled():
+            sp.add(bytes_written=stored_bytes(found) - before)
+
+
+def update_column(path, column, positions, values):
+    """
+    Overwrite the values of a column at some row positions in place.
+
+    params: path: string, the output path without extension
+    params: column: string
+    params: positions: 1-d numpy array of int
+    params: values: 1-d numpy array, the same length as positions
+    return: None
+    """
+    found = find_frame(path)
+    with span('update_column', path=path, column=column, rows_in=len(positions)):
+        _format_of(path, found)[4](found, column, positions, values)
+
+
+def export_csv(path, csvPath=None, compression='infer'):
+    """
+    Export a stage output as CSV.
+
+    params: path: string, the output path without extension
+    params: csvPath: string, default: path + '.csv'
+    params: compression: string, see DataFrame.to_csv
+    return: string, the path of the CSV file
+    """
+    csvPath = csvPath or path + '.csv'
+    read_frame(path).to_csv(csvPath, index=False, compression=compression)
+    return csvPath
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('Usage: python3 storage.py <stage output path without extension> [csv path]')
+        sys.exit(1)
+    print('Exported: {}'.format(export_csv(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)))
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Nested timing spans of the pipeline, e.g. a stage, the functions it calls and the frames it reads and writes.
+
+Tracing is off unless the environment variable TRACE names an output file:
+    TRACE=../trace.jsonl python3 run.py
+
+A span records its duration, input and output rows, bytes read and written, and the
+change of the resident memory (rss_delta_mb). Spans nest within a thread; a span opened
+in another thread (e.g. a stage run by dag.Pipeline) names its parent explicitly.
+Memory is per process, so spans running concurrently share their memory figures.
+
+Environment variables:
+    TRACE:                the output file
+    TRACE_FORMAT:         'jsonl' (default), one span per line when it ends,
+                          or 'chrome', a trace written at exit for chrome://tracing or Perfetto
+    TRACE_MEMORY=1:       also record the peak of the traced allocations above the start of each span
+                          (peak_mb, numpy included), which slows the pipeline down
+    TRACE_PROFILE=secs:   run the outermost spans of each thread under cProfile, and attach the top
+                          functions by own time to those lasting at least secs, with the full stats
+                          in '{TRACE}.{span id}.prof' (e.g. for snakeviz or pstats)
+
+When tracing is off, span() returns a shared object which does nothing and traced()
+calls the function directly, so the instrumentation can stay in place.
+
+Usage:
+    from tracing import span, traced
+
+    @traced()
+    def label_data(df, target): ...
+
+    with span('read_multiple_csv', files=len(files)) as sp:
+        sp.add(bytes_read=size)
+
+@author: Stephen
+"""
+
+import os
+import io
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import pandas as pd
+
+PROFILE_FUNCTIONS = 15
+
+_tracer = None
+
+
+class _NoSpan(object):
+    """
+    The span of disabled tracing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        return self
+
+    def add(self, **counts):
+        return self
+
+
+NO_SPAN = _NoSpan()
+
+
+def _rss_bytes():
+    """
+    Return the resident memory of the process in bytes, or 0 where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class Span(object):
+    """
+    A timed block of the pipeline.
+
+    params: tracer: Tracer
+    params: name: string
+    params: attrs: dict, attributes of the span, e.g. rows_in or the stage parameters
+    """
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.counts = dict()
+        self.origin = None
+        self.profiled = True
+
+    def set(self, **attrs):
+        """
+        Set attributes, e.g. rows_out.
+        """
+        self.attrs.update(attrs)
+        return self
+
+    def add(self, **counts):
+        """
+        Add to counters, e.g. bytes_read.
+        """
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        return self
+
+    def __enter__(self):
+        tracer = self.tracer
+        stack = tracer.stack()
+        self.id = tracer.next_id()
+        self.parent = stack[-1].id if stack else (self.origin.id if self.origin is not None else None)
+        self.thread = threading.get_ident()
+        self.profile = None
+        if tracer.profileSeconds is not None and self.profiled and not stack:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # another thread is being profiled
+                self.profile = None
+        if tracer.memory:
+            # the peak so far belongs to the open spans, before it is reset for this one
+            peak = tracemalloc.get_traced_memory()[1]
+            for open_span in stack:
+                open_span.peak = max(open_span.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+            self.peak = self.base
+        stack.append(self)
+        self.rss = _rss_bytes()
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        duration = time.perf_counter() - self.start
+        tracer = self.tracer
+        if self.profile is not None:
+            self.profile.disable()
+        stack = tracer.stack()
+        stack.pop()
+
+        record = {'name': self.name, 'id': self.id, 'parent': self.parent, 'pid': os.getpid(), 'thread': self.thread,
+                  'start': self.wall, 'duration': duration, 'rss_delta_mb': (_rss_bytes() - self.rss) / 2**20}
+        if tracer.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (self.peak - self.base) / 2**20
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        record.update(self.counts)
+        record.update(self.attrs)
+        if excType is not None:
+            record['error'] = repr(exc)
+        if self.profile is not None and duration >= tracer.profileSeconds:
+            record['profile'] = tracer.save_profile(self.profile, self.id)
+        tracer.emit(record)
+        return False
+
+
+class Tracer(object):
+    """
+    Collect the spans of a process and write them.
+
+    params: path: string, the output file
+    params: fmt: string, options: ['jsonl', 'chrome']
+    params: memory: bool, trace the peak memory of spans by tracemalloc
+    params: profileSeconds: float, profile the outermost spans, None to not profile
+    """
+    def __init__(self, path, fmt='jsonl', memory=False, profileSeconds=None):
+        if fmt not in ('jsonl', 'chrome'):
+            raise ValueError('Unknown trace format: {}, options: jsonl, chrome'.format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.memory = memory
+        self.profileSeconds = profileSeconds
+        self.events = list()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.count = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'a') if fmt == 'jsonl' else None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = list()
+        return self.local.stack
+
+    def next_id(self):
+        with self.lock:
+            self.count += 1
+            return '{}-{}'.format(os.getpid(), self.count)
+
+    def emit(self, record):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, default=str) + '\n')
+                self.file.flush()
+            else:
+                args = {key: value for key, value in record.items()
+                        if key not in ('name', 'pid', 'thread', 'start', 'duration')}
+                self.events.append({'name': record['name'], 'ph': 'X', 'pid': record['pid'], 'tid': record['thread'],
+                                    'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6,
+                                    'args': args})
+
+    def save_profile(self, profile, spanId):
+        """
+        Save the stats of a profiled span, and return its top functions by their own time.
+        """
+        profile.dump_stats('{}.{}.prof'.format(self.path, spanId))
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_FUNCTIONS]
+        return [{'function': '{}:{}({})'.format(os.path.basename(filename), line, function),
+                 'calls': calls, 'tottime': round(tottime, 6), 'cumtime': round(cumtime, 6)}
+                for (filename, line, function), (primitive, calls, tottime, cumtime, callers) in top]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            elif self.events:
+                with open(self.path, 'w') as f:
+                    json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f, default=str)
+                self.events = list()
+
+
+def enable(path, fmt='jsonl', memory=False, profileSeconds=None):
+    """
+    Start tracing into a file, e.g. from a script instead of the environment variables.
+
+    params: see Tracer
+    return: Tracer
+    """
+    global _tracer
+    disable()
+    _tracer = Tracer(path, fmt, memory, profileSeconds)
+    return _tracer
+
+
+def disable():
+    """
+    Stop tracing and write the spans.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, parent=None, profile=True, **attrs):
+    """
+    Return a span to be used as a context manager.
+
+    params: name: string
+    params: parent: Span, the parent of a span opened in another thread, default: the innermost open span of the thread
+    params: profile: bool, False to not profile the span, e.g. when it waits for other threads
+    params: attrs: attributes of the span
+    return: Span, or NO_SPAN when tracing is off
+    """
+    if _tracer is None:
+        return NO_SPAN
+    sp = Span(_tracer, name, attrs)
+    sp.origin = parent if isinstance(parent, Span) else None
+    sp.profiled = profile
+    return sp
+
+
+def current():
+    """
+    Return the innermost open span of the thread, or NO_SPAN, e.g. to add the bytes read by a helper.
+    """
+    if _tracer is None:
+        return NO_SPAN
+    stack = _tracer.stack()
+    return stack[-1] if stack else NO_SPAN
+
+
+def rows(value):
+    """
+    Count the rows of DataFrames in a value, or in a tuple or list of values. None if there is none.
+    """
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        counts = [len(v) for v in value if isinstance(v, pd.DataFrame)]
+        return sum(counts) if counts else None
+    return None
+
+
+def traced(name=None):
+    """
+    Decorate a function to run in a span, with the rows of its DataFrame arguments and results.
+
+    params: name: string, default: the function name
+    return: decorator
+    """
+    def decorator(func):
+        spanName = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, spanName, dict()) as sp:
+                rowsIn = rows(list(args) + list(kwargs.values()))
+                if rowsIn is not None:
+                    sp.set(rows_in=rowsIn)
+                result = func(*args, **kwargs)
+                rowsOut = rows(result)
+                if rowsOut is not None:
+                    sp.set(rows_out=rowsOut)
+                return result
+        return wrapper
+    return decorator
+
+
+def from_environment(suffix=None):
+    """
+    Start tracing as configured by the environment variables, if TRACE is set.
+
+    params: suffix: string, added to the file name, e.g. to trace worker processes into their own files
+    return: Tracer, or None
+    """
+    path = os.environ.get('TRACE')
+    if not path:
+        return None
+    profile = os.environ.get('TRACE_PROFILE')
+    return enable('{}.{}'.format(path, suffix) if suffix else path, os.environ.get('TRACE_FORMAT', 'jsonl'),
+                  os.environ.get('TRACE_MEMORY', '0') == '1', float(profile) if profile else None)
+
+
+from_environment()
+atexit.register(disable)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+"""
+Validity bitmaps of the measurements, so that missing readings are told apart from real zeros.
+
+The integrated frames fill missing values with 0 (see data_integration.py), and record which
+values were read in one validity column: an unsigned int per row, where bit j is set when the
+j-th column of MASKED was observed. The bit of a column is fixed by MASKED, not by the columns of
+a frame, so the bitmap survives selecting, sorting, concatenating and storing rows like any column.
+It takes 2 bytes per row for all the measurements and weather columns, as float32 in stored features.
+
+The imputed values (see imputation.py) are valid, and also marked in an imputed column of the same
+layout, so that the observations can still be told apart, e.g. to create labels from them only.
+
+A row without a bitmap (NaN in the validity column, or a frame without it, e.g. the empty testing rows)
+falls back to the non-null values.
+
+@author: Stephen
+"""
+
+import numpy as np
+import pandas as pd
+
+VALIDITY = 'validity'
+IMPUTED = 'imputed'
+MASKED = ['PM2.5', 'PM10', 'NO2', 'CO', 'O3', 'SO2',
+          'temperature', 'pressure', 'humidity', 'wind_direction', 'wind_speed']
+BITMAP_DTYPE = np.uint16
+
+
+def validity_bits(df, columns=None):
+    """
+    Return the validity bitmap of the rows: the bits of the non-null values of the masked columns.
+
+    params: df: DataFrame
+    params: columns: list of string, the columns observed, default: the masked columns of df
+    return: numpy array of BITMAP_DTYPE
+    """
+    columns = [col for col in MASKED if col in df.columns] if columns is None else columns
+    bits = np.zeros(len(df), dtype=BITMAP_DTYPE)
+    for col in columns:
+        bits |= pd.notna(df[col].values).astype(BITMAP_DTYPE) << MASKED.index(col)
+    return bits
+
+
+def add_validity(df):
+    """
+    Add the validity column of the values read, before their missing values are filled.
+
+    params: df: DataFrame
+    return: DataFrame
+    """
+    return df.assign(**{VALIDITY: validity_bits(df)})
+
+
+def validity_columns(df):
+    """
+    Return the validity column of a frame if it has one, to be selected with its values.
+    """
+    return [VALIDITY] if VALIDITY in df.columns else []
+
+
+def _bit(df, bitmap, column):
+    """
+    Return the bit of a column in a bitmap column, and whether the row has a bitmap.
+    """
+    bits = df[bitmap].values
+    known = pd.notna(bits)
+    if bits.dtype.kind == 'f':
+        bits = np.where(known, bits, 0).astype(np.int64)
+    return ((bits.astype(np.int64) >> MASKED.index(column)) & 1).astype(bool), known
+
+
+def valid_mask(df, column, observed=False):
+    """
+    Return where the values of a column are valid.
+
+    params: df: DataFrame
+    params: column: string
+    params: observed: bool, True to leave out the imputed values
+    return: numpy array of bool
+    """
+    notnull = pd.notna(df[column].values)
+    if VALIDITY not in df.columns or column not in MASKED:
+        return notnull
+    valid, known = _bit(df, VALIDITY, column)
+    mask = np.where(known, valid & notnull, notnull)
+    if observed and IMPUTED in df.columns:
+        imputed, known = _bit(df, IMPUTED, column)
+        mask &= ~(imputed & known)
+    return mask
+
+
+def with_missing(df, columns, observed=False):
+    """
+    Return the frame with the values which are not valid as NaN, e.g. for the kernels which mask NaN.
+
+    params: df: DataFrame
+    params: columns: list of string
+    params: observed: bool, True to also set the imputed values to NaN
+    return: DataFrame, a copy if any value is set to NaN
+    """
+    missing = dict()
+    for col in columns:
+        mask = valid_mask(df, col, observed)
+        if not mask.all():
+            values = df[col].values
+            missing[col] = np.where(mask, values, np.nan).astype(values.dtype if values.dtype.kind == 'f' else np.float64)
+    return df.assign(**missing) if missing else df
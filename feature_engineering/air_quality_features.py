@@ -9,95 +9,310 @@ Conclusion:
     PM2.5: window_size = 1-3 days, stats = mean, std, median, max, min
     PM10: window_size = 1-3 days, stat = mean, std, median, max, min
 
+rolling_stats() computes all windows and stats in one sorted pass per station:
+mean and std come from cumulative sums, median, max and min from sorted sliding windows.
+Values <= 0 are treated as null, except for max. Missing values are read from the validity
+bitmap of the labeled data, which is kept in the features as a column and left out when merging.
+The label validity bitmaps ({target}_label_validity) are kept with the labels up to all_features,
+unset in the testing rows.
+
+The features are declared in feature_registry.py, where other windows, lags and exponentially
+weighted means can be added, e.g. air_quality_features(..., features=default_features(['PM2.5'])
++ lag_features(['PM2.5'])). The compute cost of each feature of the default set, the lags
+of 1-48 hours and the ewm of 6 hours and 1 day is printed by:
+    python3 -u ./air_quality_features.py costs
+
+The cumulative sums restart at every 7-day block (BLOCK_HOURS), so a row's stats only
+depend on the rows since the start of the block before it. That is what the incremental
+mode keeps as per-station state to extend the features exactly:
+    python3 -u ./air_quality_features.py incremental
+
+The stream mode reads the historical data in chunks within MEMORY_LIMIT_MB (default: 512),
+carrying the same tail from chunk to chunk, and then adds the live data incrementally:
+    python3 -u ./air_quality_features.py stream
+
+The cities named in the arguments get their features (default: london), e.g.
+    python3 -u ./air_quality_features.py beijing incremental
+
+Multi-target mode features all the measurements of a city (NO2 included) in one pass,
+from the wide labeled frames of create_label.py multi, into {featurePath}/{train,test}/air_quality_features:
+    python3 -u ./air_quality_features.py multi
+
 @author: Stephen, Ray
 '''
 
 import numpy as np
 import pandas as pd
-from datetime import datetime, date, timedelta
-import itertools
-import utils
+from datetime import datetime
+from utils import submission_days, test_frame, station_watermark, split_at_watermark, update_labels, revised_rows
+from storage import read_frame, write_frame, frame_exists, append_frame, iter_frame, chunk_rows, memory_limit
+from create_label import target_list, label_validity_columns, HORIZONS
+from tracing import traced
+from cities import get_city, city_arguments, multi_target
+from feature_registry import WINDOWS, STATS, BLOCK_HOURS, window_width, default_features, lag_features, ewm_features
+from feature_registry import FeaturePlan
+from validity import validity_columns
 import sys
 
-if __name__ == "__main__":
-    # =====================
-    # Read Air Quality data
-    # =====================
-    # PM2.5 air quality data
-    PM25_hist_data = pd.read_csv('../input/london/london_PM25_hist_data_w_label.csv')
-    PM25_live_data = pd.read_csv('../input/london/london_PM25_live_data_w_label.csv')
-    PM25_data = pd.concat([PM25_hist_data, PM25_live_data])
-    PM25_data = PM25_data.drop(['latitude', 'longitude', 'PM10', 'NO2'], axis=1)
-    del PM25_hist_data, PM25_live_data
-
-    # PM10 air quality data
-    PM10_hist_data = pd.read_csv('../input/london/london_PM10_hist_data_w_label.csv')
-    PM10_live_data = pd.read_csv('../input/london/london_PM10_live_data_w_label.csv')
-    PM10_data = pd.concat([PM10_hist_data, PM10_live_data])
-    PM10_data = PM10_data.drop(['latitude', 'longitude', 'PM2.5', 'NO2'], axis=1)
-    del PM10_hist_data, PM10_live_data
-
-    # convert utc_time to datetime type
-    PM25_data['utc_time'] = pd.to_datetime(PM25_data.utc_time)
-    PM10_data['utc_time'] = pd.to_datetime(PM10_data.utc_time)
-
-    # check time period
-    print('PM25 training data starts from {} to {}'.format(PM25_data['utc_time'].min(), PM25_data['utc_time'].max()))
-    print('PM10 training data starts from {} to {}'.format(PM10_data['utc_time'].min(), PM10_data['utc_time'].max()))
-
-    # ======================================================
+
+@traced()
+def rolling_stats(df, air_quality, windows=WINDOWS, features=None):
+    """
+    Generate the rolling window stats (mean, std, median, max, min) of all windows at once.
+
+    The window of a row covers (utc_time - window, utc_time] of its station,
+    the same as pandas' time-based rolling. Several air qualities share the sort
+    and the window bounds of each station, see feature_registry.FeaturePlan.
+
+    params: df: DataFrame, including station_id, utc_time and air_quality columns
+    params: air_quality: string or list of string, e.g. 'PM2.5' or ['PM2.5', 'PM10', 'NO2']
+    params: windows: list of string, time offsets such as ['1d', '2d', '3d']
+    params: features: list of feature_registry.Feature, instead of the stats of windows, e.g. with lags
+    return: df: DataFrame, sorted by station_id and utc_time, with a column per feature, e.g. {air_quality}_{window}_{stat}
+    """
+    if features is None:
+        features = default_features(target_list(air_quality), windows)
+    return FeaturePlan(features).evaluate(df)
+
+
+@traced()
+def air_quality_features(hist_data, live_data, air_quality, submission_day1, features=None):
+    """
+    Generate the air quality features of the training data and the next 48 hours.
+
+    params: hist_data: DataFrame, historical data with labels
+    params: live_data: DataFrame, live data with labels
+    params: air_quality: string or list of string, several air qualities are featured in one pass into wide frames
+    params: submission_day1: datetime.date, the first prediction day
+    params: features: list of feature_registry.Feature, default: the rolling stats of WINDOWS
+    return: (df_train, df_test): DataFrame
+    """
+    targets = target_list(air_quality)
+    sources = [source for source in dict.fromkeys(f.source for f in features or ()) if source not in targets]
+    cols = ['station_id', 'utc_time'] + targets + sources + ['{}_label'.format(target) for target in targets] \
+        + label_validity_columns(live_data, targets) + validity_columns(live_data)
+    df = pd.concat([hist_data, live_data])[cols]
+
     # Append empty rows for testing data (The next two days)
-    # ======================================================
-    if len(sys.argv) > 1:
-        submission_day1 = sys.argv[1]
-        submission_day2 = sys.argv[2]
+    test = test_rows(df.station_id.unique(), submission_day1, label_validity_columns(df, targets))
+    testStartTime = test['utc_time'].min()
+    df = rolling_stats(pd.concat([df, test], axis=0), air_quality, features=features)
+
+    df_train = df[df['utc_time'] < testStartTime]
+    df_test = df[df['utc_time'] >= testStartTime]
+    return df_train, df_test
+
+
+def test_rows(stationId, submission_day1, labelValidity=()):
+    """
+    Create the empty testing rows, with their label validity bitmaps unset, as their labels are unknown.
+
+    params: stationId: iterable of string
+    params: submission_day1: datetime.date, the first prediction day
+    params: labelValidity: list of string, the label validity columns, see create_label.label_validity_columns()
+    return: DataFrame
+    """
+    test = test_frame(stationId, submission_day1)
+    return test.assign(**{col: np.zeros(len(test), dtype=np.uint64) for col in labelValidity})
+
+
+def rolling_tail(df, windows=WINDOWS):
+    """
+    Keep the rows of each station which the windows of its next rows can reach,
+    from the start of the block of (latest utc_time - widest window).
+
+    params: df: DataFrame, including station_id and utc_time columns
+    params: windows: list of string
+    return: DataFrame
+    """
+    blockWidth = pd.Timedelta(hours=BLOCK_HOURS).value
+    times = df['utc_time'].values.astype('datetime64[ns]').astype(np.int64)
+    latest = df.groupby(df['station_id'].astype(object))['utc_time'].transform('max').values.astype('datetime64[ns]').astype(np.int64)
+    keep = times // blockWidth >= (latest - max(window_width(win) for win in windows)) // blockWidth
+    return df[keep]
+
+
+@traced()
+def incremental_air_quality_features(hist_data, live_data, air_quality, submission_day1, featurePath='../feature/london'):
+    """
+    Append the features of the live rows after the last run to the stored training features.
+
+    The state is the rolling tail of each station ({featurePath}/state/{air_quality}_air_quality_tail).
+    Without state, all features are computed as air_quality_features() does.
+    The result equals a full computation, given that the live data only grows after the latest stored hour.
+
+    Live rows of the tail may be revised after they were featured (the duplicate policy 'last' of
+    data_integration.py), which changes the stored stats and labels up to the watermark. They are told
+    by their values in the tail, and all features are then computed again from hist_data, or, without
+    hist_data (e.g. in stream mode), a ValueError is raised. Revisions of rows older than the tail are
+    not detected; delete the state to recompute the features after them.
+
+    params: hist_data: DataFrame, historical data with labels, only read without state or after revisions
+    params: live_data: DataFrame, live data with labels
+    params: air_quality: string, options: ['PM2.5', 'PM10']
+    params: submission_day1: datetime.date, the first prediction day
+    params: featurePath: string, the directory of features
+    return: df_test: DataFrame, the testing features, which are recomputed every run
+    """
+    trainPath = '{}/train/{}/air_quality_features'.format(featurePath, air_quality)
+    testPath = '{}/test/{}/air_quality_features'.format(featurePath, air_quality)
+    statePath = '{}/state/{}_air_quality_tail'.format(featurePath, air_quality)
+    labelNames = ['{}_label'.format(air_quality)] + label_validity_columns(live_data, air_quality)
+    cols = ['station_id', 'utc_time', air_quality] + labelNames + validity_columns(live_data)
+
+    tail = read_frame(statePath) if frame_exists(statePath) and frame_exists(trainPath) else None
+    revised = 0 if tail is None else len(revised_rows(tail, live_data, [air_quality] + validity_columns(live_data)))
+    if revised and hist_data is None:
+        raise ValueError('{} live rows of the state {} were revised since they were featured; '
+                         'compute the features with the historical data, or delete the state'.format(revised, statePath))
+
+    if tail is None or revised:
+        df_train, df_test = air_quality_features(hist_data, live_data, air_quality, submission_day1)
+        write_frame(df_train, trainPath)
+        write_frame(rolling_tail(df_train[cols]), statePath)
     else:
-        today = datetime.date(PM25_data['utc_time'].max())
-        submission_day1 = today + timedelta(days=1)
-        submission_day2 = today + timedelta(days=2)
-
-    testStartTime = datetime(year=submission_day1.year, month=submission_day1.month, day=submission_day1.day)
-    testTime = [testStartTime+timedelta(hours=delta) for delta in range(48)]
-    stationId = PM25_data.station_id.unique()
-    testPair = [(sid, time) for sid in stationId for time in testTime]
-    df = pd.DataFrame(testPair, columns=['station_id', 'utc_time'])
-
-    PM25_data = pd.concat([PM25_data, df], axis=0)[['station_id', 'utc_time', 'PM2.5', 'PM2.5_label']]
-    PM10_data = pd.concat([PM10_data, df], axis=0)[['station_id', 'utc_time', 'PM10', 'PM10_label']]
-
-    # ========================================
-    # Generate Air Quality statistics features
-    # ========================================
-    # Given a station and utc_time, generate air quality stats with rolling windows.
-    # There are 15 features generated in total, combinations from window size: 1-3 days and stats: mean, std, median, max, min.
-
-    d = {'PM2.5': PM25_data, 'PM10': PM10_data}
-    for air_quality in ['PM2.5', 'PM10']:
-        print('Generate {} Features...'.format(air_quality))
-        stats = list()
-        df = d[air_quality]
-        df_group = df.groupby('station_id')
-        df_group_w_null = df.where(df>0, np.nan).groupby('station_id')
-        for win in ['1d', '2d', '3d']:
-            df_mean = df_group_w_null.apply(lambda row: row.set_index('utc_time')[air_quality].rolling(window=win).mean())
-            df_std = df_group_w_null.apply(lambda row: row.set_index('utc_time')[air_quality].rolling(window=win).std())
-            df_median = df_group_w_null.apply(lambda row: row.set_index('utc_time')[air_quality].rolling(window=win).median())
-            
-            # Note: max() and min() return NaN when the first value in the rolling window is NaN.
-            # For max(), keep values(<=0) instead of replacing them with NaN.
-            # For min(), replacing NaN with infinity still cause problems. 
-            df_max = df_group.apply(lambda row: row.set_index('utc_time')[air_quality].rolling(window=win).max())
-            df_min = df_group_w_null.apply(lambda row: row.set_index('utc_time')[air_quality].rolling(window=win).min())
-            
-            df_stat = pd.concat([df_mean, df_std, df_median, df_max, df_min], axis=1).reset_index()
-            prefix = '{}_{}'.format(air_quality, win)
-            df_stat.columns = ['station_id', 'utc_time', prefix+'_mean', prefix+'_std', prefix+'_median', prefix+'_max', prefix+'_min']
-            stats.append(df_stat)
-
-        for i in range(3):
-            df = pd.merge(df, stats[i], on=['station_id','utc_time'], how='left')
-        df = df.sort_values(['station_id', 'utc_time'], axis=0)
-        df_train = df[df['utc_time'] < testStartTime]
+        watermark = station_watermark(tail)
+        # the labels of the rows within the largest horizon before the watermark get the new observations
+        new, boundary = split_at_watermark(live_data[cols], watermark, max(HORIZONS) - 1)
+
+        test = test_rows(sorted(set(watermark) | set(new['station_id'].astype(object))), submission_day1,
+                         label_validity_columns(tail, air_quality))
+        testStartTime = test['utc_time'].min()
+        df = rolling_stats(pd.concat([tail, new, test], axis=0), air_quality)
+        df_new, _ = split_at_watermark(df[df['utc_time'] < testStartTime], watermark)
         df_test = df[df['utc_time'] >= testStartTime]
-        df_train.to_csv('../feature/london/train/{}/air_quality_features.csv'.format(air_quality), index = False)
-        df_test.to_csv('../feature/london/test/{}/air_quality_features.csv'.format(air_quality), index = False)
\ No newline at end of file
+
+        append_frame(df_new, trainPath)
+        update_labels(trainPath, boundary, labelNames)
+        write_frame(rolling_tail(pd.concat([tail, new], axis=0)), statePath)
+
+    write_frame(df_test, testPath)
+    return df_test
+
+
+def stream_air_quality_features(chunks, air_quality, windows=WINDOWS):
+    """
+    Generate the rolling window stats of chunks of data, the same as rolling_stats() on all of them at once.
+
+    The rows of a station must come in time order across chunks. The rolling tail
+    of each station is carried to the next chunk.
+
+    params: chunks: iterable of DataFrame, including station_id, utc_time and air_quality columns
+    params: air_quality: string, options: ['PM2.5', 'PM10']
+    params: windows: list of string
+    return: generator of DataFrame, the rows of each chunk with their stats, sorted by station_id and utc_time
+    """
+    tail = None
+    for chunk in chunks:
+        if tail is None:
+            yield rolling_stats(chunk, air_quality, windows)
+            tail = rolling_tail(chunk, windows)
+            continue
+        watermark = station_watermark(tail)
+        new, boundary = split_at_watermark(chunk, watermark)
+        if len(boundary) or len(new) < len(chunk):
+            raise ValueError('Rows of a station are not in time order across chunks; sort by station_id and utc_time first')
+        df = rolling_stats(pd.concat([tail, chunk], axis=0), air_quality, windows)
+        yield split_at_watermark(df, watermark)[0]
+        tail = rolling_tail(pd.concat([tail, chunk], axis=0), windows)
+
+
+@traced()
+def streaming_air_quality_features(live_data, air_quality, submission_day1, featurePath='../feature/london',
+                                   inputPath=None, memoryLimit=None, city='london'):
+    """
+    Generate the air quality features with the historical data read in chunks within a memory limit.
+
+    The historical features are written chunk by chunk, and their rolling tail is saved as
+    the state of incremental_air_quality_features(), which then adds the live data.
+
+    params: live_data: DataFrame, live data with labels
+    params: air_quality: string, options: ['PM2.5', 'PM10']
+    params: submission_day1: datetime.date, the first prediction day
+    params: featurePath: string, the directory of features
+    params: inputPath: string, the directory of the labeled historical data, default: ../input/{city}
+    params: memoryLimit: float, in MB, default: memory_limit()
+    params: city: string, see cities.py
+    return: df_test: DataFrame, the testing features
+    """
+    histPath = get_city(city).label_frame(air_quality, 'hist', inputPath)
+    trainPath = '{}/train/{}/air_quality_features'.format(featurePath, air_quality)
+    statePath = '{}/state/{}_air_quality_tail'.format(featurePath, air_quality)
+    cols = ['station_id', 'utc_time', air_quality, '{}_label'.format(air_quality)] \
+        + label_validity_columns(live_data, air_quality) + validity_columns(live_data)
+
+    # the columns and stats in float64, the sliding windows, and the copies of concatenation and sorting
+    bytesPerRow = 4 * 8 * (len(cols) + len(WINDOWS) * (len(STATS) + 2))
+    rows = chunk_rows(memoryLimit or memory_limit(), bytesPerRow)
+    tail = None
+    # the chunks come in the stored column order, the appended live rows in the order of cols
+    chunks = (chunk[cols] for chunk in iter_frame(histPath, rows, columns=cols))
+    for df in stream_air_quality_features(chunks, air_quality):
+        if tail is None:
+            write_frame(df, trainPath)
+            tail = rolling_tail(df[cols])
+        else:
+            append_frame(df, trainPath)
+            tail = rolling_tail(pd.concat([tail, df[cols]], axis=0))
+    if tail is not None:
+        write_frame(tail, statePath)
+    return incremental_air_quality_features(None, live_data, air_quality, submission_day1, featurePath)
+
+
+if __name__ == "__main__":
+
+    for city in map(get_city, city_arguments()):
+        if multi_target():
+            hist_data, live_data = read_frame(city.labels_frame('hist')), read_frame(city.labels_frame('live'))
+            submission_day1, submission_day2 = submission_days(datetime.date(live_data['utc_time'].max()))
+            print('Generate {} Features...'.format(city.measurements))
+            df_train, df_test = air_quality_features(hist_data, live_data, city.measurements, submission_day1)
+            write_frame(df_train, '{}/train/air_quality_features'.format(city.featurePath))
+            write_frame(df_test, '{}/test/air_quality_features'.format(city.featurePath))
+            continue
+
+        # =====================
+        # Read Air Quality data
+        # =====================
+        # in stream mode, the historical data is only read in chunks
+        histColumns = ['utc_time'] if 'stream' in sys.argv else None
+        d = {target: (read_frame(city.label_frame(target, 'hist'), columns=histColumns),
+                      read_frame(city.label_frame(target, 'live'))) for target in city.pollutants}
+
+        # check time period
+        for target, (hist_data, live_data) in d.items():
+            print('{} {} training data starts from {} to {}'.format(
+                city.name.title(), target, hist_data['utc_time'].min(), live_data['utc_time'].max()))
+
+        # ======================================================
+        # Append empty rows for testing data (The next two days)
+        # ======================================================
+        first = d[list(d)[0]][1]
+        submission_day1, submission_day2 = submission_days(datetime.date(first['utc_time'].max()))
+
+        # ========================================
+        # Generate Air Quality statistics features
+        # ========================================
+        # Given a station and utc_time, generate air quality stats with rolling windows.
+        # There are 15 features generated in total, combinations from window size: 1-3 days and stats: mean, std, median, max, min.
+
+        for air_quality in city.pollutants:
+            if 'costs' in sys.argv:
+                plan = FeaturePlan(default_features([air_quality]) + lag_features([air_quality]) + ewm_features([air_quality]))
+                plan.evaluate(pd.concat(d[air_quality])[['station_id', 'utc_time', air_quality]])
+                report = plan.report()
+                print('{} {} feature costs: {:.2f} secs in total'.format(city.name.title(), air_quality, report['seconds'].sum()))
+                print(report.groupby('operator', sort=False)['seconds'].sum().to_string())
+                print(report.head(15).to_string())
+                continue
+            print('Generate {} Features...'.format(air_quality))
+            if 'stream' in sys.argv:
+                streaming_air_quality_features(d[air_quality][1], air_quality, submission_day1, city.featurePath,
+                                               city=city.name)
+                continue
+            if 'incremental' in sys.argv:
+                incremental_air_quality_features(*d[air_quality], air_quality, submission_day1, city.featurePath)
+                continue
+            df_train, df_test = air_quality_features(*d[air_quality], air_quality, submission_day1)
+            write_frame(df_train, '{}/train/{}/air_quality_features'.format(city.featurePath, air_quality))
+            write_frame(df_test, '{}/test/{}/air_quality_features'.format(city.featurePath, air_quality))
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+Backtest datasets: the testing features of many forecast origins in one pass.
+
+A forecast origin is a first prediction day: its testing rows are every station by the 48 hours
+from its midnight, with the rolling stats of air_quality_features.py computed only from the
+observations before it, as if the pipeline had run on that day. Rerunning the pipeline per origin
+would sort and roll the whole history again for each of them; here the history is read once, and
+the cumulative sums of every station are computed once over it, restarting at every 7-day block
+(BLOCK_HOURS) as in feature_registry.py:
+    mean, std: range sums of the cumulative sums, from the rows of the window to the last row before
+               the origin, in the same order of operations as the testing features, so they are equal
+    median, max, min: the suffix stats (see feature_store.py) of the 3 days before each origin,
+               which hold every window of its 48 hours
+
+The datetime features are added by the shared calendar table, the weather columns are null as in the
+testing features, and the frames of the origins are written partitioned by origin, in the layout of the
+testing all_features:
+    {featurePath}/backtest/{YYYY-MM-DD}/{target}/all_features
+
+The training rows of an origin are those of the training all_features before it: their rolling
+stats only look back, so origin_training() cuts the full-history frame at the origin and leaves out
+the labels not known yet, instead of writing a training frame per origin.
+
+Origins are given as days, and ranges as start:end[:step days], both included, e.g.
+    python3 -u ./backtest.py 2018-03-01:2018-03-31 2018-04-05 [london|beijing]
+In multi-target mode, every measurement is featured at once into {featurePath}/backtest/{YYYY-MM-DD}/all_features,
+and the frames of the pollutants are written as its columns.
+
+@author: Stephen
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from utils import target_view
+from storage import read_frame, write_frame, compact_mode
+from create_label import target_list, label_name, label_validity_name, HORIZONS
+from tracing import traced
+from cities import get_city, city_arguments, multi_target
+from feature_registry import WINDOWS, STATS, BLOCK_HOURS, window_width, block_cumsums, block_range_sums
+from feature_store import suffix_stats
+from datetime_features import HORIZON_HOURS, add_datetime_features
+from validity import VALIDITY, valid_mask
+from weather_features import WEATHER
+
+HOUR = pd.Timedelta(hours=1).value
+
+
+def origin_range(start, end, step=1):
+    """
+    Return the origins from start to end, both included.
+
+    params: start: datetime.date
+    params: end: datetime.date
+    params: step: int, days between origins
+    return: list of datetime.date
+    """
+    return [start + timedelta(days=day) for day in range(0, (end - start).days + 1, step)]
+
+
+def origin_arguments():
+    """
+    Return the origins given as script arguments, 'YYYY-MM-DD' or 'YYYY-MM-DD:YYYY-MM-DD[:step]'.
+
+    return: list of datetime.date, sorted, without duplicates
+    """
+    origins = set()
+    for arg in sys.argv[1:]:
+        if not arg[:1].isdigit():
+            continue
+        parts = arg.split(':')
+        days = [datetime.strptime(part, '%Y-%m-%d').date() for part in parts[:2]]
+        step = int(parts[2]) if len(parts) > 2 else 1
+        origins.update(origin_range(days[0], days[-1], step))
+    if not origins:
+        raise ValueError('No forecast origin given, e.g. 2018-03-01:2018-03-31')
+    return sorted(origins)
+
+
+def backtest_path(featurePath, origin, target=None):
+    """
+    Return the path of the testing features of an origin.
+
+    params: featurePath: string, e.g. ../feature/london
+    params: origin: datetime.date
+    params: target: string, None for the wide frame of multi-target mode
+    return: string
+    """
+    directory = '{}/backtest/{}'.format(featurePath, origin.strftime('%Y-%m-%d'))
+    return '{}/all_features'.format(directory if target is None else '{}/{}'.format(directory, target))
+
+
+def origin_stats(times, x, origins, widths, hours=HORIZON_HOURS):
+    """
+    Compute the rolling stats of one station for the hours after each origin, from its rows before the origin.
+
+    The window of the hour h covers (h - width, h], as in rolling_stats(); the values <= 0 are null, except for max.
+
+    params: times: numpy array of int64 (nanoseconds), the sorted times of the station's rows
+    params: x: numpy array of float64, the values of the rows, NaN where missing
+    params: origins: numpy array of int64 (nanoseconds), the first prediction hour of each origin
+    params: widths: list of int, the window widths in nanoseconds
+    params: hours: int, the number of hours after each origin
+    return: numpy array in shape of (origins, hours, len(widths) * len(STATS)), by width and then stat
+    """
+    stats = np.full((len(origins), hours, len(widths) * len(STATS)), np.nan)
+    if len(times) == 0:
+        return stats
+    valid = x > 0
+    x0 = np.where(valid, x, 0.0)
+    block = times // (BLOCK_HOURS * HOUR)
+    total, squares = block_cumsums(x0, block), block_cumsums(x0 * x0, block)
+    count = np.r_[0, np.cumsum(valid)]
+
+    # rows [start, end) of each window: end is the first row at or after the origin
+    ends = np.searchsorted(times, origins, side='left')
+    targetHours = origins[:, None] + np.arange(hours) * HOUR
+    starts = [np.minimum(np.searchsorted(times, targetHours - width, side='right'), ends[:, None]) for width in widths]
+    last = np.broadcast_to(np.maximum(ends - 1, 0)[:, None], targetHours.shape)
+    for w, start in enumerate(starts):
+        cnt = count[ends[:, None]] - count[start]
+        first = np.minimum(start, len(times) - 1)
+        s = block_range_sums(total, block, first, last)
+        q = block_range_sums(squares, block, first, last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats[:, :, w * len(STATS)] = np.where(cnt > 0, s / cnt, np.nan)
+            stats[:, :, w * len(STATS) + 1] = np.sqrt(np.where(cnt > 1, np.maximum(q - s * s / cnt, 0.0) / (cnt - 1), np.nan))
+
+    # the widest window of the first hour reaches the furthest back
+    lows = np.min([start[:, 0] for start in starts], axis=0)
+    for o, (low, end) in enumerate(zip(lows, ends)):
+        if end == 0:
+            continue
+        cnt, _, _, median, vmax, vmin, otherMax = suffix_stats(x[low:end])
+        for w, start in enumerate(starts):
+            i = start[o] - low
+            column = w * len(STATS)
+            stats[o, :, column+2] = median[i]
+            stats[o, :, column+3] = np.where(cnt[i] > 0, vmax[i], np.where(otherMax[i] > -np.inf, otherMax[i], np.nan))
+            stats[o, :, column+4] = np.where(cnt[i] > 0, vmin[i], np.nan)
+    return stats
+
+
+@traced()
+def backtest_features(df, air_quality, origins, windows=WINDOWS, hours=HORIZON_HOURS):
+    """
+    Generate the testing features of every origin, from the full history in one pass per station.
+
+    params: df: DataFrame, the historical and live data, including station_id, utc_time, the air quality columns
+                and the validity bitmap if any
+    params: air_quality: string or list of string
+    params: origins: list of datetime.date, the first prediction days
+    params: windows: list of string, see air_quality_features.WINDOWS
+    params: hours: int, the number of hours after each origin
+    return: dict, origin -> DataFrame in the layout of the testing all_features, sorted by station_id and utc_time,
+            the stations with rows before the origin by its hours
+    """
+    targets = target_list(air_quality)
+    origins = sorted(origins)
+    origin = np.array([datetime(o.year, o.month, o.day) for o in origins], dtype='datetime64[ns]').astype(np.int64)
+    widths = [window_width(win) for win in windows]
+    columns = ['{}_{}_{}'.format(target, win, stat) for target in targets for win in windows for stat in STATS]
+
+    # missing values as NaN, as in the rolling stats of the testing features
+    stations = df['station_id'].astype(object).values
+    times = df['utc_time'].values.astype('datetime64[ns]').astype(np.int64)
+    values = [np.where(valid_mask(df, target), df[target].values.astype(np.float64), np.nan) for target in targets]
+    order = np.lexsort((times, stations))
+    stations, times, values = stations[order], times[order], [v[order] for v in values]
+    bounds = np.r_[0, np.flatnonzero(stations[1:] != stations[:-1]) + 1, len(stations)]
+
+    names, first, blocks = [], [], []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        names.append(stations[start])
+        first.append(times[start])
+        blocks.append(np.concatenate([origin_stats(times[start:stop], v[start:stop], origin, widths, hours)
+                                      for v in values], axis=2))
+
+    dtype = np.float32 if compact_mode() else np.float64
+    offsets = np.arange(hours) * HOUR
+    frames = dict()
+    for o, day in enumerate(origins):
+        present = [i for i in range(len(names)) if first[i] < origin[o]]
+        stats = np.vstack([blocks[i][o] for i in present]) if present else np.empty((0, len(columns)))
+        data = {'station_id': np.repeat(np.array([names[i] for i in present], dtype=object), hours),
+                'utc_time': np.tile(origin[o] + offsets, len(present)).astype('datetime64[ns]')}
+        data.update({target: np.full(len(stats), np.nan, dtype=dtype) for target in targets})
+        data.update({'{}_label'.format(target): np.full(len(stats), np.nan, dtype=dtype) for target in targets})
+        data.update({label_validity_name(target): np.zeros(len(stats), dtype=np.uint64) for target in targets})
+        data.update({col: stats[:, i].astype(dtype) for i, col in enumerate(columns)})
+        df_test = add_datetime_features(pd.DataFrame(data))
+        frames[day] = df_test.assign(**{col: np.full(len(df_test), np.nan, dtype=dtype) for col in WEATHER})
+    return frames
+
+
+def origin_training(df, origin, air_quality):
+    """
+    Return the training rows of an origin from the full-history training features.
+
+    The rows are those before the origin, with the labels due at or after it (unknown on that day) set to 0
+    and their bits of the label validity bitmap unset, as the labels of the last hours of the pipeline's training data.
+
+    params: df: DataFrame, e.g. {featurePath}/train/{target}/all_features
+    params: origin: datetime.date
+    params: air_quality: string or list of string
+    return: DataFrame
+    """
+    origin = pd.Timestamp(origin)
+    df = df[df['utc_time'] < origin].copy()
+    for target in target_list(air_quality):
+        validity = label_validity_name(target)
+        bits = df[validity].values.astype(np.uint64) if validity in df.columns else None
+        for horizon in HORIZONS:
+            col = label_name(target, horizon)
+            due = (df['utc_time'] + pd.Timedelta(hours=horizon) >= origin).values
+            if col in df.columns:
+                df.loc[due, col] = 0
+            if bits is not None:
+                bits = np.where(due, bits & ~np.uint64(1 << (horizon - 1)), bits)
+        if bits is not None:
+            df[validity] = bits
+    return df
+
+
+if __name__ == '__main__':
+
+    origins = origin_arguments()
+    for city in map(get_city, city_arguments()):
+        groups = [(None, city.measurements)] if multi_target() else [(target, [target]) for target in city.pollutants]
+        for name, targets in groups:
+            s = time.time()
+            cols = ['station_id', 'utc_time'] + targets + [VALIDITY]
+            if name is None:
+                frames = [city.labels_frame(kind) for kind in ['hist', 'live']]
+            else:
+                frames = [city.label_frame(name, kind) for kind in ['hist', 'live']]
+            df = pd.concat([read_frame(path, columns=cols) for path in frames])
+            print('Generate {} backtest features of {} origins from {} to {}...'.format(
+                targets, len(origins), origins[0], origins[-1]))
+            for origin, df_test in backtest_features(df, targets, origins).items():
+                if name is None:
+                    write_frame(df_test, backtest_path(city.featurePath, origin))
+                    for pollutant in city.pollutants:
+                        write_frame(target_view(df_test, pollutant, targets), backtest_path(city.featurePath, origin, pollutant))
+                else:
+                    write_frame(df_test, backtest_path(city.featurePath, origin, name))
+            print('{} {} backtest features: {:.2f} secs'.format(city.name.title(), targets, time.time() - s))
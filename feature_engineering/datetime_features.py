@@ -9,126 +9,248 @@ day_of_month, day_of_week, hour_of_day
 
 Range of relative time columns:
     month of year: [1-12]
-    week of year: [1-52]
+    week of year: [1-53], the ISO week
     week of month: [1-6]
     day of month: [1-31]
     day of week: [0-6]
     hour of day: [0-23]
 
+The columns are computed once per distinct hour into a calendar table, shared by
+all targets and the testing data, and rows get them by their hour offset in the table.
+
+Incremental mode appends the features of the hours after the last run:
+    python3 -u ./datetime_features.py incremental
+
+The cities named in the arguments get their features (default: london):
+    python3 -u ./datetime_features.py beijing
+
+Multi-target mode keeps the labels of all the measurements in one frame, from the wide
+labeled frames of create_label.py multi, in {featurePath}/{train,test}/datetime_features:
+    python3 -u ./datetime_features.py multi
+
 @author: Stephen Fang
 '''
+import numpy as np
 import pandas as pd
 import sys
 import os
-from datetime import datetime, date, timedelta
-from math import ceil 
-import itertools
+from datetime import date
+import threading
+from utils import submission_days, test_frame, station_watermark, split_at_watermark, update_labels
+from storage import read_frame, write_frame, frame_exists, append_frame, compact_mode
+from tracing import traced
+from cities import get_city, city_arguments, multi_target
+from create_label import target_list, label_validity_columns
 
 
-def week_of_month(date):
-    """ 
-    Returns the week of the month given the specified date.
-    Adjust the date with an offset, the weekday of the first date of that month.
+CALENDAR_COLUMNS = ['month_of_year', 'week_of_year', 'week_of_month', 'day_of_month', 'day_of_week', 'hour_of_day']
+HORIZON_HOURS = 48
 
-    params: date: datetime64[ns]
-    return: int
+_calendar = {'table': None}
+_calendarLock = threading.Lock()
+
+
+@traced()
+def calendar_table(startTime, endTime):
     """
-    offset = date.replace(day=1).weekday()
-    return ceil((date.day + offset)/7)
+    Compute the relative time columns of every hour from startTime to endTime.
 
-if __name__ == "__main__":
-    # ===========================================
-    # Create relative time columns of London data
-    # ===========================================
-
-    # Initialize default directories
-    folders = [(dataType, airQuality) for dataType in ('train', 'test') for airQuality in ('PM2.5', 'PM10')]
-    for f in folders:
-        path = '../feature/london/{}/{}'.format(f[0], f[1])
-        if not os.path.isdir(path):
-            os.makedirs(path)
-
-    # =======================================
-    # Generate London PM2.5 datetime features
-    # =======================================
-    PM25_hist_data = pd.read_csv('../input/london/london_PM25_hist_data_w_label.csv')
-    PM25_live_data = pd.read_csv('../input/london/london_PM25_live_data_w_label.csv')
-    PM25_data = pd.concat([PM25_hist_data, PM25_live_data])
-    del PM25_hist_data, PM25_live_data
-
-    PM25_data['utc_time'] = pd.to_datetime(PM25_data['utc_time'])
-    PM25_data['month_of_year'] = PM25_data['utc_time'].dt.month
-    PM25_data['week_of_year'] = PM25_data['utc_time'].dt.week
-    PM25_data['week_of_month'] = PM25_data['utc_time'].apply(week_of_month)
-    PM25_data['day_of_month'] = PM25_data['utc_time'].dt.day
-    PM25_data['day_of_week'] = PM25_data['utc_time'].dt.weekday
-    PM25_data['hour_of_day'] = PM25_data['utc_time'].dt.hour
-
-    cols = ['station_id', 'utc_time', 'PM2.5_label', 'month_of_year',
-            'week_of_year', 'week_of_month', 'day_of_month',
-            'day_of_week', 'hour_of_day']
-
-    PM25_datetime_featues = PM25_data[cols]
-    PM25_datetime_featues = PM25_datetime_featues.sort_values(by=['station_id', 'utc_time'])
-    PM25_datetime_featues.to_csv('../feature/london/train/PM2.5/datetime_features.csv', index=False)
-    print('Current latest date in PM2.5 training data: {}'.format(PM25_datetime_featues['utc_time'].max()))
-    print('London PM2.5 datetime features: Done!')
-
-    # ======================================
-    # Generate London PM10 datetime features
-    # ======================================
-    PM10_hist_data = pd.read_csv('../input/london/london_PM10_hist_data_w_label.csv')
-    PM10_live_data = pd.read_csv('../input/london/london_PM10_live_data_w_label.csv')
-    PM10_data = pd.concat([PM10_hist_data, PM10_live_data])
-    del PM10_hist_data, PM10_live_data
-
-    PM10_data['utc_time'] = pd.to_datetime(PM10_data['utc_time'])
-    PM10_data['month_of_year'] = PM10_data['utc_time'].dt.month
-    PM10_data['week_of_year'] = PM10_data['utc_time'].dt.week
-    PM10_data['week_of_month'] = PM10_data['utc_time'].apply(week_of_month)
-    PM10_data['day_of_month'] = PM10_data['utc_time'].dt.day
-    PM10_data['day_of_week'] = PM10_data['utc_time'].dt.weekday
-    PM10_data['hour_of_day'] = PM10_data['utc_time'].dt.hour
-
-    cols = ['station_id', 'utc_time', 'PM10_label', 'month_of_year',
-            'week_of_year', 'week_of_month', 'day_of_month',
-            'day_of_week', 'hour_of_day']
-
-    PM10_datetime_featues = PM10_data[cols]
-    PM10_datetime_featues = PM10_datetime_featues.sort_values(by=['station_id', 'utc_time'])
-
-    PM10_datetime_featues.to_csv('../feature/london/train/PM10/datetime_features.csv', index=False)
-    print('Current latest date in PM10 training data: {}'.format(PM10_datetime_featues['utc_time'].max()))
-    print('London PM10 dateime features: Done!')
-    print('Training Data Process: Done!')
-
-    # ==========================================
-    # Process Testing Dataset (The next two day)
-    # ==========================================
-
-    if len(sys.argv) > 1:
-        submission_day1 = sys.argv[1]
-        submission_day2 = sys.argv[2]
+    params: startTime: datetime-like, floored to the hour
+    params: endTime: datetime-like, included
+    return: DataFrame, indexed by the hours, with CALENDAR_COLUMNS as int8 in compact mode
+    """
+    hours = pd.date_range(pd.Timestamp(startTime).floor('h'), pd.Timestamp(endTime), freq='h')
+    calendar = np.int8 if compact_mode() else np.int64
+    # week of the month: the day shifted by the weekday of the first day of the month
+    offset = (hours.weekday - (hours.day - 1)) % 7
+    return pd.DataFrame({'month_of_year': hours.month,
+                         'week_of_year': hours.isocalendar().week.values,
+                         'week_of_month': -((-(hours.day + offset)) // 7),
+                         'day_of_month': hours.day,
+                         'day_of_week': hours.weekday,
+                         'hour_of_day': hours.hour}, index=hours).astype(calendar)
+
+
+def cached_calendar(startTime, endTime):
+    """
+    Return the cached calendar table, extended to cover startTime to endTime plus the forecast horizon.
+
+    params: startTime: datetime-like
+    params: endTime: datetime-like
+    return: DataFrame, see calendar_table()
+    """
+    with _calendarLock:
+        table = _calendar['table']
+        if (table is None or table.index[0] > startTime or table.index[-1] < endTime
+                or table['hour_of_day'].dtype != (np.int8 if compact_mode() else np.int64)):
+            if table is not None:
+                startTime, endTime = min(startTime, table.index[0]), max(endTime, table.index[-1])
+            table = calendar_table(startTime, pd.Timestamp(endTime) + pd.Timedelta(hours=HORIZON_HOURS))
+            _calendar['table'] = table
+    return table
+
+
+@traced()
+def add_datetime_features(df):
+    """
+    Add the relative time columns of utc_time, looked up by the hour offset in the calendar table.
+
+    params: df: DataFrame, including utc_time column
+    return: df: DataFrame
+    """
+    if len(df) == 0:
+        for col in CALENDAR_COLUMNS:
+            df[col] = np.array([], dtype=np.int8 if compact_mode() else np.int64)
+        return df
+    times = df['utc_time'].values.astype('datetime64[h]')
+    table = cached_calendar(pd.Timestamp(times.min()), pd.Timestamp(times.max()))
+    offset = (times - table.index[0].to_datetime64().astype('datetime64[h]')).astype(np.int64)
+    for col in CALENDAR_COLUMNS:
+        df[col] = table[col].values[offset]
+    return df
+
+
+def datetime_features(hist_data, live_data, target):
+    """
+    Generate the datetime features of the training data.
+
+    params: hist_data: DataFrame, historical data with labels
+    params: live_data: DataFrame, live data with labels
+    params: target: string or list of string, the labels of several targets are kept in one frame
+    return: DataFrame
+    """
+    # only the keys, the 1-hour labels and their validity, not the labels of every horizon
+    keys = ['station_id', 'utc_time'] + ['{}_label'.format(name) for name in target_list(target)] \
+        + label_validity_columns(live_data, target)
+    df = add_datetime_features(pd.concat([hist_data[keys], live_data[keys]]))
+
+    cols = keys + ['month_of_year', 'week_of_year', 'week_of_month', 'day_of_month',
+                   'day_of_week', 'hour_of_day']
+
+    return df[cols].sort_values(by=['station_id', 'utc_time'])
+
+
+def test_datetime_features(stationId, submission_day1):
+    """
+    Generate the datetime features of the testing data (The next two day).
+
+    params: stationId: iterable of string
+    params: submission_day1: datetime.date, the first prediction day
+    return: DataFrame
+    """
+    return add_datetime_features(test_frame(stationId, submission_day1))
+
+
+@traced()
+def train_test_datetime_features(hist_data, live_data, target, submission_day1):
+    """
+    Generate the datetime features of the training and testing data.
+
+    params: hist_data: DataFrame, historical data with labels
+    params: live_data: DataFrame, live data with labels
+    params: target: string or list of string, see datetime_features()
+    params: submission_day1: datetime.date, the first prediction day
+    return: (df_train, df_test): DataFrame
+    """
+    df_train = datetime_features(hist_data, live_data, target)
+    return df_train, test_datetime_features(df_train.station_id.unique(), submission_day1)
+
+
+@traced()
+def incremental_datetime_features(hist_data, live_data, target, submission_day1, featurePath='../feature/london'):
+    """
+    Append the datetime features of the live rows after the last run to the stored training features.
+
+    The state is the latest utc_time of each station ({featurePath}/state/{target}_datetime_watermark).
+    Without state, all features are computed as train_test_datetime_features() does.
+    The labels of the stored live rows are rewritten every run, so those of the new observations and of
+    revised live rows (the duplicate policy 'last' of data_integration.py) are up to date.
+
+    params: hist_data: DataFrame, historical data with labels, only read without state
+    params: live_data: DataFrame, live data with labels
+    params: target: string, options: ['PM2.5', 'PM10']
+    params: submission_day1: datetime.date, the first prediction day
+    params: featurePath: string, the directory of features
+    return: df_test: DataFrame, the testing features, which are recomputed every run
+    """
+    trainPath = '{}/train/{}/datetime_features'.format(featurePath, target)
+    testPath = '{}/test/{}/datetime_features'.format(featurePath, target)
+    statePath = '{}/state/{}_datetime_watermark'.format(featurePath, target)
+    labelNames = ['{}_label'.format(target)] + label_validity_columns(live_data, target)
+
+    if not (frame_exists(statePath) and frame_exists(trainPath)):
+        df_train, df_test = train_test_datetime_features(hist_data, live_data, target, submission_day1)
+        write_frame(df_train, trainPath)
     else:
-        today = date.today()
-        submission_day1 = today + timedelta(days=1)
-        submission_day2 = today + timedelta(days=2)
-
-    # Initialize station ID and utc time columns
-    testStartTime = datetime(year=submission_day1.year, month=submission_day1.month, day=submission_day1.day)
-    testTime = [testStartTime+timedelta(hours=delta) for delta in range(48)]
-    stationId = PM25_data.station_id.unique()
-    testPair = [(sid, time) for sid in stationId for time in testTime]
-    test = pd.DataFrame(testPair, columns=['station_id', 'utc_time'])
-
-    # Generate testing datetime features
-    test['month_of_year'] = test['utc_time'].dt.month
-    test['week_of_year'] = test['utc_time'].dt.week
-    test['week_of_month'] = test['utc_time'].apply(week_of_month)
-    test['day_of_month'] = test['utc_time'].dt.day
-    test['day_of_week'] = test['utc_time'].dt.weekday
-    test['hour_of_day'] = test['utc_time'].dt.hour
-
-    test.to_csv('../feature/london/test/PM2.5/datetime_features.csv', index = False)
-    test.to_csv('../feature/london/test/PM10/datetime_features.csv', index = False)
-    print('Testing Data Process: Done!')
\ No newline at end of file
+        state = read_frame(statePath)
+        new, boundary = split_at_watermark(live_data, station_watermark(state), None)
+        df_train = datetime_features(new.iloc[:0], new, target)
+        stationId = set(state['station_id'].astype(object)) | set(df_train['station_id'].astype(object))
+        df_test = test_datetime_features(sorted(stationId), submission_day1)
+
+        append_frame(df_train, trainPath)
+        update_labels(trainPath, boundary, labelNames)
+        df_train = pd.concat([state, df_train[['station_id', 'utc_time']]], axis=0)
+
+    marks = station_watermark(df_train)
+    write_frame(pd.DataFrame({'station_id': list(marks), 'utc_time': list(marks.values())}), statePath)
+    write_frame(df_test, testPath)
+    return df_test
+
+
+if __name__ == "__main__":
+    submission_day1, submission_day2 = submission_days(date.today())
+
+    for city in map(get_city, city_arguments()):
+        # =====================================
+        # Create relative time columns of a city
+        # =====================================
+
+        # Initialize default directories
+        folders = [(dataType, airQuality) for dataType in ('train', 'test') for airQuality in city.pollutants]
+        for f in folders:
+            path = '{}/{}/{}'.format(city.featurePath, f[0], f[1])
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        if multi_target():
+            df_train, df_test = train_test_datetime_features(read_frame(city.labels_frame('hist')),
+                                                             read_frame(city.labels_frame('live')),
+                                                             city.measurements, submission_day1)
+            write_frame(df_train, '{}/train/datetime_features'.format(city.featurePath))
+            write_frame(df_test, '{}/test/datetime_features'.format(city.featurePath))
+            print('{} datetime features of {}: Done!'.format(city.name.title(), city.measurements))
+            continue
+
+        if 'incremental' in sys.argv:
+            for target in city.pollutants:
+                incremental_datetime_features(read_frame(city.label_frame(target, 'hist')),
+                                              read_frame(city.label_frame(target, 'live')),
+                                              target, submission_day1, city.featurePath)
+                print('{} {} incremental datetime features: Done!'.format(city.name.title(), target))
+            continue
+
+        # =====================================
+        # Generate datetime features per target
+        # =====================================
+        stationId = None
+        for target in city.pollutants:
+            hist_data = read_frame(city.label_frame(target, 'hist'))
+            live_data = read_frame(city.label_frame(target, 'live'))
+            datetime_featues = datetime_features(hist_data, live_data, target)
+            if stationId is None:
+                stationId = datetime_featues.station_id.unique()
+            del hist_data, live_data
+
+            write_frame(datetime_featues, '{}/train/{}/datetime_features'.format(city.featurePath, target))
+            print('Current latest date in {} training data: {}'.format(target, datetime_featues['utc_time'].max()))
+            print('{} {} datetime features: Done!'.format(city.name.title(), target))
+        print('Training Data Process: Done!')
+
+        # ==========================================
+        # Process Testing Dataset (The next two day)
+        # ==========================================
+        test = test_datetime_features(stationId, submission_day1)
+        for target in city.pollutants:
+            write_frame(test, '{}/test/{}/datetime_features'.format(city.featurePath, target))
+        print('Testing Data Process: Done!')
@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+Declarative registry of the air quality features, evaluated by a planner in one pass per station.
+
+A feature is (source column, operator, window or lag, null policy), e.g.
+    Feature('PM2.5', 'mean', '1d')      PM2.5_1d_mean: the mean over (utc_time - 1 day, utc_time]
+    Feature('PM2.5', 'lag', '3h')       PM2.5_lag_3h: the value at utc_time - 3 hours, null if not observed
+    Feature('PM2.5', 'ewm', '12h')      PM2.5_ewm_12h: the mean of all earlier values, weighted by 0.5 ** (age / 12 hours)
+
+Operators:
+    mean, std, median, max, min: rolling windows (as pandas' time-based rolling), of at most BLOCK_HOURS
+    lag:                         the value a number of hours before, on the same station
+    ewm:                         the exponentially weighted mean with the window as half-life
+Null policies:
+    positive (default): values <= 0 are null, except for max, which falls back to them when a window has no positive value
+    nonnull:            only missing values are null, the feature names end with _nonnull
+Missing values are those of the validity bitmap (see data_processing/validity.py), not the zeros they
+are filled with, or the null values of rows without a bitmap. The mask is computed once per source.
+
+FeaturePlan groups the features by the intermediates they share, and computes each intermediate once:
+    one sort by station_id and utc_time for all features
+    the window bounds of each width, for all sources
+    the validity mask and counts of each (source, null policy)
+    the block cumulative sums of each (source, null policy, window), for mean and std
+    one sliding pass of sorted windows per (source, null policy), for median, max and min of all its windows
+    the shifted positions of each lag, for all sources
+    the block-scaled weighted sums of each (source, null policy, half-life), for ewm
+The time of each intermediate is split among the features using it, into FeaturePlan.costs,
+so that expensive features of little value can be pruned (see report()).
+
+The stations are independent, so with several workers (STATION_WORKERS) they are split among
+worker processes over shared memory, see data_processing/parallel.py, with the same features.
+
+The cumulative sums restart at every 7-day block (BLOCK_HOURS), so a row's rolling stats only
+depend on the rows since the start of the block before it, see air_quality_features.rolling_tail().
+
+@author: Stephen
+'''
+
+import time
+import numpy as np
+import pandas as pd
+from bisect import bisect_left, insort
+import utils  # the modules of data_processing become importable
+from storage import compact_mode
+from parallel import station_bounds, map_stations
+from validity import valid_mask
+from tracing import current, enabled
+
+WINDOWS = ['1d', '2d', '3d']
+STATS = ['mean', 'std', 'median', 'max', 'min']
+BLOCK_HOURS = 7 * 24
+OPERATORS = STATS + ['lag', 'ewm']
+NULL_POLICIES = ['positive', 'nonnull']
+# the largest exponent of the ewm weights within a block, far from the float64 overflow at 709
+MAX_EXPONENT = 500.0
+
+
+def window_width(win):
+    """
+    Width of a window in nanoseconds, e.g. '1d' -> 86400000000000
+    """
+    return pd.Timedelta(win.replace('d', 'D')).value
+
+
+class Feature(object):
+    """
+    The specification of a feature.
+
+    params: source: string, the column, e.g. 'PM2.5'
+    params: operator: string, see OPERATORS
+    params: window: string, a time offset: the window of rolling stats, the lag, or the half-life of ewm, e.g. '1d', '6h'
+    params: nulls: string, see NULL_POLICIES
+    """
+    def __init__(self, source, operator, window, nulls='positive'):
+        if operator not in OPERATORS:
+            raise ValueError('Unknown operator: {}, options: {}'.format(operator, OPERATORS))
+        if nulls not in NULL_POLICIES:
+            raise ValueError('Unknown null policy: {}, options: {}'.format(nulls, NULL_POLICIES))
+        self.source = source
+        self.operator = operator
+        self.window = window
+        self.width = window_width(window)
+        self.nulls = nulls
+        if self.width <= 0:
+            raise ValueError('The window of {} must be positive'.format(self.name))
+        if operator in STATS and self.width > pd.Timedelta(hours=BLOCK_HOURS).value:
+            raise ValueError('Windows wider than {} hours are not supported: {}'.format(BLOCK_HOURS, self.name))
+
+    @property
+    def name(self):
+        if self.operator in STATS:
+            name = '{}_{}_{}'.format(self.source, self.window, self.operator)
+        else:
+            name = '{}_{}_{}'.format(self.source, self.operator, self.window)
+        return name if self.nulls == 'positive' else name + '_nonnull'
+
+    def __repr__(self):
+        return "Feature('{}', '{}', '{}', '{}')".format(self.source, self.operator, self.window, self.nulls)
+
+
+def default_features(sources, windows=WINDOWS, stats=STATS):
+    """
+    Return the rolling stats of every window, the features of air_quality_features().
+
+    params: sources: list of string, e.g. ['PM2.5', 'PM10']
+    params: windows: list of string
+    params: stats: list of string
+    return: list of Feature, in the order of the columns
+    """
+    return [Feature(source, stat, win) for source in sources for win in windows for stat in stats]
+
+
+def lag_features(sources, hours=range(1, 49), nulls='positive'):
+    """
+    Return the lags of every hour, e.g. the values at utc_time - 1h .. utc_time - 48h.
+    """
+    return [Feature(source, 'lag', '{}h'.format(hour), nulls) for source in sources for hour in hours]
+
+
+def ewm_features(sources, halflives=('6h', '1d'), nulls='positive'):
+    """
+    Return the exponentially weighted means of every half-life.
+    """
+    return [Feature(source, 'ewm', halflife, nulls) for source in sources for halflife in halflives]
+
+
+def block_cumsums(v, block):
+    """
+    Cumulative sums of v restarting at every block.
+
+    params: v: 1-d numpy array
+    params: block: 1-d numpy array of int, non-decreasing block number of each row
+    return: (incl, excl, total): numpy arrays, the sums of the block up to each row included and excluded,
+            and the sum of the whole block of each row
+    """
+    incl = pd.Series(v).groupby(block).cumsum().values
+    first = np.r_[True, block[1:] != block[:-1]]
+    excl = np.where(first, 0.0, np.r_[0.0, incl[:-1]])
+    last = np.r_[np.flatnonzero(first[1:]), len(v) - 1]
+    total = incl[last][np.cumsum(first) - 1]
+    return incl, excl, total
+
+
+def block_range_sums(sums, block, start, end):
+    """
+    Sums over the rows [start, end], from block_cumsums().
+
+    A range spans two blocks at most, since no window is wider than a block.
+
+    params: sums: (incl, excl, total), see block_cumsums()
+    params: block: 1-d numpy array of int
+    params: start: numpy array of int, the first row of each range
+    params: end: numpy array of int, the last row of each range
+    return: numpy array
+    """
+    incl, excl, total = sums
+    return np.where(block[start] == block[end], incl[end] - excl[start], (total[start] - excl[start]) + incl[end])
+
+
+def _block_window_sums(v, block, start):
+    """
+    Sums of v over the windows [start[i], i], from cumulative sums restarting at every block.
+
+    params: v: 1-d numpy array
+    params: block: 1-d numpy array of int, non-decreasing block number of each row
+    params: start: 1-d numpy array of int, the first row of each row's window
+    return: 1-d numpy array
+    """
+    return block_range_sums(block_cumsums(v, block), block, start, np.arange(len(v)))
+
+
+def _sliding_order_stats(raw, starts, valid):
+    """
+    Rolling median, max and min of several windows sharing one pass over a station.
+
+    Each window keeps two sorted lists: the valid values and the other non-null
+    values, which only matter for max when a window has no valid value.
+
+    params: raw: 1-d numpy array, the values of one station sorted by time, NaN where not observed
+    params: starts: list of 1-d numpy arrays, the first row of each row's window
+    params: valid: 1-d numpy array of bool, the values of the null policy
+    return: (median, max, min): numpy arrays in shape of (len(starts), len(raw))
+    """
+    n = len(raw)
+    median, vmax, vmin = (np.full((len(starts), n), np.nan) for _ in range(3))
+    windows = [([], [], 0) for _ in starts]
+    for i in range(n):
+        x = raw[i]
+        for k, start in enumerate(starts):
+            values, other, lo = windows[k]
+            while lo < start[i]:
+                y = raw[lo]
+                if valid[lo]:
+                    del values[bisect_left(values, y)]
+                elif y == y:
+                    del other[bisect_left(other, y)]
+                lo += 1
+            if valid[i]:
+                insort(values, x)
+            elif x == x:
+                insort(other, x)
+            windows[k] = (values, other, lo)
+
+            m = len(values)
+            if m:
+                median[k, i] = values[m // 2] if m % 2 else (values[m // 2 - 1] + values[m // 2]) / 2.0
+                vmax[k, i] = values[-1]
+                vmin[k, i] = values[0]
+            elif other:
+                vmax[k, i] = other[-1]
+    return median, vmax, vmin
+
+
+def _ewm(x, valid, times, width):
+    """
+    Exponentially weighted mean of the valid values up to each row, with the half-life width.
+
+    The weights exp(a * (t - block start)) are scaled per block, so they stay finite, and the
+    sums of earlier blocks are carried, decayed to the start of each block.
+
+    params: x: 1-d numpy array, the values of one station sorted by time
+    params: valid: 1-d numpy array of bool
+    params: times: 1-d numpy array of int64, nanoseconds
+    params: width: int, the half-life in nanoseconds
+    return: 1-d numpy array
+    """
+    a = np.log(2) / width
+    blockWidth = int(min(pd.Timedelta(hours=BLOCK_HOURS).value, MAX_EXPONENT / a))
+    block = times // blockWidth
+    weight = np.where(valid, np.exp(a * (times - block * blockWidth)), 0.0)
+    num = pd.Series(np.where(valid, x, 0.0) * weight).groupby(block).cumsum().values
+    den = pd.Series(weight).groupby(block).cumsum().values
+
+    # the carried sums at the start of each block
+    first = np.flatnonzero(np.r_[True, block[1:] != block[:-1]])
+    last = np.r_[first[1:] - 1, len(x) - 1]
+    carryNum, carryDen = np.zeros(len(first)), np.zeros(len(first))
+    for b in range(1, len(first)):
+        decay = np.exp(-a * blockWidth * (block[first[b]] - block[first[b - 1]]))
+        carryNum[b] = (carryNum[b - 1] + num[last[b - 1]]) * decay
+        carryDen[b] = (carryDen[b - 1] + den[last[b - 1]]) * decay
+    blockIndex = np.cumsum(np.r_[True, block[1:] != block[:-1]]) - 1
+    num, den = num + carryNum[blockIndex], den + carryDen[blockIndex]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+
+def _evaluate_stations(inputs, outputs, start, stop, features):
+    """
+    Compute the features of the stations in the rows [start, stop), one station at a time.
+
+    params: inputs: dict, 'times': int64 nanoseconds, 'bounds': see parallel.station_bounds(),
+                    'raws': float64 array in shape of (sources, rows), NaN where not observed,
+                    'observed': bool array in shape of (sources, rows), see validity.valid_mask()
+    params: outputs: dict, 'values': array in shape of (features, rows), written in place
+    params: start: int, the first row, of a station
+    params: stop: int, the row after the last one, of a station
+    params: features: list of Feature, in the order of the values; their sources in the order of the raws
+    return: dict, feature name -> seconds of the intermediates it used
+    """
+    costs = {feature.name: 0.0 for feature in features}
+
+    def charge(seconds, members):
+        for feature in members:
+            costs[feature.name] += seconds / len(members)
+
+    times, bounds, raws, observed = inputs['times'], inputs['bounds'], inputs['raws'], inputs['observed']
+    sources = list(dict.fromkeys(feature.source for feature in features))
+    index = {feature.name: k for k, feature in enumerate(features)}
+    values = outputs['values']
+    rolling = [feature for feature in features if feature.operator in STATS]
+    widths = sorted({feature.width for feature in rolling})
+    lags = sorted({feature.width for feature in features if feature.operator == 'lag'})
+    groups = list(dict.fromkeys((feature.source, feature.nulls) for feature in features))
+    blockWidth = pd.Timedelta(hours=BLOCK_HOURS).value
+    bounds = bounds[(bounds >= start) & (bounds <= stop)]
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        t = times[start:stop]
+        end = np.arange(1, stop - start + 1)
+
+        # window bounds and lag positions, shared by all sources
+        s = time.perf_counter()
+        block = t // blockWidth
+        starts = {width: np.searchsorted(t, t - width, side='right') for width in widths}
+        charge(time.perf_counter() - s, rolling)
+        shifted = dict()
+        for lag in lags:
+            s = time.perf_counter()
+            position = np.minimum(np.searchsorted(t, t - lag), len(t) - 1)
+            shifted[lag] = np.where(t[position] == t - lag, position, -1)
+            charge(time.perf_counter() - s, [f for f in features if f.operator == 'lag' and f.width == lag])
+
+        for source, nulls in groups:
+            members = [f for f in features if (f.source, f.nulls) == (source, nulls)]
+            s = time.perf_counter()
+            x = raws[sources.index(source), start:stop]
+            valid = observed[sources.index(source), start:stop]
+            if nulls == 'positive':
+                valid = valid & (x > 0)
+            x0 = np.where(valid, x, 0.0)
+            N = np.r_[0, np.cumsum(valid)]
+            charge(time.perf_counter() - s, members)
+
+            ordered = [f for f in members if f.operator in ('median', 'max', 'min')]
+            if ordered:
+                s = time.perf_counter()
+                orderWidths = sorted({f.width for f in ordered})
+                median, vmax, vmin = _sliding_order_stats(x, [starts[w] for w in orderWidths], valid)
+                order = {'median': median, 'max': vmax, 'min': vmin}
+                for f in ordered:
+                    values[index[f.name], start:stop] = order[f.operator][orderWidths.index(f.width)]
+                charge(time.perf_counter() - s, ordered)
+
+            for width in sorted({f.width for f in members if f.operator in ('mean', 'std')}):
+                moments = [f for f in members if f.operator in ('mean', 'std') and f.width == width]
+                s = time.perf_counter()
+                cnt = N[end] - N[starts[width]]
+                total = _block_window_sums(x0, block, starts[width])
+                squares = _block_window_sums(x0 * x0, block, starts[width]) \
+                    if any(f.operator == 'std' for f in moments) else None
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    for f in moments:
+                        if f.operator == 'mean':
+                            values[index[f.name], start:stop] = np.where(cnt > 0, total / cnt, np.nan)
+                        else:
+                            var = np.where(cnt > 1, np.maximum(squares - total * total / cnt, 0.0) / (cnt - 1), np.nan)
+                            values[index[f.name], start:stop] = np.sqrt(var)
+                charge(time.perf_counter() - s, moments)
+
+            for f in members:
+                if f.operator == 'lag':
+                    s = time.perf_counter()
+                    position = shifted[f.width]
+                    values[index[f.name], start:stop] = np.where((position >= 0) & valid[position], x[position], np.nan)
+                    charge(time.perf_counter() - s, [f])
+                elif f.operator == 'ewm':
+                    s = time.perf_counter()
+                    values[index[f.name], start:stop] = _ewm(x, valid, t, f.width)
+                    charge(time.perf_counter() - s, [f])
+    return costs
+
+
+class FeaturePlan(object):
+    """
+    The shared computation of a set of features.
+
+    params: features: list of Feature, with unique names
+    """
+    def __init__(self, features):
+        self.features = list(features)
+        names = [feature.name for feature in self.features]
+        if len(set(names)) < len(names):
+            raise ValueError('Features repeated: {}'.format(sorted({name for name in names if names.count(name) > 1})))
+        self.sources = list(dict.fromkeys(feature.source for feature in self.features))
+        self.costs = {name: 0.0 for name in names}
+
+    def _charge(self, seconds, features):
+        """
+        Split the time of an intermediate among the features using it.
+        """
+        for feature in features:
+            self.costs[feature.name] += seconds / len(features)
+
+    def evaluate(self, df, workers=None):
+        """
+        Compute the features of the rows, in one pass per station.
+
+        The stations are computed by worker processes over shared memory when there are
+        several workers, see parallel.map_stations(); the features are the same.
+
+        params: df: DataFrame, including station_id, utc_time and the source columns
+        params: workers: int, the number of worker processes, default: parallel.station_workers()
+        return: df: DataFrame, sorted by station_id and utc_time, with a column per feature
+        """
+        s = time.perf_counter()
+        df = df.sort_values(['station_id', 'utc_time'], kind='mergesort').reset_index(drop=True)
+        n = len(df)
+        inputs = {'times': df['utc_time'].values.astype('datetime64[ns]').astype(np.int64),
+                  'bounds': station_bounds(pd.factorize(df['station_id'])[0]),
+                  'raws': np.empty((len(self.sources), n), dtype=np.float64),
+                  'observed': np.empty((len(self.sources), n), dtype=bool)}
+        for i, source in enumerate(self.sources):
+            inputs['observed'][i] = valid_mask(df, source)
+            inputs['raws'][i] = np.where(inputs['observed'][i], df[source].values.astype(np.float64), np.nan)
+        dtype = np.float32 if compact_mode() else np.float64
+        outputs = {'values': np.full((len(self.features), n), np.nan, dtype=dtype)}
+        self._charge(time.perf_counter() - s, self.features)
+
+        outputs, costs = map_stations(_evaluate_stations, inputs, outputs, inputs['bounds'], (self.features,), workers)
+        for partition in costs:
+            for name, seconds in partition.items():
+                self.costs[name] += seconds
+
+        s = time.perf_counter()
+        df = pd.concat([df, pd.DataFrame(outputs['values'].T, columns=[f.name for f in self.features])], axis=1)
+        self._charge(time.perf_counter() - s, self.features)
+        if enabled():
+            current().set(feature_costs={name: round(seconds, 6) for name, seconds in self.costs.items()})
+        return df
+
+    def report(self):
+        """
+        Return the compute cost of each feature, the most expensive first.
+
+        return: DataFrame, with columns feature, operator, seconds and share (of the total)
+        """
+        total = sum(self.costs.values()) or 1.0
+        report = pd.DataFrame({'feature': [f.name for f in self.features], 'operator': [f.operator for f in self.features],
+                               'seconds': [self.costs[f.name] for f in self.features]})
+        report['share'] = report['seconds'] / total
+        return report.sort_values('seconds', ascending=False, kind='mergesort').reset_index(drop=True)
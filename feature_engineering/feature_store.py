@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+In-memory feature store of the air quality observations, for serving forecasts.
+
+The store keeps the hourly observations of each station in time order, loaded from the
+merged air quality data of the pipeline, and computes the features of the next 48 hours
+at query time:
+    features(stations, asOf) -> one row per station and hour asOf+1h .. asOf+48h, with
+    the rolling stats of every target (see air_quality_features.py) and the datetime features
+
+The features are point-in-time: only observations with utc_time <= asOf are used, so
+observations after asOf (e.g. replayed or loaded late) do not leak into them, and a query
+of the first prediction day's midnight - 1h gives the testing features of the pipeline.
+The label columns, unknown at serving time, are left out, and the target columns (the
+observations of the hours) and the weather columns are null, as in the testing features. The rows can be transformed
+by the TransformPlan of the training features (see merge_all_features.py), with labels=False.
+
+New observations are added in place by update(), e.g. every hour from the live data;
+a row with the key of a stored one replaces its values. The rows of a station grow in
+preallocated arrays, so an hourly update does not copy the history.
+
+A window of an hour after asOf only reaches the last 3 days of observations, so a query
+reads a short tail per station. The features of a (station, asOf) are cached until the
+station is updated, and repeated queries return a copy of the cached frame.
+
+Usage:
+    python3 -u ./feature_store.py [london|beijing] [YYYY-MM-DDTHH:MM]
+
+@author: Stephen
+'''
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import utils  # the modules of data_processing become importable
+from storage import read_frame, compact_mode
+from air_quality_features import WINDOWS, STATS, window_width
+from datetime_features import CALENDAR_COLUMNS, HORIZON_HOURS, cached_calendar
+from create_label import target_list
+from cities import get_city, city_arguments, multi_target
+from validity import VALIDITY, with_missing
+from weather_features import WEATHER
+
+HOUR = pd.Timedelta(hours=1).value
+MIN_CAPACITY = 256
+MAX_CACHE = 4096
+
+
+class StationSeries(object):
+    """
+    The observations of one station, sorted by time, in arrays grown in place.
+
+    params: targets: int, the number of measurements
+    """
+    def __init__(self, targets):
+        self.size = 0
+        self.times = np.empty(0, dtype=np.int64)
+        self.values = np.empty((targets, 0), dtype=np.float64)
+        self.version = 0
+
+    def _reserve(self, size):
+        if size <= len(self.times):
+            return
+        capacity = max(MIN_CAPACITY, 2 * len(self.times), size)
+        times = np.empty(capacity, dtype=np.int64)
+        values = np.empty((len(self.values), capacity), dtype=np.float64)
+        times[:self.size] = self.times[:self.size]
+        values[:, :self.size] = self.values[:, :self.size]
+        self.times, self.values = times, values
+
+    def update(self, times, values):
+        """
+        Add observations, replacing the values of the times already stored.
+
+        params: times: numpy array of int64 (nanoseconds), sorted, without duplicates
+        params: values: numpy array in shape of (targets, len(times))
+        return: None
+        """
+        n = self.size
+        if n == 0 or times[0] > self.times[n - 1]:
+            # the usual hourly update: appended after the latest observation
+            self._reserve(n + len(times))
+            self.times[n:n + len(times)] = times
+            self.values[:, n:n + len(times)] = values
+            self.size = n + len(times)
+        else:
+            allTimes = np.concatenate([self.times[:n], times])
+            allValues = np.concatenate([self.values[:, :n], values], axis=1)
+            order = np.argsort(allTimes, kind='mergesort')
+            allTimes, allValues = allTimes[order], allValues[:, order]
+            # the later of equal times is the new observation
+            keep = np.r_[allTimes[1:] != allTimes[:-1], True]
+            self.size = 0
+            self._reserve(int(keep.sum()))
+            self.size = int(keep.sum())
+            self.times[:self.size] = allTimes[keep]
+            self.values[:, :self.size] = allValues[:, keep]
+        self.version += 1
+
+    def tail(self, start, asOf):
+        """
+        Return the observations with start < utc_time <= asOf.
+
+        return: (times, values): numpy arrays
+        """
+        times = self.times[:self.size]
+        begin, end = np.searchsorted(times, [start, asOf], side='right')
+        return times[begin:end], self.values[:, begin:end]
+
+
+def suffix_stats(x):
+    """
+    The stats of the valid values (>0) of every suffix x[i:] of the observations, i in 0..len(x).
+
+    params: x: 1-d numpy array
+    return: (count, sum, squares, median, max, min, otherMax): numpy arrays of len(x)+1,
+            otherMax is the max of the non-null values, for windows without any valid value
+    """
+    valid = x > 0
+    x0 = np.where(valid, x, 0.0)
+    count = np.r_[np.cumsum(valid[::-1])[::-1], 0]
+    total = np.r_[np.cumsum(x0[::-1])[::-1], 0.0]
+    squares = np.r_[np.cumsum((x0 * x0)[::-1])[::-1], 0.0]
+    vmax = np.r_[np.maximum.accumulate(np.where(valid, x, -np.inf)[::-1])[::-1], -np.inf]
+    vmin = np.r_[np.minimum.accumulate(np.where(valid, x, np.inf)[::-1])[::-1], np.inf]
+    otherMax = np.r_[np.maximum.accumulate(np.where(x == x, x, -np.inf)[::-1])[::-1], -np.inf]
+
+    # each suffix sorted, the invalid values as NaN at the end
+    m = len(x)
+    suffixes = np.where(np.triu(np.ones((m + 1, m), dtype=bool)) & valid, x, np.nan)
+    suffixes.sort(axis=1)
+    rows = np.arange(m + 1)
+    lo, hi = np.maximum((count - 1) // 2, 0), np.minimum(count // 2, max(m - 1, 0))
+    median = np.full(m + 1, np.nan)
+    if m:
+        median = np.where(count > 0, (suffixes[rows, lo] + suffixes[rows, hi]) / 2.0, np.nan)
+    return count, total, squares, median, vmax, vmin, otherMax
+
+
+class FeatureStore(object):
+    """
+    Point-in-time features of the next hours, from observations kept in memory.
+
+    params: targets: list of string, the measurements featured, e.g. ['PM2.5', 'PM10']
+    params: windows: list of string, see air_quality_features.WINDOWS
+    params: hours: int, the number of hours featured after asOf
+    """
+    def __init__(self, targets, windows=WINDOWS, hours=HORIZON_HOURS):
+        self.targets = target_list(targets)
+        self.windows = list(windows)
+        self.widths = np.array([window_width(win) for win in windows], dtype=np.int64)
+        self.hours = hours
+        self.series = dict()
+        self.cache = dict()
+        self.columns = ['{}_{}_{}'.format(target, win, stat) for target in self.targets
+                        for win in self.windows for stat in STATS]
+
+    @classmethod
+    def load(cls, city='london', inputPath=None, targets=None, windows=WINDOWS, hours=HORIZON_HOURS):
+        """
+        Load the historical and live air quality data of a city from the pipeline outputs.
+
+        params: city: string, see cities.py
+        params: inputPath: string, the directory of the preprocessed data, default: ../input/{city}
+        params: targets: list of string, default: the measurements in multi-target mode, else the pollutants
+        params: windows: list of string
+        params: hours: int
+        return: FeatureStore
+        """
+        city = get_city(city)
+        if targets is None:
+            targets = city.measurements if multi_target() else list(city.pollutants)
+        store = cls(targets, windows, hours)
+        columns = ['station_id', 'utc_time'] + store.targets + [VALIDITY]
+        for kind in ['hist', 'live']:
+            store.update(read_frame(city.frame('aq_{}_data_merged'.format(kind), inputPath), columns=columns))
+        return store
+
+    def update(self, df):
+        """
+        Add new observations in place, e.g. the live data of the last hour.
+
+        A row with the station and utc_time of a stored observation replaces its values,
+        the last of repeated rows wins.
+
+        params: df: DataFrame, including station_id, utc_time and the target columns, and the validity bitmap if any
+        return: int, the number of rows added
+        """
+        if len(df) == 0:
+            return 0
+        # the missing values are null, as in the rolling stats of the testing features
+        df = with_missing(df, self.targets)
+        stations = df['station_id'].astype(object).values
+        codes, names = pd.factorize(stations)
+        times = df['utc_time'].values.astype('datetime64[ns]').astype(np.int64)
+        values = np.vstack([df[target].values.astype(np.float64) for target in self.targets])
+        order = np.lexsort((times, codes))
+        codes, times, values = codes[order], times[order], values[:, order]
+        bounds = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(codes)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            station = names[codes[start]]
+            t, v = times[start:stop], values[:, start:stop]
+            last = np.r_[t[1:] != t[:-1], True]
+            if station not in self.series:
+                self.series[station] = StationSeries(len(self.targets))
+            self.series[station].update(t[last], v[:, last])
+        return len(df)
+
+    def station_features(self, station, asOf):
+        """
+        Compute the rolling stats of a station for the hours after asOf.
+
+        params: station: string
+        params: asOf: int, nanoseconds since epoch
+        return: numpy array in shape of (hours, len(self.columns))
+        """
+        series = self.series.get(station)
+        version = series.version if series is not None else -1
+        cached = self.cache.get((station, asOf))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        hours = (asOf // HOUR + np.arange(1, self.hours + 1)) * HOUR
+        block = np.full((self.hours, len(self.columns)), np.nan)
+        if series is not None:
+            times, values = series.tail(hours[0] - self.widths.max(), asOf)
+            column = 0
+            for x in values:
+                count, total, squares, median, vmax, vmin, otherMax = suffix_stats(x)
+                for width in self.widths:
+                    starts = np.searchsorted(times, hours - width, side='right')
+                    cnt, s, q = count[starts], total[starts], squares[starts]
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        block[:, column] = np.where(cnt > 0, s / cnt, np.nan)
+                        block[:, column+1] = np.sqrt(np.where(cnt > 1, np.maximum(q - s * s / cnt, 0.0) / (cnt - 1), np.nan))
+                    block[:, column+2] = median[starts]
+                    block[:, column+3] = np.where(cnt > 0, vmax[starts],
+                                                  np.where(otherMax[starts] > -np.inf, otherMax[starts], np.nan))
+                    block[:, column+4] = np.where(cnt > 0, vmin[starts], np.nan)
+                    column += len(STATS)
+
+        if len(self.cache) >= MAX_CACHE:
+            self.cache.clear()
+        self.cache[(station, asOf)] = (version, block)
+        return block
+
+    def features(self, stations, asOf):
+        """
+        Return the label-free features of the stations for the hours after asOf.
+
+        params: stations: list of string
+        params: asOf: datetime-like, the latest time of the observations used
+        return: DataFrame, one row per station and hour (asOf floored + 1h .. + hours), sorted by station_id and utc_time,
+                with station_id, utc_time, the targets (null), the rolling stats, the datetime features
+                and the weather (null)
+        """
+        stations = list(stations)
+        asOf = pd.Timestamp(asOf).value
+        key = ('frame', tuple(stations), asOf)
+        versions = tuple(self.series[s].version if s in self.series else -1 for s in stations)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1].copy()
+
+        hours = pd.DatetimeIndex((asOf // HOUR + np.arange(1, self.hours + 1)) * HOUR)
+        order = sorted(range(len(stations)), key=lambda i: stations[i])
+        blocks = np.vstack([self.station_features(stations[i], asOf) for i in order]) if stations else \
+            np.empty((0, len(self.columns)))
+        calendar = cached_calendar(hours[0], hours[-1]).loc[hours]
+        dtype = np.float32 if compact_mode() else np.float64
+
+        data = {'station_id': np.repeat(np.array([stations[i] for i in order], dtype=object), self.hours),
+                'utc_time': np.tile(hours.values, len(stations))}
+        data.update({target: np.full(len(blocks), np.nan, dtype=dtype) for target in self.targets})
+        data.update({col: blocks[:, i].astype(dtype) for i, col in enumerate(self.columns)})
+        data.update({col: np.tile(calendar[col].values, len(stations)) for col in CALENDAR_COLUMNS})
+        data.update({col: np.full(len(blocks), np.nan, dtype=dtype) for col in WEATHER})
+        df = pd.DataFrame(data)
+        if len(self.cache) >= MAX_CACHE:
+            self.cache.clear()
+        self.cache[key] = (versions, df)
+        return df.copy()
+
+
+if __name__ == '__main__':
+
+    for city in map(get_city, city_arguments()):
+        s = time.time()
+        store = FeatureStore.load(city.name)
+        print('{} feature store of {}: {} stations loaded in {:.2f} secs'.format(
+            city.name.title(), store.targets, len(store.series), time.time() - s))
+
+        args = [arg for arg in sys.argv[1:] if arg[:1].isdigit()]
+        latest = max(series.times[series.size - 1] for series in store.series.values() if series.size)
+        asOf = pd.Timestamp(args[0]) if args else pd.Timestamp(latest)
+
+        s = time.perf_counter()
+        df = store.features(city.stations, asOf)
+        first = time.perf_counter() - s
+        repeat = 1000
+        s = time.perf_counter()
+        for i in range(repeat):
+            store.features(city.stations, asOf)
+        print('Features as of {}: {} rows, first query {:.2f} ms, repeated queries {:.3f} ms'.format(
+            asOf, len(df), first * 1000, (time.perf_counter() - s) / repeat * 1000))
@@ -1,48 +1,291 @@
 #!/usr/bin/python3
 # -*-coding:utf-8
+'''
+Merge the datetime and air quality features into all_features.
+
+The log transformation of the features is a TransformPlan, fitted once on the training
+features and saved as JSON, so the training, testing and streaming rows (e.g. from
+feature_store.py) get the same columns in the same order and dtypes. The stages of run.py fit it
+after merging (see transform_frame()), and so does
+    python3 -u ./merge_all_features.py transform
+which writes {featurePath}/train/{target}/transform_plan.json and {featurePath}/{train,test}/{target}/transformed_features.
+
+@author: Stephen
+'''
+import os
+import json
 import time
+import sys
 import numpy as np
 import pandas as pd
+from utils import target_view
+from storage import read_frame, write_frame, frame_exists
+from panel import Panel, station_axis, time_axis
+from tracing import traced
+from cities import get_city, city_arguments, multi_target
+from validity import VALIDITY, IMPUTED
+
+class TransformPlan(object):
+    """
+    The log transformation of features, fitted on the training features.
+
+    A column is transformed to log_{column} = log(column + 1) when it is numeric, not a label,
+    and its max in the training features is > 100 (NOT LOGICAL!). The transformed columns
+    follow the others, in their order.
+
+    params: logColumns: list of string, the columns to be transformed
+    params: columns: list of string, the columns of the fitted frame
+    params: dtypes: dict, output column -> dtype name of the numeric output columns,
+                    or {'categories': [...]} of the categorical ones (e.g. station_id), fitted on the training features
+    """
+    def __init__(self, logColumns=(), columns=(), dtypes=None):
+        self.logColumns = list(logColumns)
+        self.columns = list(columns)
+        self.dtypes = dict(dtypes or {})
+
+    @property
+    def output_columns(self):
+        return [col for col in self.columns if col not in self.logColumns] + ['log_{}'.format(col) for col in self.logColumns]
+
+    def fit(self, df):
+        """
+        Choose the columns to be transformed from the training features.
+
+        params: df: DataFrame
+        return: TransformPlan, self
+        """
+        self.columns = list(df.columns)
+        self.logColumns = [col for col in df.columns if 'label' not in col
+                           and (pd.api.types.is_integer_dtype(df[col]) or pd.api.types.is_float_dtype(df[col]))
+                           and df[col].max() > 100]
+        # the dtypes of the output: a float32 column is transformed in float32, the others in float64
+        self.dtypes = {col: df[col].dtype.name for col in self.columns if col not in self.logColumns
+                       and (pd.api.types.is_integer_dtype(df[col]) or pd.api.types.is_float_dtype(df[col]))}
+        # the categories are kept, so other rows (e.g. of a few stations) get the codes of the training features
+        self.dtypes.update({col: {'categories': df[col].cat.categories.tolist()} for col in self.columns
+                            if isinstance(df[col].dtype, pd.CategoricalDtype)})
+        self.dtypes.update({'log_{}'.format(col): 'float32' if df[col].dtype == np.float32 else 'float64'
+                            for col in self.logColumns})
+        return self
+
+    def transform(self, df, labels=True):
+        """
+        Apply the plan, to all the transformed columns at once.
+
+        params: df: DataFrame, with the columns of the fitted frame
+        params: labels: bool, False for rows without labels (e.g. from feature_store.py), whose label columns are left out
+        return: DataFrame, with output_columns (without the labels unless labels) in the fitted dtypes
+        """
+        columns = [col for col in self.columns if labels or 'label' not in col]
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            raise ValueError('The features have no columns {} of the transform plan'.format(missing))
+        kept = [col for col in columns if col not in self.logColumns]
+        logged = dict()
+        # one block per output dtype, e.g. the float32 stats and the float64 of int columns
+        for dtype in sorted({self.dtypes['log_{}'.format(col)] for col in self.logColumns}):
+            cols = [col for col in self.logColumns if self.dtypes['log_{}'.format(col)] == dtype]
+            block = np.log1p(df[cols].to_numpy(dtype=dtype)) if len(df) else np.empty((0, len(cols)), dtype=dtype)
+            logged.update({'log_{}'.format(col): block[:, i] for i, col in enumerate(cols)})
+        out = pd.concat([df[kept], pd.DataFrame(logged, index=df.index)], axis=1)
+        out = out[[col for col in self.output_columns if col in out.columns]]
+        dtypes = {col: self.dtype(col) for col in self.dtypes if col in out}
+        for col, dtype in dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                # recoded by value, whatever the categories of the rows
+                out[col] = pd.Categorical(out[col], categories=dtype.categories)
+            elif out[col].dtype != dtype:
+                out[col] = out[col].astype(dtype)
+        self.check(out)
+        return out
 
+    def dtype(self, col):
+        """
+        Return the fitted dtype of an output column.
+
+        params: col: string
+        return: numpy dtype, or pandas.CategoricalDtype of the training categories
+        """
+        dtype = self.dtypes[col]
+        if isinstance(dtype, dict):
+            return pd.CategoricalDtype(dtype['categories'])
+        # plans saved before the categories were kept
+        return pd.CategoricalDtype() if dtype == 'category' else np.dtype(dtype)
+
+    def check(self, df):
+        """
+        Check that transformed rows have the dtypes of the transformed training features.
+
+        params: df: DataFrame, transformed by the plan
+        return: None, raises ValueError for the columns of other dtypes (or categories)
+        """
+        wrong = []
+        for col in self.dtypes:
+            if col not in df:
+                continue
+            dtype = self.dtype(col)
+            if isinstance(dtype, pd.CategoricalDtype) and isinstance(df[col].dtype, pd.CategoricalDtype):
+                if dtype.categories is not None and not df[col].cat.categories.equals(dtype.categories):
+                    wrong.append(col)
+            elif df[col].dtype != dtype:
+                wrong.append(col)
+        if wrong:
+            raise ValueError('The transformed columns {} do not have the dtypes of the training features'.format(wrong))
+
+    def save(self, path):
+        """
+        Save the plan as JSON.
+        """
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'log_columns': self.logColumns, 'columns': self.columns, 'dtypes': self.dtypes}, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a plan saved by save().
+        """
+        with open(path) as f:
+            plan = json.load(f)
+        return cls(plan['log_columns'], plan['columns'], plan['dtypes'])
+
+
+@traced()
 def log_transformation(df):
     """
     Perform Log Transformation on features, which max value is > 100 (NOT LOGICAL!)
+
+    The plan is fitted on df itself; fit a TransformPlan on the training features to transform other rows the same way.
+    """
+    plan = TransformPlan().fit(df)
+    for col in plan.logColumns:
+        print('Perform Log Transformation on column: ', col)
+    return plan.transform(df)
+
+
+def feature_directory(featurePath, dataType, airQuality):
     """
-    for col in df.columns:
-        if 'label' in col:
-            pass
-        elif df[col].dtypes == np.int64 and df[col].max() > 100:
-            print('Perform Transformation on column: ', col)
-            df['log_{}'.format(col)] = np.log(df[col] + 1) # smoothing
-            df.drop(col, axis = 1, inplace = True)
-        elif df[col].dtypes == np.float64 and df[col].max() > 100:
-            print('Perform Log Transformation on column: ', col)
-            df['log_{}'.format(col)] = np.log(df[col] + 1) # smoothing
-            df.drop(col, axis = 1, inplace = True)
-    return df
-
-def merge_features(dataType, airQuality):
+    Return the directory of the features of a data type, and of a target unless airQuality is None (multi-target mode).
+    """
+    return '{}/{}'.format(featurePath, dataType) if airQuality is None else '{}/{}/{}'.format(featurePath, dataType, airQuality)
+
+
+def plan_path(featurePath, airQuality):
+    """
+    Return the path of the transform plan fitted on the training features of a target, or of the wide frame if airQuality is None.
+    """
+    return '{}/transform_plan.json'.format(feature_directory(featurePath, 'train', airQuality))
+
+
+@traced()
+def transform_frame(df, planPath, fit=False):
+    """
+    Transform all_features with the transform plan, e.g. in a stage of run.py.
+
+    params: df: DataFrame, all_features
+    params: planPath: string, see plan_path()
+    params: fit: bool, True to fit the plan on df (the training features) and save it,
+                 False to load the saved plan (e.g. for the testing features)
+    return: DataFrame, the transformed features
+    """
+    if fit:
+        plan = TransformPlan().fit(df)
+        plan.save(planPath)
+    else:
+        plan = TransformPlan.load(planPath)
+    return plan.transform(df)
+
+
+@traced()
+def transform_features(airQuality, featurePath='../feature/london'):
+    """
+    Fit the transform plan on the training features, save it and transform the training and testing features.
+
+    params: airQuality: str, or None for the wide frames of multi-target mode
+    params: featurePath: str, the directory of features of a city
+    return: TransformPlan
+    """
+    trainDirectory, testDirectory = (feature_directory(featurePath, dataType, airQuality) for dataType in ['train', 'test'])
+    train = read_frame('{}/all_features'.format(trainDirectory))
+    plan = TransformPlan().fit(train)
+    plan.save(plan_path(featurePath, airQuality))
+    write_frame(plan.transform(train), '{}/transformed_features'.format(trainDirectory))
+    del train
+    write_frame(plan.transform(read_frame('{}/all_features'.format(testDirectory))),
+                '{}/transformed_features'.format(testDirectory))
+    return plan
+
+
+def merge_features(dataType, airQuality, featurePath='../feature/london'):
     """
     Merge datetime features and air quality features into a dataframe
 
     params: dataType: str = ['train', 'test']
-    params: airQuality: str = ['PM2.5', 'PM10']
+    params: airQuality: str = ['PM2.5', 'PM10'], or None for the wide frames of multi-target mode
+    params: featurePath: str, the directory of features of a city
     return: dataframe
     """
-    df_datetime = pd.read_csv('../feature/london/{}/{}/datetime_features.csv'.format(dataType, airQuality))
-    df_airquality = pd.read_csv('../feature/london/{}/{}/air_quality_features.csv'.format(dataType, airQuality))
-    df = pd.merge(df_airquality, df_datetime, on=['station_id', 'utc_time'])
- 
-    return df
+    directory = feature_directory(featurePath, dataType, airQuality)
+    df_datetime = read_frame('{}/datetime_features'.format(directory))
+    df_airquality = read_frame('{}/air_quality_features'.format(directory))
+    weatherPath = '{}/weather_features'.format(featurePath)
+    df_weather = read_frame(weatherPath) if frame_exists(weatherPath) else None
+    return merge_frames(df_airquality, df_datetime, df_weather)
+
+@traced()
+def merge_frames(df_airquality, df_datetime, df_weather=None):
+    """
+    Merge datetime features, air quality features and weather features already in memory
+
+    The rows line up by position on a station x hour panel instead of a key join.
+    Columns in both frames (the label and its validity bitmap) are kept once, from df_airquality.
+    The validity bitmaps of the air quality values are not features, and are left out; the label validity
+    bitmaps are kept, so that the rows of filled labels can be left out when training.
+    The weather only covers the hours of the live grid data, so it is joined to the rows
+    of the other features, and null at the other hours (e.g. the historical and testing rows).
+
+    params: df_airquality: DataFrame
+    params: df_datetime: DataFrame
+    params: df_weather: DataFrame, see weather_features.py, or None
+    return: dataframe, the rows in both df_airquality and df_datetime, sorted by station_id and utc_time
+    """
+    df_airquality = df_airquality.drop(columns=[VALIDITY, IMPUTED], errors='ignore')
+    stations = station_axis(df_airquality, df_datetime)
+    times = time_axis(df_airquality, df_datetime)
+    airquality = Panel.from_frame(df_airquality, stations=stations, times=times)
+    datetime = Panel.from_frame(df_datetime, stations=stations, times=times)
+    merged = airquality.join(datetime, how='inner')
+    if df_weather is not None:
+        merged = merged.join(Panel.from_frame(df_weather, stations=stations, times=times), how='left')
+    return merged.to_frame()
 
 if __name__ == "__main__":
     s = time.time()
 
-    inputPair = [(dataType, airQuality) for dataType in ['train', 'test'] for airQuality in ['PM2.5', 'PM10']]
-    for pair in inputPair:
-        print('Merging {} {} dataset...'.format(pair[1], pair[0]))
-        df = merge_features(pair[0], pair[1])
-        df.to_csv('../feature/london/{}/{}/all_features.csv'.format(pair[0], pair[1]), index=False)
+    for city in map(get_city, city_arguments()):
+        if multi_target():
+            # one wide merge of all measurements, and the frames of the pollutants as its views
+            for dataType in ['train', 'test']:
+                print('Merging {} {} dataset of {}...'.format(city.name.title(), dataType, city.measurements))
+                df = merge_features(dataType, None, city.featurePath)
+                write_frame(df, '{}/{}/all_features'.format(city.featurePath, dataType))
+                for airQuality in city.pollutants:
+                    write_frame(target_view(df, airQuality, city.measurements),
+                                '{}/{}/{}/all_features'.format(city.featurePath, dataType, airQuality))
+            if 'transform' in sys.argv:
+                for airQuality in [None] + list(city.pollutants):
+                    transform_features(airQuality, city.featurePath)
+            continue
+
+        inputPair = [(dataType, airQuality) for dataType in ['train', 'test'] for airQuality in city.pollutants]
+        for pair in inputPair:
+            print('Merging {} {} {} dataset...'.format(city.name.title(), pair[1], pair[0]))
+            df = merge_features(pair[0], pair[1], city.featurePath)
+            write_frame(df, '{}/{}/{}/all_features'.format(city.featurePath, pair[0], pair[1]))
+        if 'transform' in sys.argv:
+            for airQuality in city.pollutants:
+                print('Transforming {} {} features...'.format(city.name.title(), airQuality))
+                transform_features(airQuality, city.featurePath)
 
     e = time.time()
     print('Process time: {:.2f} secs'.format(e-s))
@@ -3,40 +3,195 @@
 """
 Feature Engineering Pipeline.
 
-Note: The prediction dates can be passed as parameters into scripts
+The preprocessing and feature stages run in this process (see dag.py), so the
+labels and features are passed in memory. Stages whose inputs, parameters and
+code are unchanged since the last run are skipped, and the datetime and air quality
+features run concurrently.
+
+Each city named in the arguments runs its own pipeline in a worker process (see
+dag.run_cities), e.g. python3 run.py london beijing (default: london).
+
+With MULTI_TARGET=1 (or the argument multi), all the measurements of a city are labeled
+and featured together into wide frames (see feature_stages).
+
+The merged features are transformed by the transform plan fitted on the training features,
+saved next to them and loaded to transform the testing features (see transform_stages).
+
+Note: The prediction dates can be passed as parameters, e.g. python3 run.py 2018-05-01 2018-05-02
+The exit status is 1 when any stage or city failed, after the other stages ran.
 
 @author: Stephen
 """
 import os
 import time
 import sys
-from datetime import date, timedelta
-
-#######################
-# Feature Engineering #
-#######################
-s = time.time()
-
-# Initialize the prediction dates
-today = date.today()
-submission_day1 = today + timedelta(days=1)
-submission_day2 = today + timedelta(days=2)
-
-print(.)
-print('Step 1: Generate Datetime Features')
-os.system('python3 -u ./datetime_features.py')
-
-print(.)
-print('Step 2: Generate Air Quality Features')
-os.system('python3 -u ./air_quality_features.py')
-
-print(.)
-print('Step 3: Merge all features')
-os.system('python3 -u ./merge_all_features.py')
-
-e = time.time()
-print('.')
-print('.')
-print('.')
-print('Feature Engineering Done!')
-print('It take {} mins'.format((e-s)/60.0))
\ No newline at end of file
+from datetime import date
+from utils import submission_days, target_view
+from dag import Stage, Pipeline, run_cities, failed
+from pipeline import preprocessing_stages
+from cities import get_city, city_arguments, multi_target
+from datetime_features import train_test_datetime_features
+from air_quality_features import air_quality_features
+from merge_all_features import merge_frames, transform_frame, feature_directory, plan_path
+from weather_features import interpolation_index, weather_features
+
+# the modules run by the feature stages besides the module of their function, part of their fingerprints
+DATETIME_CODE = ['utils', 'storage']
+AIR_QUALITY_CODE = ['utils', 'feature_registry', 'panel', 'parallel', 'validity', 'storage']
+MERGE_CODE = ['panel', 'validity', 'storage']
+
+
+def feature_stages(submission_day1, featurePath=None, rawPath='../raw_data', city='london', multiTarget=None):
+    """
+    Create the stages of feature engineering of a city.
+
+    In multi-target mode, the datetime and air quality features of all measurements are
+    computed in one pass each and merged into one wide frame per data type, and the
+    features of each pollutant are its views ({featurePath}/{dataType}/{target}/all_features).
+
+    params: submission_day1: datetime.date, the first prediction day
+    params: featurePath: string, the directory of features, default: ../feature/{city}
+    params: rawPath: string, the root directory of raw data, for the station coordinates
+    params: city: string, see cities.py
+    params: multiTarget: bool, default: cities.multi_target()
+    return: list of Stage
+    """
+    city = get_city(city)
+    featurePath = featurePath or city.featurePath
+    multiTarget = multi_target() if multiTarget is None else multiTarget
+    stages = list()
+    stages.append(Stage('weather_index', interpolation_index, params={'rawPath': rawPath, 'city': city.name},
+                        outputs={'weather_index': '{}/weather_index'.format(featurePath)},
+                        files=['{}/{}'.format(rawPath, city.aqStationsFile),
+                               '{}/{}'.format(rawPath, city.gridStationsFile)], code=['cities']))
+    stages.append(Stage('weather_features', weather_features, inputs=['weather_index', 'grid_live'],
+                        code=['cities', 'panel', 'validity', 'storage'],
+                        outputs={'weather': '{}/weather_features'.format(featurePath)}))
+    if multiTarget:
+        return stages + multi_target_stages(submission_day1, featurePath, city)
+
+    for target in city.pollutants:
+        inputs = ['{}_hist_label'.format(target), '{}_live_label'.format(target)]
+        params = {'submission_day1': submission_day1}
+        stages.append(Stage('datetime_features_{}'.format(target), train_test_datetime_features,
+                            inputs=inputs, params=dict(params, target=target), code=DATETIME_CODE,
+                            outputs={'{}_{}_datetime'.format(target, dataType):
+                                     '{}/{}/{}/datetime_features'.format(featurePath, dataType, target)
+                                     for dataType in ['train', 'test']}))
+        stages.append(Stage('air_quality_features_{}'.format(target), air_quality_features,
+                            inputs=inputs, params=dict(params, air_quality=target), code=AIR_QUALITY_CODE,
+                            outputs={'{}_{}_aq'.format(target, dataType):
+                                     '{}/{}/{}/air_quality_features'.format(featurePath, dataType, target)
+                                     for dataType in ['train', 'test']}))
+        for dataType in ['train', 'test']:
+            stages.append(Stage('merge_features_{}_{}'.format(dataType, target), merge_frames,
+                                inputs=['{}_{}_aq'.format(target, dataType), '{}_{}_datetime'.format(target, dataType), 'weather'],
+                                outputs={'{}_{}_all'.format(target, dataType):
+                                         '{}/{}/{}/all_features'.format(featurePath, dataType, target)}, code=MERGE_CODE))
+        stages += transform_stages(featurePath, target)
+    return stages
+
+
+def transform_stages(featurePath, target=None):
+    """
+    Create the stages fitting the transform plan on the training all_features of a target, and transforming
+    the training and testing all_features with it into transformed_features (see merge_all_features.py).
+
+    The testing stage loads the saved plan after the training stage, and runs again when the plan changes.
+
+    params: featurePath: string, the directory of features
+    params: target: string, or None for the wide frames of multi-target mode
+    return: list of Stage
+    """
+    prefix, suffix = ('', '') if target is None else ('{}_'.format(target), '_{}'.format(target))
+    planPath = plan_path(featurePath, target)
+    stages = list()
+    for dataType in ['train', 'test']:
+        fit = dataType == 'train'
+        stages.append(Stage('transform_features_{}{}'.format(dataType, suffix), transform_frame,
+                            inputs=['{}{}_all'.format(prefix, dataType)], params={'planPath': planPath, 'fit': fit},
+                            after=[] if fit else ['transform_features_train{}'.format(suffix)],
+                            files=[] if fit else [planPath],
+                            outputs={'{}{}_transformed'.format(prefix, dataType):
+                                     '{}/transformed_features'.format(feature_directory(featurePath, dataType, target))}))
+    return stages
+
+
+def multi_target_stages(submission_day1, featurePath, city):
+    """
+    Create the feature stages of all measurements of a city at once, from the labels of multi-target mode.
+
+    params: submission_day1: datetime.date, the first prediction day
+    params: featurePath: string, the directory of features
+    params: city: City
+    return: list of Stage
+    """
+    stages = list()
+    inputs = ['hist_label', 'live_label']
+    params = {'submission_day1': submission_day1}
+    stages.append(Stage('datetime_features', train_test_datetime_features,
+                        inputs=inputs, params=dict(params, target=city.measurements), code=DATETIME_CODE,
+                        outputs={'{}_datetime'.format(dataType): '{}/{}/datetime_features'.format(featurePath, dataType)
+                                 for dataType in ['train', 'test']}))
+    stages.append(Stage('air_quality_features', air_quality_features,
+                        inputs=inputs, params=dict(params, air_quality=city.measurements), code=AIR_QUALITY_CODE,
+                        outputs={'{}_aq'.format(dataType): '{}/{}/air_quality_features'.format(featurePath, dataType)
+                                 for dataType in ['train', 'test']}))
+    for dataType in ['train', 'test']:
+        stages.append(Stage('merge_features_{}'.format(dataType), merge_frames,
+                            inputs=['{}_aq'.format(dataType), '{}_datetime'.format(dataType), 'weather'], code=MERGE_CODE,
+                            outputs={'{}_all'.format(dataType): '{}/{}/all_features'.format(featurePath, dataType)}))
+        for target in city.pollutants:
+            stages.append(Stage('features_{}_{}'.format(dataType, target), target_view,
+                                inputs=['{}_all'.format(dataType)],
+                                params={'target': target, 'targets': city.measurements}, code=['utils'],
+                                outputs={'{}_{}_all'.format(target, dataType):
+                                         '{}/{}/{}/all_features'.format(featurePath, dataType, target)}))
+    for target in [None] + list(city.pollutants):
+        stages += transform_stages(featurePath, target)
+    return stages
+
+
+def run_city(city, submission_day1):
+    """
+    Run the preprocessing and feature pipeline of a city, e.g. in a worker process of dag.run_cities.
+
+    params: city: string
+    params: submission_day1: datetime.date, the first prediction day
+    return: dict, stage name -> status
+    """
+    city = get_city(city)
+    for dataType in ['train', 'test']:
+        for target in city.pollutants:
+            path = '{}/{}/{}'.format(city.featurePath, dataType, target)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+    if not os.path.isdir(city.inputPath):
+        os.makedirs(city.inputPath)
+
+    return Pipeline(preprocessing_stages(retrieve=False, city=city.name) + feature_stages(submission_day1, city=city.name),
+                    cachePath='{}/dag_cache.json'.format(city.inputPath)).run()
+
+
+if __name__ == '__main__':
+
+    #######################
+    # Feature Engineering #
+    #######################
+    s = time.time()
+
+    # Initialize the prediction dates
+    submission_day1, submission_day2 = submission_days(date.today())
+
+    print('Generate Datetime, Air Quality, Weather Features and Merge all features')
+    status = run_cities(run_city, city_arguments(), (submission_day1,))
+
+    e = time.time()
+    print('.')
+    print('.')
+    print('.')
+    print('Feature Engineering Done! {}'.format(status))
+    print('It take {} mins'.format((e-s)/60.0))
+    if failed(status):
+        print('Failed: {}'.format(failed(status)))
+        sys.exit(1)
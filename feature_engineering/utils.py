@@ -0,0 +1,129 @@
+# -*-coding:utf-8
+"""
+Shared helpers of the feature engineering scripts.
+
+The modules of data_processing (e.g. storage) become importable after importing utils.
+
+@author: Stephen
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+DATA_PROCESSING_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data_processing'))
+if DATA_PROCESSING_DIR not in sys.path:
+    sys.path.append(DATA_PROCESSING_DIR)
+
+from storage import read_frame, update_column
+
+
+def submission_days(today):
+    """
+    Return the two prediction days, given as 'YYYY-MM-DD' script arguments or the two days after today.
+
+    params: today: datetime.date, the default reference day
+    return: (submission_day1, submission_day2): datetime.date
+    """
+    args = [arg for arg in sys.argv[1:] if arg[:1].isdigit()]
+    if len(args) > 1:
+        return tuple(datetime.strptime(arg, '%Y-%m-%d').date() for arg in args[:2])
+    return today + timedelta(days=1), today + timedelta(days=2)
+
+
+def test_frame(stationId, submission_day1, hours=48):
+    """
+    Create the empty testing rows, every station by every hour of the next two days.
+
+    params: stationId: iterable of string
+    params: submission_day1: datetime.date, the first prediction day
+    params: hours: int, the number of prediction hours
+    return: DataFrame, with columns station_id and utc_time
+    """
+    testStartTime = datetime(year=submission_day1.year, month=submission_day1.month, day=submission_day1.day)
+    testTime = [testStartTime+timedelta(hours=delta) for delta in range(hours)]
+    testPair = [(sid, time) for sid in stationId for time in testTime]
+    return pd.DataFrame(testPair, columns=['station_id', 'utc_time'])
+
+
+def station_watermark(df):
+    """
+    Return the latest utc_time of each station.
+
+    params: df: DataFrame, including station_id and utc_time columns
+    return: dict, station_id -> pandas.Timestamp
+    """
+    return df.groupby(df['station_id'].astype(object))['utc_time'].max().to_dict()
+
+
+def split_at_watermark(df, watermark, lookback=0):
+    """
+    Split rows into those after the watermark of their station, and those at it or up to lookback hours before.
+
+    params: df: DataFrame, including station_id and utc_time columns
+    params: watermark: dict, station_id -> pandas.Timestamp, stations without one are all new
+    params: lookback: int, hours before the watermark of the boundary rows, e.g. whose label validity bitmaps
+                      still change with the new rows, or None for all the rows up to the watermark
+    return: (new, boundary): DataFrame
+    """
+    mark = pd.to_datetime(df['station_id'].astype(object).map(watermark))
+    boundary = df['utc_time'] <= mark
+    if lookback is not None:
+        boundary &= df['utc_time'] >= mark - timedelta(hours=lookback)
+    return df[mark.isna() | (df['utc_time'] > mark)], df[boundary]
+
+
+def revised_rows(stored, df, columns):
+    """
+    Return the rows whose keys are stored with other values, e.g. live rows revised by the duplicate
+    policy 'last' of data_integration.py after they were featured.
+
+    params: stored: DataFrame, including station_id, utc_time and columns, e.g. the rolling tail state
+    params: df: DataFrame, the rows read again, including station_id, utc_time and columns
+    params: columns: list of string, the compared columns
+    return: DataFrame, the rows of df with other values, with station_id, utc_time and columns
+    """
+    keys = ['station_id', 'utc_time']
+    both = df[keys + columns].astype({'station_id': object}).merge(
+        stored[keys + columns].astype({'station_id': object}), on=keys, suffixes=('', '_stored'))
+    differ = np.zeros(len(both), dtype=bool)
+    for col in columns:
+        new, old = both[col].values, both['{}_stored'.format(col)].values
+        differ |= ~((new == old) | (pd.isna(new) & pd.isna(old)))
+    return both.loc[differ, keys + columns]
+
+
+def update_labels(path, boundary, labelNames):
+    """
+    Overwrite in place the labels of stored rows, which were not known when the rows were stored.
+
+    params: path: string, the stored features without extension
+    params: boundary: DataFrame, rows with station_id, utc_time and the new labels
+    params: labelNames: list of string, e.g. ['PM2.5_label', 'PM2.5_label_validity']
+    return: None
+    """
+    stored = read_frame(path, columns=['station_id', 'utc_time'])
+    keys = pd.DataFrame({'station_id': stored['station_id'].astype(object), 'utc_time': stored['utc_time'],
+                         'position': np.arange(len(stored))})
+    boundary = boundary[['station_id', 'utc_time'] + labelNames].astype({'station_id': object})
+    rows = keys.merge(boundary, on=['station_id', 'utc_time'])
+    for labelName in labelNames:
+        update_column(path, labelName, rows['position'].values, rows[labelName].values)
+
+
+def target_view(df, target, targets):
+    """
+    Select the columns of one target from a wide multi-target frame, in the layout of a single-target frame.
+
+    The columns of the other targets (e.g. 'PM10', 'PM10_label', 'PM10_1d_mean') are left out,
+    the keys and the shared columns (e.g. the datetime features) are kept.
+
+    params: df: DataFrame, with the columns of several targets
+    params: target: string, e.g. 'PM2.5'
+    params: targets: list of string, all the targets of the frame
+    return: DataFrame
+    """
+    others = [other for other in targets if other != target]
+    return df[[col for col in df.columns if not any(col == other or col.startswith(other + '_') for other in others)]]
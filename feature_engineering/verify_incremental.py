@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+Check that the incremental features equal a full computation.
+
+The live data is replayed day by day: each day is labeled as create_label.py does,
+the incremental features are updated in a temporary directory, and the stored
+features are finally compared with air_quality_features() and train_test_datetime_features().
+A value of the last day is then revised, as the duplicate policy 'last' of data_integration.py
+does with a day downloaded again, and the features updated once more: without the historical
+data, the revision must be refused, and with it, the features must equal the full computation
+of the revised data.
+
+Usage:
+    python3 -u ./verify_incremental.py [days] [city]
+
+@author: Stephen
+'''
+import sys
+import shutil
+import tempfile
+import pandas as pd
+from datetime import datetime
+from utils import submission_days
+from storage import read_frame, apply_schema
+from validity import valid_mask
+from create_label import label_data
+from air_quality_features import air_quality_features, incremental_air_quality_features
+from datetime_features import train_test_datetime_features, incremental_datetime_features
+from cities import get_city, city_arguments
+
+
+def comparable(df):
+    """
+    Sort a feature frame by station and time, with the storage schema.
+
+    params: df: DataFrame
+    return: DataFrame
+    """
+    df = apply_schema(df).astype({'station_id': object})
+    return df.sort_values(by=['station_id', 'utc_time']).reset_index(drop=True)
+
+
+def revise(live, target, hours=6):
+    """
+    Return a copy of the live data with a valid value of the target revised, some hours before the latest one.
+
+    params: live: DataFrame, merged live air quality data
+    params: target: string
+    params: hours: int
+    return: DataFrame
+    """
+    live = live.copy()
+    rows = live.index[valid_mask(live, target) & (live['utc_time'] == live['utc_time'].max() - pd.Timedelta(hours=hours))]
+    live.loc[rows[:1], target] += 10
+    return live
+
+
+def verify(hist, live, target, days=3):
+    """
+    Replay the last days of the live data into the incremental features and compare them with a full computation.
+
+    params: hist: DataFrame, merged historical air quality data
+    params: live: DataFrame, merged live air quality data
+    params: target: string, a pollutant of the city, e.g. 'PM2.5'
+    params: days: int, the number of days appended incrementally
+    return: list of string, the names of the frames which differ
+    """
+    hist_data = label_data(hist, target)
+    live_data = label_data(live, target)
+    submission_day1, submission_day2 = submission_days(datetime.date(live['utc_time'].max()))
+
+    featurePath = tempfile.mkdtemp(prefix='incremental_features_')
+    try:
+        lastDay = live['utc_time'].max().floor('D')
+        for cut in pd.date_range(end=lastDay, periods=days + 1, freq='D')[:-1].tolist() + [None]:
+            prefix = live if cut is None else live[live['utc_time'] < cut]
+            prefix_data = label_data(prefix, target)
+            incremental_air_quality_features(hist_data, prefix_data, target, submission_day1, featurePath)
+            incremental_datetime_features(hist_data, prefix_data, target, submission_day1, featurePath)
+
+        live_data = label_data(revise(live.reset_index(drop=True), target), target)
+        mismatches = list()
+        try:
+            incremental_air_quality_features(None, live_data, target, submission_day1, featurePath)
+            print('{}: the revised live data was featured without the historical data'.format(target))
+            mismatches.append('revised/{}'.format(target))
+        except ValueError:
+            pass
+        incremental_air_quality_features(hist_data, live_data, target, submission_day1, featurePath)
+        incremental_datetime_features(hist_data, live_data, target, submission_day1, featurePath)
+
+        aq_train, aq_test = air_quality_features(hist_data, live_data, target, submission_day1)
+        dt_train, dt_test = train_test_datetime_features(hist_data, live_data, target, submission_day1)
+        expected = {'train/{}/air_quality_features': aq_train, 'test/{}/air_quality_features': aq_test,
+                    'train/{}/datetime_features': dt_train, 'test/{}/datetime_features': dt_test}
+
+        for name, df in expected.items():
+            name = name.format(target)
+            try:
+                pd.testing.assert_frame_equal(comparable(read_frame('{}/{}'.format(featurePath, name))),
+                                              comparable(df), check_exact=False, rtol=1e-5, check_dtype=False)
+            except AssertionError as e:
+                print('{}: {}'.format(name, e))
+                mismatches.append(name)
+        return mismatches
+    finally:
+        shutil.rmtree(featurePath)
+
+
+if __name__ == '__main__':
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 3
+    mismatches = list()
+    for city in map(get_city, city_arguments()):
+        hist = read_frame(city.frame('aq_hist_data_merged'))
+        live = read_frame(city.frame('aq_live_data_merged'))
+        for target in city.pollutants:
+            mismatches += verify(hist, live, target, days)
+    print('Incremental features equal the full computation' if not mismatches else 'Mismatches: {}'.format(mismatches))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+Check that the missing labels reach all_features marked invalid.
+
+The label of a row is the observation of its station 1 hour later. When that observation is
+missing, create_label.py fills the label with 0, and bit 0 of {target}_label_validity must stay
+unset through the features and the merge, so that the filled label is not taken for a real zero.
+The testing rows, whose labels are unknown, must have no bit set.
+
+Usage:
+    python3 -u ./verify_label_validity.py [city]
+
+@author: Stephen
+'''
+import sys
+import numpy as np
+import pandas as pd
+import utils  # the modules of data_processing become importable
+from storage import read_frame
+from create_label import label_validity_name
+from validity import VALIDITY, valid_mask
+from cities import get_city, city_arguments
+
+
+def observed_keys(df, target):
+    """
+    Return the keys of the valid observations of a target.
+
+    params: df: DataFrame, merged air quality data
+    params: target: string
+    return: MultiIndex of (station_id, utc_time)
+    """
+    valid = valid_mask(df, target, observed=True)
+    return pd.MultiIndex.from_arrays([df['station_id'].astype(object).values[valid],
+                                      df['utc_time'].values.astype('datetime64[ns]')[valid]])
+
+
+def verify(merged, features, target, kind='train'):
+    """
+    Compare the label validity of the features with the observations an hour later.
+
+    params: merged: DataFrame, merged historical and live air quality data
+    params: features: DataFrame, e.g. {featurePath}/train/{target}/all_features
+    params: target: string
+    params: kind: string, 'train' or 'test'
+    return: int, the number of rows with a missing label marked valid
+    """
+    validity = label_validity_name(target)
+    if validity not in features.columns:
+        print('{} {}: no {} column'.format(kind, target, validity))
+        return len(features)
+    marked = (features[validity].values.astype(np.uint64) & np.uint64(1)).astype(bool)
+    if kind == 'test':
+        observed = np.zeros(len(features), dtype=bool)
+    else:
+        nextHour = pd.MultiIndex.from_arrays([features['station_id'].astype(object).values,
+                                              features['utc_time'].values.astype('datetime64[ns]') + np.timedelta64(1, 'h')])
+        observed = nextHour.isin(observed_keys(merged, target))
+    wrong = int((marked & ~observed).sum())
+    print('{} {}: {} rows, {} missing labels, {} marked valid'.format(kind, target, len(features), (~observed).sum(), wrong))
+    return wrong
+
+
+if __name__ == '__main__':
+
+    wrong = 0
+    for city in map(get_city, city_arguments()):
+        merged = pd.concat([read_frame(city.frame('aq_{}_data_merged'.format(kind)),
+                                       columns=['station_id', 'utc_time'] + city.measurements + [VALIDITY])
+                            for kind in ['hist', 'live']])
+        for target in city.pollutants:
+            for kind in ['train', 'test']:
+                features = read_frame('{}/{}/{}/all_features'.format(city.featurePath, kind, target))
+                wrong += verify(merged, features, target, kind)
+    print('The missing labels are marked invalid' if not wrong else '{} missing labels marked valid'.format(wrong))
+    sys.exit(1 if wrong else 0)
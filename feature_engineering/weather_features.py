@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# -*-coding:utf-8
+'''
+Interpolate the grid weather onto the air quality stations.
+
+The weight index is computed once from the coordinates: each station takes the
+inverse distance weights of its nearest grid points (1 neighbour: nearest neighbour).
+It is kept as a sparse (stations x grids) matrix, and the weather of all hours is
+interpolated by matrix products over batches of hours. Grid points missing at an
+hour, or whose value is missing by the validity bitmap (see validity.py), are left out,
+and the weights of the others are renormalized.
+
+Wind direction is interpolated as a vector (wind speed is averaged as a scalar).
+
+Output:
+    ../feature/{city}/weather_index: station_id, grid_id, distance (km), weight
+    ../feature/{city}/weather_features: station_id, utc_time, temperature, pressure,
+                                        humidity, wind_speed, wind_direction
+
+Usage:
+    python3 -u ./weather_features.py [london|beijing]
+
+@author: Stephen
+'''
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import utils  # the modules of data_processing become importable
+from storage import read_frame, write_frame
+from panel import Panel
+from cities import get_city, city_arguments, station_coordinates, haversine
+from tracing import traced
+from validity import with_missing
+
+WEATHER = ['temperature', 'pressure', 'humidity', 'wind_speed', 'wind_direction']
+
+
+@traced()
+def interpolation_index(rawPath='../raw_data', neighbours=4, power=2, city='london'):
+    """
+    Compute the inverse distance weights from the grid points to the air quality stations.
+
+    params: rawPath: string, the root directory of raw data
+    params: neighbours: int, the number of nearest grid points per station
+    params: power: float, weights are 1 / distance ** power
+    params: city: string, see cities.py
+    return: DataFrame, with columns station_id, grid_id, distance and weight, weights of a station sum to 1
+    """
+    city = get_city(city)
+    aq_stations = station_coordinates('{}/{}'.format(rawPath, city.aqStationsFile))
+    grid_stations = station_coordinates('{}/{}'.format(rawPath, city.gridStationsFile), city.gridStationsHeader)
+
+    distance = haversine(aq_stations['latitude'].values[:, None], aq_stations['longitude'].values[:, None],
+                         grid_stations['latitude'].values[None, :], grid_stations['longitude'].values[None, :])
+    nearest = np.argsort(distance, axis=1, kind='mergesort')[:, :neighbours]
+    nearestDistance = np.take_along_axis(distance, nearest, axis=1)
+
+    with np.errstate(divide='ignore'):
+        weight = 1.0 / nearestDistance ** power
+    # a grid point at the station takes all the weight
+    exact = np.isinf(weight)
+    weight = np.where(exact.any(axis=1, keepdims=True), exact.astype(np.float64), weight)
+    weight /= weight.sum(axis=1, keepdims=True)
+
+    return pd.DataFrame({'station_id': np.repeat(aq_stations.index.values, nearest.shape[1]),
+                         'grid_id': grid_stations.index.values[nearest.ravel()],
+                         'distance': nearestDistance.ravel(),
+                         'weight': weight.ravel()})
+
+
+def weight_matrix(index, stations, grids):
+    """
+    Build the sparse weight matrix of an interpolation index.
+
+    params: index: DataFrame, see interpolation_index()
+    params: stations: list of string, the rows
+    params: grids: list of string, the columns
+    return: scipy.sparse.csr_matrix in shape of (len(stations), len(grids))
+    """
+    row = pd.Index(stations).get_indexer(index['station_id'].astype(object))
+    col = pd.Index(grids).get_indexer(index['grid_id'].astype(object))
+    keep = (row >= 0) & (col >= 0)
+    return sparse.csr_matrix((index['weight'].values[keep].astype(np.float64), (row[keep], col[keep])),
+                             shape=(len(stations), len(grids)))
+
+
+@traced()
+def weather_features(index, grid_live, batchHours=24*7):
+    """
+    Interpolate the grid weather of all hours onto the air quality stations.
+
+    params: index: DataFrame, see interpolation_index()
+    params: grid_live: DataFrame, the merged live grid weather data
+    params: batchHours: int, the number of hours interpolated by one matrix product
+    return: DataFrame, sorted by station_id and utc_time, for the hours with weather around the station
+    """
+    # the values missing from the raw data (see the validity bitmap) are left out as the grid points missing at an hour
+    grid_live = with_missing(grid_live, WEATHER)
+    # wind direction is averaged through its vector components
+    radians = np.radians(grid_live['wind_direction'].values.astype(np.float64))
+    speed = grid_live['wind_speed'].values.astype(np.float64)
+    calm = grid_live['wind_direction'].values > 360
+    grid = grid_live[['station_id', 'utc_time', 'temperature', 'pressure', 'humidity', 'wind_speed']].assign(
+        wind_u=np.where(calm, 0.0, speed * np.sin(radians)), wind_v=np.where(calm, 0.0, speed * np.cos(radians)))
+    variables = ['temperature', 'pressure', 'humidity', 'wind_speed', 'wind_u', 'wind_v']
+
+    grids = sorted(set(index['grid_id'].astype(object)))
+    stations = sorted(set(index['station_id'].astype(object)))
+    panel = Panel.from_frame(grid, variables, stations=grids)
+    W = weight_matrix(index, stations, grids)
+    hours = len(panel.times)
+
+    shape = (len(stations), hours)
+    result = {variable: np.full(shape, np.nan) for variable in variables}
+    observed = np.zeros(shape, dtype=bool)
+    for start in range(0, hours, batchHours):
+        stop = min(start + batchHours, hours)
+        # all variables of the batch in one (grids x variables * hours) product
+        mask = np.hstack([panel.mask[variable][:, start:stop] for variable in variables]).astype(np.float64)
+        values = np.hstack([np.where(panel.mask[variable][:, start:stop], panel.values[variable][:, start:stop], 0.0)
+                            for variable in variables])
+        total = W @ values
+        weight = W @ mask
+        with np.errstate(divide='ignore', invalid='ignore'):
+            interpolated = np.where(weight > 0, total / weight, np.nan)
+        for k, variable in enumerate(variables):
+            result[variable][:, start:stop] = interpolated[:, k * (stop - start):(k + 1) * (stop - start)]
+        observed[:, start:stop] = (weight > 0).reshape(len(stations), len(variables), stop - start).any(axis=1)
+
+    result['wind_direction'] = np.degrees(np.arctan2(result.pop('wind_u'), result.pop('wind_v'))) % 360
+    weather = Panel(stations, panel.times, {variable: result[variable] for variable in WEATHER},
+                    {variable: ~np.isnan(result[variable]) for variable in WEATHER}, observed)
+    return weather.to_frame()
+
+
+if __name__ == '__main__':
+
+    for city in map(get_city, city_arguments()):
+        path = city.featurePath
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        index = interpolation_index(city=city.name)
+        write_frame(index, '{}/weather_index'.format(path))
+        print('{} weather interpolation index: {} stations, {} grid points'.format(
+            city.name.title(), index['station_id'].nunique(), index['grid_id'].nunique()))
+
+        weather = weather_features(index, read_frame(city.frame('grid_live_data_merged')))
+        write_frame(weather, '{}/weather_features'.format(path))
+        print('Weather features from {} to {}: Done!'.format(weather['utc_time'].min(), weather['utc_time'].max()))